@@ -15,6 +15,11 @@ config = ConfigManager(
     path.join(path.abspath(path.dirname(__file__)), "settings", "config.yml")
 )
 
+# backfill records are split over this many pods (by a hash of
+# reviewerID/asin), each running on its own node, and a merge task puts
+# them back together
+SHARD_COUNT = 4
+
 default_args = {
     "owner": config.read("dag.owner"),
     "start_date": pendulum.datetime(2014, 1, 1, tz="Europe/Amsterdam"),
@@ -25,7 +30,7 @@ with DAG(
     dag_id="process_reviews_and_metadata",
     default_args=default_args,
     schedule_interval="0 * * * *",  # run every hour on the dot
-    catchup=True,
+    catchup=False,  # history is covered by the backfill DAG below
 ) as dag:
     common = {
         "namespace": config.read("cluster_namespace"),
@@ -49,37 +54,81 @@ with DAG(
     # create dummmy task for the run start
     start_operator = DummyOperator(task_id="start_task")
 
-    # and then actual tasks
-    process_reviews_data = KubernetesPodOperator(
+    # and then the actual task: reviews + metadata run concurrently in one
+    # pod (sharing the clients), instead of one pod + cold start each;
+    # an hour of data is small, so it isn't sharded (that's for backfills)
+    process_reviews_and_metadata = KubernetesPodOperator(
         **common,
-        name="process_reviews_data",
+        name="process_reviews_and_metadata",
         arguments=[
             "python",
             "src/entrypoint.py",
             "--task",
-            "process_raw_reviews_data_with_timestamps",
+            "process_reviews_and_metadata",
             "--start_timestamp",
             "{{ data_interval_start }}",
             "--end_timestamp",
             "{{ data_interval_end }}",
+            "--checkpoint",  # so retries only redo the failed stage
         ],
-        task_id="process_reviews_data"
+        task_id="process_reviews_and_metadata",
     )
 
-    process_metadata = KubernetesPodOperator(
+    start_operator >> process_reviews_and_metadata
+
+
+# catching up hour by hour from 2014 means tens of thousands of pods that
+# each re-read the raw data, so history is done by one backfill pod instead
+with DAG(
+    dag_id="backfill_reviews_and_metadata",
+    default_args=default_args,
+    schedule_interval=None,  # triggered manually, with the interval as params
+    catchup=False,
+    params={
+        "start_timestamp": "2014-01-01T00:00:00+01:00",
+        "end_timestamp": "2014-02-01T00:00:00+01:00",
+    },
+) as backfill_dag:
+    backfill_raw_data = KubernetesPodOperator.partial(
         **common,
-        name="process_metadata",
+        name="backfill_raw_data",
+        task_id="backfill_raw_data",
+    ).expand(
+        arguments=[
+            [
+                "python",
+                "src/entrypoint.py",
+                "--task",
+                "backfill_raw_data",
+                "--start_timestamp",
+                "{{ params.start_timestamp }}",
+                "--end_timestamp",
+                "{{ params.end_timestamp }}",
+                "--shard-index",
+                str(shard_index),
+                "--shard-count",
+                str(SHARD_COUNT),
+            ]
+            for shard_index in range(SHARD_COUNT)
+        ]
+    )
+
+    merge_backfill_shards = KubernetesPodOperator(
+        **common,
+        name="merge_backfill_shards",
         arguments=[
             "python",
             "src/entrypoint.py",
             "--task",
-            "process_raw_metadata_with_timestamps",
+            "merge_shards",
             "--start_timestamp",
-            "{{ data_interval_start }}",
+            "{{ params.start_timestamp }}",
             "--end_timestamp",
-            "{{ data_interval_end }}",
+            "{{ params.end_timestamp }}",
+            "--shard-count",
+            str(SHARD_COUNT),
         ],
-        task_id="process_metadata"
+        task_id="merge_backfill_shards",
     )
 
-    start_operator >> [process_reviews_data, process_metadata]
+    backfill_raw_data >> merge_backfill_shards
@@ -0,0 +1,2 @@
+# here so pytest puts the repo root on the path, and the
+# tests can import src when run as `pytest .` (like the CI does)
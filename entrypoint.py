@@ -1,6 +1,7 @@
 import argparse
 
 from src import main
+from src.profiling import profile_task, should_profile
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run a Python job")
@@ -12,8 +13,6 @@ if __name__ == "__main__":
         dest="task_name",
         help="Name of the task to execute",
     )
-    """
-    For when doing it with timestamps:
     parser.add_argument(
         "--start_timestamp",
         "-start_timestamp",
@@ -29,13 +28,214 @@ if __name__ == "__main__":
         default=None,
         help="Timestamp of the date interval end",
     )
-    """
+
+    parser.add_argument(
+        "--datasets",
+        "-datasets",
+        type=str,
+        default=None,
+        help="Comma separated datasets to process, e.g. reviews,metadata",
+    )
+
+    parser.add_argument(
+        "--retrieve_from",
+        "-retrieve_from",
+        type=str,
+        default=None,
+        help="Where to read the raw data from: local, s3 or api",
+    )
+
+    parser.add_argument(
+        "--upload_to",
+        "-upload_to",
+        type=str,
+        default=None,
+        help="Where to write the tables to, e.g. dwh_as_stream",
+    )
+
+    parser.add_argument(
+        "--sequential",
+        "-sequential",
+        action="store_true",
+        help="Run the datasets one after the other instead of concurrently",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        "-checkpoint",
+        action="store_true",
+        help="Checkpoint each stage, so a retry skips the finished stages",
+    )
+
+    parser.add_argument(
+        "--change_data_capture",
+        "-change_data_capture",
+        action="store_true",
+        help="Only load the metadata rows that changed since the last run",
+    )
+
+    parser.add_argument(
+        "--out_of_line_text",
+        "-out_of_line_text",
+        action="store_true",
+        help="Store review texts/descriptions in a separate compressed text store",
+    )
+
+    parser.add_argument(
+        "--near_duplicates",
+        "-near_duplicates",
+        action="store_true",
+        help="Cluster near-duplicate reviews (review_duplicate_clusters table)",
+    )
+
+    parser.add_argument(
+        "--copurchase_graph",
+        "-copurchase_graph",
+        action="store_true",
+        help="Also build the memory-mappable co-purchase graph from the metadata",
+    )
+
+    parser.add_argument(
+        "--surrogate_keys",
+        "-surrogate_keys",
+        action="store_true",
+        help="Use integer surrogate keys instead of the string ids",
+    )
+
+    parser.add_argument(
+        "--data_quality",
+        "-data_quality",
+        type=str,
+        default=None,
+        help="Row-level data quality checks: quarantine or profile (sampled)",
+    )
+
+    parser.add_argument(
+        "--overlapped",
+        "-overlapped",
+        action="store_true",
+        help="Extract, transform and load batches of rows at the same time",
+    )
+
+    parser.add_argument(
+        "--batch_rows",
+        "-batch_rows",
+        type=int,
+        default=None,
+        help="Rows per batch in the overlapped mode",
+    )
+
+    parser.add_argument(
+        "--shard_index",
+        "--shard-index",
+        "-shard_index",
+        type=int,
+        default=None,
+        help="Which shard (0 to shard count - 1) of the records this pod processes",
+    )
+
+    parser.add_argument(
+        "--shard_count",
+        "--shard-count",
+        "-shard_count",
+        type=int,
+        default=None,
+        help="In how many shards the records are split (one pod per shard)",
+    )
+
+    parser.add_argument(
+        "--inverted_index",
+        "-inverted_index",
+        action="store_true",
+        help="Add the review texts to the (memory-mapped) inverted index",
+    )
+
+    parser.add_argument(
+        "--sample_fraction",
+        "-sample_fraction",
+        type=float,
+        default=None,
+        help="Only process this fraction of the products (by asin), for dev runs",
+    )
+
+    parser.add_argument(
+        "--plan",
+        "-plan",
+        action="store_true",
+        help="Pick in memory/chunked/parallel execution from the size of the input",
+    )
+
+    parser.add_argument(
+        "--referential_integrity",
+        "-referential_integrity",
+        action="store_true",
+        help="Report the reviews/related items that refer to unknown products",
+    )
+
+    parser.add_argument(
+        "--tables",
+        "-tables",
+        type=str,
+        default=None,
+        help="Comma separated tables to transform + load (default: all of them)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        "-profile",
+        action="store_true",
+        help="Sample the stacks + memory of the task, per stage",
+    )
+
+    parser.add_argument(
+        "--profile_allocations",
+        "-profile_allocations",
+        action="store_true",
+        help="Also trace the allocations per stage (slow, see src/profiling.py)",
+    )
+
     args = parser.parse_args()
 
     task_name = args.task_name
-    # start_timestamp = args.start_timestamp
-    # end_timestamp = args.end_timestamp
+
+    # only pass the arguments along when given, since not all
+    # tasks take them (e.g. the *_without_timestamps ones)
+    task_arguments = {
+        argument_name: argument_value
+        for argument_name, argument_value in [
+            ("start_timestamp", args.start_timestamp),
+            ("end_timestamp", args.end_timestamp),
+            ("datasets", args.datasets and args.datasets.split(",")),
+            ("retrieve_from", args.retrieve_from),
+            ("upload_to", args.upload_to),
+            ("concurrent", False if args.sequential else None),
+            ("checkpoint", True if args.checkpoint else None),
+            ("change_data_capture", True if args.change_data_capture else None),
+            ("out_of_line_text", True if args.out_of_line_text else None),
+            ("near_duplicates", True if args.near_duplicates else None),
+            ("copurchase_graph", True if args.copurchase_graph else None),
+            ("surrogate_keys", True if args.surrogate_keys else None),
+            ("data_quality", args.data_quality),
+            ("overlapped", True if args.overlapped else None),
+            ("batch_rows", args.batch_rows),
+            ("shard_index", args.shard_index),
+            ("shard_count", args.shard_count),
+            ("inverted_index", True if args.inverted_index else None),
+            ("sample_fraction", args.sample_fraction),
+            ("plan", True if args.plan else None),
+            (
+                "referential_integrity",
+                True if args.referential_integrity else None,
+            ),
+            ("tables", args.tables and args.tables.split(",")),
+        ]
+        if argument_value is not None
+    }
 
     task = getattr(main, task_name)
-    # task(start_timestamp, end_timestamp)
-    task()
+    with profile_task(
+        task_name,
+        enabled=should_profile(args.profile or args.profile_allocations),
+        trace_allocations=args.profile_allocations,
+    ):
+        task(**task_arguments)
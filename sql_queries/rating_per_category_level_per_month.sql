@@ -0,0 +1,34 @@
+-- same idea as rating_per_category_per_month, but at any level of
+-- the category tree (e.g. level 1 = "Electronics", level 2 =
+-- "Electronics > Phones"): items only link to their leaf categories,
+-- and the closure table rolls every leaf up to all its ancestors,
+-- so it's integer joins against small tables instead of strings
+WITH item_ratings AS (
+    SELECT
+        item_id
+        , CONCAT(SUBSTR(CAST(review_date AS VARCHAR(10)), 1, 6), "01") AS month_string
+        , AVG(rating) AS average_item_rating
+    FROM facts.reviews
+    GROUP BY item_id, CONCAT(SUBSTR(CAST(review_date AS VARCHAR(10)), 1, 6), "01")
+),
+item_ancestor_categories AS (
+    -- DISTINCT: two leaves of an item can share an ancestor
+    SELECT DISTINCT
+        leaves.item_id AS item_id
+        , closure.ancestor_category_id AS category_id
+    FROM dimensions.product_category_leaves AS leaves
+    INNER JOIN dimensions.category_closure AS closure
+    ON leaves.category_id = closure.descendant_category_id
+)
+
+SELECT
+    tree.category_path AS category
+    , CAST(item_ratings.month_string AS INT) AS month_int
+    , AVG(item_ratings.average_item_rating) AS average_rating
+FROM item_ratings
+INNER JOIN item_ancestor_categories AS categories
+ON item_ratings.item_id = categories.item_id
+INNER JOIN dimensions.category_tree AS tree
+ON categories.category_id = tree.category_id
+WHERE tree.category_level = 2 -- the level to roll up to
+GROUP BY tree.category_path, CAST(item_ratings.month_string AS INT)
@@ -10,16 +10,28 @@ to retrieve data for specific timestamps
 """
 
 # import json
+import io
 import os
 import re
-from datetime import datetime
-from typing import Optional
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
 
 import pandas as pd
 import requests
-from smart_open import smart_open
-
-from src.constants import S3_ACCESS_KEY_ID, S3_ACCESS_KEY_SECRET, S3_BUCKET_NAME
+import smart_open
+from urllib3.util.request import ACCEPT_ENCODING
+
+from src.compression import detect_compression, open_decompressed
+from src.constants import (
+    DOWNLOAD_CACHE_ENABLED,
+    RANGED_DOWNLOAD_THRESHOLD_BYTES,
+    RAW_DATA_FILE_EXTENSION,
+    S3_BUCKET_NAME,
+)
+from src.download_cache import S3DownloadCache
+from src.helper_functions import convert_timestamp_to_unix, get_s3_client
+from src.json_decoding import decode_data_records
+from src.ranged_download import RangedObjectReader
 
 # from datasets import load_dataset
 # from huggingface_hub import hf_hub_download
@@ -53,17 +65,128 @@ def compose_timestamp_based_request_parameters(
     return params
 
 
+def filter_on_review_time(
+    target_data: pd.DataFrame,
+    start_timestamp: Optional[str],
+    end_timestamp: Optional[str],
+) -> pd.DataFrame:
+    """Keep the records with start <= unixReviewTime < end"""
+    # half-open, like the backfill's hourly intervals, so a record right
+    # on the hour (all of them: the review times are days) is loaded by
+    # one hourly run, not by both the runs it borders
+    if start_timestamp is not None:
+        # first convert str to unix
+        start_timestamp_as_unix = convert_timestamp_to_unix(start_timestamp)
+
+        # then filter data
+        target_data = target_data[
+            target_data["unixReviewTime"] >= start_timestamp_as_unix
+        ]
+
+        # reset index to return clean
+        target_data.reset_index(drop=True, inplace=True)
+
+    if end_timestamp is not None:
+        # same steps as for start timestamp
+        end_timestamp_as_unix = convert_timestamp_to_unix(end_timestamp)
+
+        target_data = target_data[target_data["unixReviewTime"] < end_timestamp_as_unix]
+        target_data.reset_index(drop=True, inplace=True)
+
+    return target_data
+
+
+def is_local_file(raw_file: BinaryIO) -> bool:
+    """Whether the file is on disk (and can therefore be memory-mapped)"""
+    try:
+        raw_file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+
+    return True
+
+
+@contextmanager
+def open_s3_object(
+    bucket_name: str, object_key: str, use_download_cache: bool
+) -> Iterator[BinaryIO]:
+    """Open a raw S3 object for reading, in the cheapest way available"""
+    s3_client = get_s3_client()
+
+    if use_download_cache:
+        download_cache = S3DownloadCache(s3_client=s3_client)
+        etag, object_size, cache_file_path = download_cache.lookup(
+            bucket_name, object_key
+        )
+
+        if cache_file_path is not None:
+            # nothing changed since the last download
+            print(f"Using cached copy of s3://{bucket_name}/{object_key}")
+            with download_cache.open_cached(cache_file_path) as raw_file:
+                yield raw_file
+            return
+    else:
+        object_head = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+        etag, object_size = object_head["ETag"], object_head["ContentLength"]
+
+    # small objects: one stream is plenty
+    if object_size < RANGED_DOWNLOAD_THRESHOLD_BYTES:
+        if use_download_cache:
+            with download_cache.fetch(bucket_name, object_key, etag) as raw_file:
+                yield raw_file
+        else:
+            # reuse the shared client instead of setting up a new one per read
+            with smart_open.open(
+                f"s3://{bucket_name}/{object_key}",
+                "rb",
+                transport_params={"client": s3_client},
+            ) as raw_file:
+                yield raw_file
+        return
+
+    # big objects: parallel byte ranges, parsed while the rest downloads
+    if not use_download_cache:
+        with RangedObjectReader(
+            s3_client, bucket_name, object_key, object_size, etag
+        ) as raw_file:
+            yield raw_file
+        return
+
+    # ...and with the cache on, the ranges are written to the cache on the way
+    partial_file_path = download_cache.compose_partial_file_path(
+        bucket_name, object_key, etag
+    )
+    try:
+        with open(partial_file_path, "wb") as sink:
+            with RangedObjectReader(
+                s3_client, bucket_name, object_key, object_size, etag, sink=sink
+            ) as raw_file:
+                yield raw_file
+                download_completed = raw_file.completed
+
+        if download_completed:
+            download_cache.add(bucket_name, object_key, etag, partial_file_path).close()
+    finally:
+        if os.path.exists(partial_file_path):
+            os.remove(partial_file_path)
+
+
 class APIInteractor:
     def __init__(self, base_url: str, bearer_token: str):
         """Save base API properties: URL + auth"""
         self.base_url = base_url
         self.headers = compose_api_request_headers(bearer_token)
 
-    def retrieve_data(
+        # one session for all calls, so the connections get reused
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # every compression urllib3 can decode here (e.g. br/zstd if installed)
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+
+    def retrieve_data_batches(
         self, endpoint: str, start_timestamp: str, end_timestamp: str
-    ) -> pd.DataFrame:
-        """Get data from an endpoint, filtering on the timestamp"""
-        response_data_df = pd.DataFrame()
+    ) -> Iterator[pd.DataFrame]:
+        """Get data from an endpoint page by page, filtering on the timestamp"""
         data_complete = False
         api_calls = 0
         params = compose_timestamp_based_request_parameters(
@@ -72,19 +195,17 @@ class APIInteractor:
 
         while not data_complete:
             params["offset"] = params["limit"] * api_calls
-            api_response = requests.get(
-                self.base_url + f"/{endpoint}", headers=self.headers, params=params
-            )
-
-            response_json = api_response.json()
-
-            response_data_content = response_json["data"]
-
-            flattened_response_data = pd.json_normalize(response_data_content, sep="_")
+            # streamed: the records are decoded as the body comes in
+            with self.session.get(
+                self.base_url + f"/{endpoint}", params=params, stream=True
+            ) as api_response:
+                # gzip etc. get decompressed on the way
+                api_response.raw.decode_content = True
+                flattened_response_data = decode_data_records(
+                    api_response.raw, endpoint
+                )
 
-            response_data_df = pd.concat(
-                [response_data_df, flattened_response_data], ignore_index=True, axis=0
-            )
+            yield flattened_response_data
 
             api_calls += 1
 
@@ -97,17 +218,22 @@ class APIInteractor:
                 # so we set this as a safety measure
                 break
 
-            return response_data_df
-
-    @staticmethod
-    def retrieve_data_from_csv(
-        endpoint: str, start_timestamp: Optional[str], end_timestamp: Optional[str]
+    def retrieve_data(
+        self, endpoint: str, start_timestamp: str, end_timestamp: str
     ) -> pd.DataFrame:
-        """Write code for reading data from folders with csvs"""
+        """Get data from an endpoint, filtering on the timestamp"""
+        # concat once at the end rather than once per page
+        response_data_df = pd.concat(
+            list(self.retrieve_data_batches(endpoint, start_timestamp, end_timestamp)),
+            ignore_index=True,
+            axis=0,
+        )
 
-        # create empty df to catch results
-        result_data = pd.DataFrame()
+        return response_data_df
 
+    @staticmethod
+    def list_csv_files(endpoint: str) -> list:
+        """Find the local csv files of an endpoint"""
         # create OS-agnostic path
         path_to_search = os.path.join("data_short")
 
@@ -132,44 +258,58 @@ class APIInteractor:
                 "Incorrect endpoint specified - check your data folder and try again!"
             )
 
-        # file by file, add to results_df
-        for file_name in files_to_read:
-            csv_path = os.path.join(path_to_search, file_name)
+        return [os.path.join(path_to_search, file_name) for file_name in files_to_read]
 
-            data_to_read = pd.read_csv(csv_path, index_col=False)
+    @staticmethod
+    def retrieve_data_from_csv(
+        endpoint: str, start_timestamp: Optional[str], end_timestamp: Optional[str]
+    ) -> pd.DataFrame:
+        """Write code for reading data from folders with csvs"""
+
+        # create empty df to catch results
+        result_data = pd.DataFrame()
+
+        # file by file, add to results_df
+        for csv_path in APIInteractor.list_csv_files(endpoint):
+            compression = detect_compression(csv_path)
+
+            if compression is None:
+                data_to_read = pd.read_csv(csv_path, index_col=False)
+            else:
+                # .csv.gz / .csv.zst are decompressed while being parsed
+                with open(csv_path, "rb") as raw_file, open_decompressed(
+                    raw_file, compression
+                ) as csv_file:
+                    data_to_read = pd.read_csv(csv_file, index_col=False)
 
             result_data = pd.concat(
                 [result_data, data_to_read], axis=0, ignore_index=True
             )
 
         # finally, filter based on the timestamp
-        if start_timestamp is not None:
-            # first convert str to unix
-            start_timestamp_as_unix = datetime.strptime(
-                start_timestamp, "%Y-%m-%d %H:%M:%S.%f"
-            ).timestamp()
-
-            # then filter data
-            result_data = result_data[
-                result_data["unixReviewTime"] >= start_timestamp_as_unix
-            ]
-
-            # reset index to return clean
-            result_data.reset_index(drop=True, inplace=True)
-
-        if end_timestamp is not None:
-            # same steps as for start timestamp
-            end_timestamp_as_unix = datetime.strptime(
-                end_timestamp, "%Y-%m-%d %H:%M:%S.%f"
-            ).timestamp()
-
-            result_data = result_data[
-                result_data["unixReviewTime"] <= end_timestamp_as_unix
-            ]
-            result_data.reset_index(drop=True, inplace=True)
+        result_data = filter_on_review_time(result_data, start_timestamp, end_timestamp)
 
         return result_data
 
+    @staticmethod
+    def retrieve_data_batches_from_csv(
+        endpoint: str,
+        start_timestamp: Optional[str],
+        end_timestamp: Optional[str],
+        batch_rows: int,
+    ) -> Iterator[pd.DataFrame]:
+        """Same as retrieve_data_from_csv, but batch_rows rows at a time"""
+        for csv_path in APIInteractor.list_csv_files(endpoint):
+            with open(csv_path, "rb") as raw_file, open_decompressed(
+                raw_file, detect_compression(csv_path)
+            ) as csv_file:
+                for data_batch in pd.read_csv(
+                    csv_file, index_col=False, chunksize=batch_rows
+                ):
+                    yield filter_on_review_time(
+                        data_batch, start_timestamp, end_timestamp
+                    )
+
     '''
     @staticmethod
     def retrieve_data_from_datasets_package(
@@ -216,7 +356,9 @@ class APIInteractor:
     '''
 
     @staticmethod
-    def retrieve_data_from_s3(table_name: str) -> pd.DataFrame:
+    def retrieve_data_from_s3(
+        table_name: str, use_download_cache: bool = DOWNLOAD_CACHE_ENABLED
+    ) -> pd.DataFrame:
         """Retrieve data from the S3 bucket"""
         # download_path = f"data/{table_name}.csv"
 
@@ -234,17 +376,42 @@ class APIInteractor:
         #    Filename=download_path,
         # )
 
-        aws_key = S3_ACCESS_KEY_ID
-        aws_secret = S3_ACCESS_KEY_SECRET
-
         bucket_name = S3_BUCKET_NAME
-        object_key = f"raw_data/{table_name}.csv"
-
-        path = "s3://{}:{}@{}/{}".format(aws_key, aws_secret, bucket_name, object_key)
-
-        df = pd.read_csv(smart_open(path))
+        object_key = f"raw_data/{table_name}{RAW_DATA_FILE_EXTENSION}"
+
+        # compressed objects are cached/downloaded compressed, and only
+        # decompressed on the fly while parsing
+        with open_s3_object(
+            bucket_name, object_key, use_download_cache
+        ) as raw_file, open_decompressed(
+            raw_file, detect_compression(object_key)
+        ) as csv_file:
+            # cached (uncompressed) copies are on disk, so those get memory-mapped
+            df = pd.read_csv(csv_file, memory_map=is_local_file(csv_file))
 
         print(f"Data ({table_name}) downloaded successfully")
         # data = pd.read_csv(download_path)
 
         return df
+
+    @staticmethod
+    def retrieve_data_batches_from_s3(
+        table_name: str,
+        batch_rows: int,
+        use_download_cache: bool = DOWNLOAD_CACHE_ENABLED,
+    ) -> Iterator[pd.DataFrame]:
+        """Same as retrieve_data_from_s3, but batch_rows rows at a time"""
+        object_key = f"raw_data/{table_name}{RAW_DATA_FILE_EXTENSION}"
+
+        # the object stays open while the batches are handed out, so the
+        # download of the next rows overlaps with whatever the caller does
+        with open_s3_object(
+            S3_BUCKET_NAME, object_key, use_download_cache
+        ) as raw_file, open_decompressed(
+            raw_file, detect_compression(object_key)
+        ) as csv_file:
+            yield from pd.read_csv(
+                csv_file, memory_map=is_local_file(csv_file), chunksize=batch_rows
+            )
+
+        print(f"Data ({table_name}) downloaded successfully")
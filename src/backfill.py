@@ -0,0 +1,103 @@
+"""
+Here we keep the bits for backfilling: instead of one
+pod per hour (which is what catchup=True gives us from 2014),
+we read the raw data once, split it into the hourly intervals
+in memory and process each interval separately, remembering
+which intervals are done so a restarted backfill can resume
+"""
+
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from src.helper_functions import convert_timestamp_to_unix
+from src.state_store import StateStore
+
+SECONDS_PER_HOUR = 3600
+
+
+def compose_interval_label(interval_start_unix: float) -> str:
+    """Name an hourly interval, e.g. 20140101T00"""
+    return datetime.fromtimestamp(interval_start_unix, tz=timezone.utc).strftime(
+        "%Y%m%dT%H"
+    )
+
+
+def partition_into_hourly_intervals(
+    target_data: pd.DataFrame,
+    start_timestamp: str,
+    end_timestamp: str,
+    timestamp_column: str = "unixReviewTime",
+) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """Split the data into [start, end) hourly intervals, yield (label, data)"""
+    start_unix = convert_timestamp_to_unix(start_timestamp)
+    end_unix = convert_timestamp_to_unix(end_timestamp)
+
+    # note: the intervals are half-open, so a record falling exactly on
+    # the hour goes to the interval starting then (Airflow does the same)
+    in_range = (target_data[timestamp_column] >= start_unix) & (
+        target_data[timestamp_column] < end_unix
+    )
+    target_data = target_data[in_range]
+
+    # hour number since the start of the backfill, in one vectorized go
+    interval_numbers = (
+        (target_data[timestamp_column] - start_unix) // SECONDS_PER_HOUR
+    ).astype("int64")
+
+    records_per_interval = dict(
+        list(target_data.groupby(interval_numbers.to_numpy(), sort=True))
+    )
+
+    number_of_intervals = int(-(-(end_unix - start_unix) // SECONDS_PER_HOUR))
+
+    for interval_number in range(number_of_intervals):
+        interval_label = compose_interval_label(
+            start_unix + interval_number * SECONDS_PER_HOUR
+        )
+        interval_data = records_per_interval.get(interval_number, target_data.iloc[0:0])
+
+        yield interval_label, interval_data.reset_index(drop=True)
+
+
+class BackfillProgress:
+    def __init__(
+        self,
+        dataset_name: str,
+        start_timestamp: str,
+        end_timestamp: str,
+        shard_label: Optional[str] = None,
+    ):
+        """Keep track of the finished intervals of one backfill (shard)"""
+        self.store = StateStore("backfill")
+        self.state_name = "{}_{}_{}{}.json".format(
+            dataset_name,
+            compose_interval_label(convert_timestamp_to_unix(start_timestamp)),
+            compose_interval_label(convert_timestamp_to_unix(end_timestamp)),
+            "" if shard_label is None else f"_{shard_label}",
+        )
+
+        state = self.store.read_json(
+            self.state_name, default={"completed_intervals": []}
+        )
+        self.completed_intervals: List[str] = state["completed_intervals"]
+        self._completed_lookup = set(self.completed_intervals)
+
+    def is_completed(self, interval_label: str) -> bool:
+        return interval_label in self._completed_lookup
+
+    def mark_completed(self, interval_label: str, save: bool = True) -> None:
+        """Record an interval as done"""
+        # empty intervals are the vast majority (review times are at
+        # day granularity), so those get saved in bulk with the next save
+        self.completed_intervals.append(interval_label)
+        self._completed_lookup.add(interval_label)
+
+        if save:
+            self.save()
+
+    def save(self) -> None:
+        self.store.write_json(
+            self.state_name, {"completed_intervals": self.completed_intervals}
+        )
@@ -0,0 +1,146 @@
+"""
+Here we keep the change-data-capture (CDC) stage for the
+metadata: only a tiny part of the catalogue changes between
+runs, so instead of re-uploading every table in full, we hash
+every row, compare the hashes against the ones of the previous
+snapshot and only emit the inserted/updated/deleted rows.
+
+Note: this assumes every run sees the whole catalogue (like
+the raw metadata file on S3); a product missing from a run is
+treated as deleted
+"""
+
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from src.extract import import_change_data_capture_schemas
+from src.state_store import StateStore
+
+CHANGE_DATA_CAPTURE_SCHEMAS = import_change_data_capture_schemas()
+
+
+def compute_row_hashes(target_df: pd.DataFrame, key_columns: List[str]) -> pd.Series:
+    """Hash the non-key columns of every row (stable across runs)"""
+    value_columns = [
+        column_name
+        for column_name in target_df.columns
+        if column_name not in key_columns
+    ]
+
+    if not value_columns:
+        # bridge tables are all key: rows can come and go, but not change
+        return pd.Series(0, index=target_df.index, dtype="uint64")
+
+    # hash_pandas_object uses a fixed hash key, so the same row gives
+    # the same hash in every run/process (unlike Python's hash())
+    return pd.util.hash_pandas_object(target_df[value_columns], index=False)
+
+
+def compute_changes(
+    target_df: pd.DataFrame,
+    key_columns: List[str],
+    previous_hash_index: Optional[pd.DataFrame],
+) -> tuple:
+    """Compare a table with the previous snapshot -> (changes, new hash index)"""
+    # a key that shows up twice would make the comparison ambiguous
+    target_df = target_df.drop_duplicates(subset=key_columns)
+
+    # nullable UInt64 so the outer merge below doesn't turn the hashes
+    # into floats (which would lose bits and hide some updates)
+    hash_index = target_df[key_columns].copy()
+    hash_index["row_hash"] = pd.array(
+        compute_row_hashes(target_df, key_columns).to_numpy(), dtype="UInt64"
+    )
+
+    if previous_hash_index is None:
+        # first run: everything is new
+        changes = target_df.copy()
+        changes["change_type"] = "insert"
+        return changes, hash_index
+
+    previous_hash_index = previous_hash_index.astype({"row_hash": "UInt64"})
+
+    compared = hash_index.merge(
+        previous_hash_index,
+        on=key_columns,
+        how="outer",
+        suffixes=("", "_previous"),
+        indicator=True,
+    )
+
+    is_inserted = compared["_merge"] == "left_only"
+    is_updated = (compared["_merge"] == "both") & (
+        compared["row_hash"] != compared["row_hash_previous"]
+    ).fillna(False)
+    is_deleted = compared["_merge"] == "right_only"
+
+    # inserted + updated rows go out in full...
+    change_types = pd.Series("unchanged", index=compared.index)
+    change_types[is_inserted] = "insert"
+    change_types[is_updated] = "update"
+    changed_keys = compared.loc[is_inserted | is_updated, key_columns].assign(
+        change_type=change_types[is_inserted | is_updated]
+    )
+    changes = target_df.merge(changed_keys, on=key_columns, how="inner")
+
+    # ...deleted ones only with their keys
+    deleted_rows = compared.loc[is_deleted, key_columns].assign(change_type="delete")
+    changes = pd.concat([changes, deleted_rows], axis=0, ignore_index=True)
+
+    return changes, hash_index
+
+
+class ChangeDataCapture:
+    def __init__(self):
+        """Keep the hash indexes of the previous snapshot in the state store"""
+        self.store = StateStore("change_data_capture")
+        self.new_hash_indexes = {}
+
+    def _load_hash_index(self, table_name: str) -> Optional[pd.DataFrame]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "hash_index.parquet")
+            if not self.store.download_file(f"{table_name}.parquet", file_path):
+                return None
+
+            return pd.read_parquet(file_path)
+
+    def capture_changes(
+        self, processed_tables: Dict[str, pd.DataFrame]
+    ) -> Dict[str, pd.DataFrame]:
+        """Swap every CDC table for its delta table (<table>_changes)"""
+        tables_to_load = {}
+
+        for table_name, table_data in processed_tables.items():
+            if table_name not in CHANGE_DATA_CAPTURE_SCHEMAS:
+                tables_to_load[table_name] = table_data
+                continue
+
+            changes, self.new_hash_indexes[table_name] = compute_changes(
+                table_data,
+                CHANGE_DATA_CAPTURE_SCHEMAS[table_name],
+                self._load_hash_index(table_name),
+            )
+            tables_to_load[f"{table_name}_changes"] = changes
+
+            change_counts = changes["change_type"].value_counts()
+            print(
+                "Changes in {}: {} inserted, {} updated, {} deleted".format(
+                    table_name,
+                    change_counts.get("insert", 0),
+                    change_counts.get("update", 0),
+                    change_counts.get("delete", 0),
+                )
+            )
+
+        return tables_to_load
+
+    def commit(self) -> None:
+        """Save the new snapshot's hash indexes (only once loaded!)"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for table_name, hash_index in self.new_hash_indexes.items():
+                file_path = os.path.join(temp_dir, f"{table_name}.parquet")
+                hash_index.to_parquet(file_path, index=False)
+                self.store.upload_file(f"{table_name}.parquet", file_path)
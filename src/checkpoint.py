@@ -0,0 +1,203 @@
+"""
+Here we keep the stage checkpoints: the DAG retries a task
+up to 3 times, and without these every retry downloads and
+transforms everything again even if only the last upload failed.
+We save the raw extract and the transformed tables (as Parquet)
+keyed by the interval + a hash of the input, and remember
+which tables were already loaded.
+
+All of it sits under a key of what the run reads (the source's
+ETag/mtime, the sample fraction, the tables, ...), so a run with
+other data or options never picks up another run's checkpoints;
+those (and ones past their age) are dropped instead
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.backfill import compose_interval_label
+from src.constants import CHECKPOINT_MAX_AGE_HOURS
+from src.helper_functions import convert_timestamp_to_unix
+from src.state_store import StateStore
+
+
+def compose_interval_key(
+    start_timestamp: Optional[str], end_timestamp: Optional[str]
+) -> str:
+    """Name the interval a run covers, e.g. 20140101T00_20140101T01"""
+    return "_".join(
+        (
+            compose_interval_label(convert_timestamp_to_unix(timestamp))
+            if timestamp is not None
+            else "open"
+        )
+        for timestamp in (start_timestamp, end_timestamp)
+    )
+
+
+def compute_content_hash(target_data: pd.DataFrame) -> str:
+    """Hash a dataframe's content (column names + values)"""
+    # hash_pandas_object hashes each row vectorized, so this
+    # is much cheaper than serialising the whole frame
+    row_hashes = pd.util.hash_pandas_object(target_data, index=False).to_numpy()
+
+    content_hash = hashlib.sha256(",".join(target_data.columns).encode("utf-8"))
+    content_hash.update(row_hashes.tobytes())
+
+    return content_hash.hexdigest()
+
+
+def compute_run_key(run_identity: dict) -> str:
+    """Short hash of what a run reads, e.g. the source ETag + options"""
+    return hashlib.sha256(
+        json.dumps(run_identity, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+def restore_missing_values(target_data: pd.DataFrame) -> pd.DataFrame:
+    """Parquet gives back None for missing strings, the CSVs gave NaN"""
+    # the transforms check for NaN (e.g. str(value) != "nan"), so we
+    # put NaN back to get exactly the same results as from the CSVs
+    for column_name in target_data.columns:
+        if target_data[column_name].dtype == object:
+            target_data[column_name] = target_data[column_name].where(
+                target_data[column_name].notna(), np.nan
+            )
+
+    return target_data
+
+
+class PipelineCheckpoint:
+    def __init__(
+        self,
+        dataset_name: str,
+        start_timestamp: Optional[str],
+        end_timestamp: Optional[str],
+        shard_label: Optional[str] = None,
+        run_identity: Optional[dict] = None,
+    ):
+        """Checkpoints of one dataset for one interval (+ shard) and input"""
+        self.store = StateStore("checkpoints")
+        # shards of the same interval run at the same time, so each has its own
+        run_prefix = (
+            f"{dataset_name}/{compose_interval_key(start_timestamp, end_timestamp)}"
+            f"/{shard_label or 'unsharded'}/"
+        )
+        self.prefix = run_prefix + compute_run_key(run_identity or {})
+
+        self.drop_stale_checkpoints(run_prefix)
+
+        run_state = self.store.read_json(
+            f"{self.prefix}/run.json",
+            default={
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "run_identity": run_identity,
+                "loaded_tables": [],
+            },
+        )
+        self.created_at = run_state["created_at"]
+        self.run_identity = run_state["run_identity"]
+        self.loaded_tables = run_state["loaded_tables"]
+
+    def drop_stale_checkpoints(self, run_prefix: str) -> None:
+        """Delete the checkpoints of other inputs/options, or too old ones"""
+        stale_prefixes = {
+            run_prefix + name[len(run_prefix) :].split("/")[0] + "/"
+            for name in self.store.list_names(run_prefix)
+            if not name.startswith(f"{self.prefix}/")
+        }
+
+        run_state = self.store.read_json(f"{self.prefix}/run.json")
+        if run_state is not None:
+            created_at = datetime.fromisoformat(run_state["created_at"])
+            if datetime.now(timezone.utc) - created_at > timedelta(
+                hours=CHECKPOINT_MAX_AGE_HOURS
+            ):
+                stale_prefixes.add(f"{self.prefix}/")
+
+        for stale_prefix in sorted(stale_prefixes):
+            print(f"Dropping stale checkpoint: {stale_prefix}")
+            self.store.delete(stale_prefix)
+
+    def _save_run_state(self) -> None:
+        self.store.write_json(
+            f"{self.prefix}/run.json",
+            {
+                "created_at": self.created_at,
+                "run_identity": self.run_identity,
+                "loaded_tables": self.loaded_tables,
+            },
+        )
+
+    def _save_dataframe(self, name: str, target_data: pd.DataFrame) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "data.parquet")
+            # keep the index, it ends up in the uploaded CSVs
+            target_data.to_parquet(file_path)
+            self.store.upload_file(f"{self.prefix}/{name}", file_path)
+
+    def _load_dataframe(self, name: str) -> Optional[pd.DataFrame]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "data.parquet")
+            if not self.store.download_file(f"{self.prefix}/{name}", file_path):
+                return None
+
+            return restore_missing_values(pd.read_parquet(file_path))
+
+    def load_raw_extract(self) -> Optional[pd.DataFrame]:
+        """Get the raw data saved by a previous attempt, if any"""
+        raw_data = self._load_dataframe("raw_extract.parquet")
+
+        if raw_data is not None:
+            print(f"Resuming from checkpoint: {self.prefix}/raw_extract")
+
+        return raw_data
+
+    def save_raw_extract(self, raw_data: pd.DataFrame) -> None:
+        self._save_dataframe("raw_extract.parquet", raw_data)
+        self._save_run_state()
+
+    def load_transformed_tables(
+        self, input_hash: str
+    ) -> Optional[Dict[str, pd.DataFrame]]:
+        """Get the tables transformed from this exact input, if any"""
+        # the table list is written last, so if it's there all tables are too
+        table_list = self.store.read_json(f"{self.prefix}/{input_hash}/tables.json")
+
+        if table_list is None:
+            return None
+
+        print(f"Resuming from checkpoint: {self.prefix}/{input_hash}")
+
+        return {
+            table_name: self._load_dataframe(f"{input_hash}/{table_name}.parquet")
+            for table_name in table_list["tables"]
+        }
+
+    def save_transformed_tables(
+        self, input_hash: str, tables: Dict[str, pd.DataFrame]
+    ) -> None:
+        for table_name, table_data in tables.items():
+            self._save_dataframe(f"{input_hash}/{table_name}.parquet", table_data)
+
+        self.store.write_json(
+            f"{self.prefix}/{input_hash}/tables.json", {"tables": list(tables)}
+        )
+
+    def is_loaded(self, table_name: str) -> bool:
+        return table_name in self.loaded_tables
+
+    def mark_loaded(self, table_name: str) -> None:
+        self.loaded_tables.append(table_name)
+        self._save_run_state()
+
+    def clear(self) -> None:
+        """Everything went through, so the checkpoints can go"""
+        self.store.delete(f"{self.prefix}/")
@@ -0,0 +1,151 @@
+"""
+Here we keep the bits for reading compressed raw files
+(gzip or zstd), both from the local folder and from S3.
+The decompression runs in its own thread and hands blocks
+to the CSV parser through a small queue, so downloading,
+decompressing and parsing all happen at the same time and
+the decompressed file never has to exist in full
+"""
+
+import gzip
+import io
+import queue
+import threading
+import zlib
+from typing import BinaryIO, Optional
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst files
+    zstandard = None
+
+
+DECOMPRESSED_BLOCK_SIZE = 4 * 1024**2
+
+
+class UnsupportedCompression(Exception):
+    pass
+
+
+def detect_compression(file_name: str) -> Optional[str]:
+    """Get the compression from the file extension (None = plain)"""
+    if file_name.endswith(".gz"):
+        return "gzip"
+    elif file_name.endswith(".zst"):
+        return "zstd"
+
+    return None
+
+
+def open_decompressing_stream(raw_file: BinaryIO, compression: str) -> BinaryIO:
+    """Wrap a compressed binary file into a decompressing one"""
+    if compression == "gzip":
+        # also reads multi-member files, e.g. the ones pigz/bgzip write
+        return gzip.GzipFile(fileobj=raw_file, mode="rb")
+
+    elif compression == "zstd":
+        if zstandard is None:
+            raise UnsupportedCompression("Reading .zst files needs zstandard")
+
+        # read_across_frames: files written in parallel have many frames
+        return zstandard.ZstdDecompressor().stream_reader(
+            raw_file, read_across_frames=True
+        )
+
+    raise UnsupportedCompression(f"Unknown compression: {compression}")
+
+
+def decompress_head(compressed_head: bytes, compression: Optional[str]) -> bytes:
+    """Decompress as much as possible of the first bytes of a file"""
+    if compression is None:
+        return compressed_head
+
+    # the streaming decompressors give back what they can without the
+    # rest of the file (the file readers above would fail on the cut)
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS).decompress(compressed_head)
+
+    elif compression == "zstd":
+        if zstandard is None:
+            raise UnsupportedCompression("Reading .zst files needs zstandard")
+
+        return zstandard.ZstdDecompressor().decompressobj().decompress(compressed_head)
+
+    raise UnsupportedCompression(f"Unknown compression: {compression}")
+
+
+class BackgroundDecompressor(io.RawIOBase):
+    def __init__(
+        self, raw_file: BinaryIO, compression: str, max_blocks_in_queue: int = 8
+    ):
+        """Decompress in a separate thread, read the result like a file"""
+        # both zlib and zstd let go of the GIL while decompressing, so
+        # this thread really runs next to the parser (and the download)
+        super().__init__()
+        self.decompressing_stream = open_decompressing_stream(raw_file, compression)
+        self.blocks = queue.Queue(maxsize=max_blocks_in_queue)
+        self.current_block = memoryview(b"")
+        self.finished = False
+        self.stop_requested = threading.Event()
+
+        self.worker = threading.Thread(target=self._decompress, daemon=True)
+        self.worker.start()
+
+    def _decompress(self) -> None:
+        try:
+            while not self.stop_requested.is_set():
+                block = self.decompressing_stream.read(DECOMPRESSED_BLOCK_SIZE)
+                self._put(block)
+                if not block:
+                    return  # an empty block marks the end
+        except Exception as error:
+            # hand the error over, so it's raised in the reading thread
+            self._put(error)
+
+    def _put(self, item) -> None:
+        # the queue is bounded: if the parser falls behind, we wait here
+        while not self.stop_requested.is_set():
+            try:
+                self.blocks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if len(self.current_block) == 0:
+            if self.finished:
+                return 0
+
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.finished = True
+                return 0
+
+            self.current_block = memoryview(block)
+
+        number_of_bytes = min(len(buffer), len(self.current_block))
+        buffer[:number_of_bytes] = self.current_block[:number_of_bytes]
+        self.current_block = self.current_block[number_of_bytes:]
+
+        return number_of_bytes
+
+    def close(self) -> None:
+        if not self.closed:
+            self.stop_requested.set()
+            self.worker.join()
+            self.decompressing_stream.close()
+
+        super().close()
+
+
+def open_decompressed(raw_file: BinaryIO, compression: Optional[str]) -> BinaryIO:
+    """Return a plain (decompressed) view of the raw file"""
+    if compression is None:
+        return raw_file
+
+    return BackgroundDecompressor(raw_file, compression)
@@ -5,10 +5,108 @@ from dotenv import dotenv_values
 path_to_creds = os.path.join("src", "credentials", ".env")
 config = dotenv_values(path_to_creds)
 
-
-BEARER_TOKEN = config["API_BEARER_TOKEN"]
-S3_ACCESS_KEY_ID = config["S3_ACCESS_KEY_ID"]
-S3_ACCESS_KEY_SECRET = config["S3_ACCESS_KEY_SECRET"]
+# .get, so the modules (+ tests) import without credentials; the API/S3
+# clients still fail without them
+BEARER_TOKEN = config.get("API_BEARER_TOKEN")
+S3_ACCESS_KEY_ID = config.get("S3_ACCESS_KEY_ID")
+S3_ACCESS_KEY_SECRET = config.get("S3_ACCESS_KEY_SECRET")
 S3_BUCKET_NAME = "luca-mircea-takeaway-challenge"
 
+# lets us point the S3 client at a local stand-in (e.g. MinIO/moto) for testing
+S3_ENDPOINT_URL = config.get("S3_ENDPOINT_URL") or None
+
 BASE_URL = "https://api.endpoint.com/"
+
+# pipeline state (backfill progress, checkpoints, indexes, etc.) lives
+# either on the local disk ("local") or in the bucket ("s3"); on Kubernetes
+# it should be "s3", since every retry/run gets a fresh pod
+STATE_LOCATION = config.get("STATE_LOCATION", "s3")
+STATE_LOCAL_DIRECTORY = "pipeline_state"
+STATE_S3_PREFIX = "pipeline_state"
+
+# checkpoints older than this are dropped instead of resumed from (the
+# API source has no ETag/mtime to tell whether the data changed since)
+CHECKPOINT_MAX_AGE_HOURS = float(config.get("CHECKPOINT_MAX_AGE_HOURS", 24))
+
+# raw objects downloaded from S3 are kept on disk (keyed by their ETag),
+# so unchanged objects aren't downloaded again; oldest used get evicted first
+DOWNLOAD_CACHE_ENABLED = config.get("DOWNLOAD_CACHE_ENABLED", "true") == "true"
+DOWNLOAD_CACHE_DIRECTORY = config.get("DOWNLOAD_CACHE_DIRECTORY", "download_cache")
+DOWNLOAD_CACHE_MAX_BYTES = int(config.get("DOWNLOAD_CACHE_MAX_BYTES", 10 * 1024**3))
+
+# big raw objects are downloaded as byte ranges by several threads at once
+RANGED_DOWNLOAD_THRESHOLD_BYTES = int(
+    config.get("RANGED_DOWNLOAD_THRESHOLD_BYTES", 64 * 1024**2)
+)
+RANGE_SIZE_BYTES = int(config.get("RANGE_SIZE_BYTES", 16 * 1024**2))
+RANGED_DOWNLOAD_CONCURRENCY = int(config.get("RANGED_DOWNLOAD_CONCURRENCY", 8))
+
+# raw files can be stored compressed on S3, e.g. ".csv.gz" or ".csv.zst"
+RAW_DATA_FILE_EXTENSION = config.get("RAW_DATA_FILE_EXTENSION", ".csv")
+
+# overlapped mode: extract, transform + load run at the same time on
+# batches of rows, with at most OVERLAPPED_QUEUE_SIZE batches waiting
+# between two stages (so a slow stage holds the others back)
+OVERLAPPED_BATCH_ROWS = int(config.get("OVERLAPPED_BATCH_ROWS", 100_000))
+OVERLAPPED_TRANSFORM_WORKERS = int(
+    config.get("OVERLAPPED_TRANSFORM_WORKERS", os.cpu_count() or 2)
+)
+OVERLAPPED_QUEUE_SIZE = int(config.get("OVERLAPPED_QUEUE_SIZE", 2))
+
+# the postgres_copy target: COPY straight into a Postgres warehouse
+POSTGRES_DSN = config.get("POSTGRES_DSN")
+POSTGRES_SCHEMA = config.get("POSTGRES_SCHEMA", "public")
+POSTGRES_COPY_FORMAT = config.get("POSTGRES_COPY_FORMAT", "csv")  # or "binary"
+POSTGRES_POOL_SIZE = int(config.get("POSTGRES_POOL_SIZE", 4))
+# bigger tables are copied in parts of this many rows, in parallel
+POSTGRES_COPY_PART_ROWS = int(config.get("POSTGRES_COPY_PART_ROWS", 250_000))
+
+# deduplication/PK checks bigger than this spill to disk, hash partitioned,
+# so each partition fits (the rest of the table stays out of the hash tables)
+DEDUP_MEMORY_BUDGET_BYTES = int(config.get("DEDUP_MEMORY_BUDGET_BYTES", 1024**3))
+DEDUP_SPILL_DIRECTORY = config.get("DEDUP_SPILL_DIRECTORY") or None
+
+# sampling mode (dev runs): the raw data is read this many rows at a time,
+# keeping only the sampled products of each batch
+SAMPLE_READ_BATCH_ROWS = int(config.get("SAMPLE_READ_BATCH_ROWS", 250_000))
+
+# execution planner: picks in memory/chunked/parallel per dataset so a run
+# fits these (set them to the pod's memory limit + cores on Kubernetes)
+PLANNER_MEMORY_BUDGET_BYTES = int(
+    config.get("PLANNER_MEMORY_BUDGET_BYTES", 4 * 1024**3)
+)
+PLANNER_CPU_COUNT = int(config.get("PLANNER_CPU_COUNT", os.cpu_count() or 1))
+# how much of the file is read up front to size up the rows
+PLANNER_HEAD_BYTES = int(config.get("PLANNER_HEAD_BYTES", 1024**2))
+# how many times its own size a frame takes up while being transformed
+PLANNER_TRANSFORM_OVERHEAD = int(config.get("PLANNER_TRANSFORM_OVERHEAD", 5))
+# below this many rows, splitting the work up isn't worth the overhead
+PLANNER_PARALLEL_MIN_ROWS = int(config.get("PLANNER_PARALLEL_MIN_ROWS", 500_000))
+PLANNER_MIN_BATCH_ROWS = int(config.get("PLANNER_MIN_BATCH_ROWS", 10_000))
+
+# profiling: the --profile flag profiles a run, and PROFILING_SAMPLE_RATE
+# profiles that share of all runs (also read from the environment, so it
+# can be set per pod/DAG without touching the credentials file)
+PROFILING_SAMPLE_RATE = float(
+    os.environ.get("PROFILING_SAMPLE_RATE") or config.get("PROFILING_SAMPLE_RATE", 0)
+)
+# a local folder, or an s3://bucket/prefix
+PROFILING_OUTPUT = (
+    os.environ.get("PROFILING_OUTPUT") or config.get("PROFILING_OUTPUT") or "profiles"
+)
+PROFILING_INTERVAL_SECONDS = float(config.get("PROFILING_INTERVAL_SECONDS", 0.01))
+# tracemalloc, for the top allocations per stage, slows the transforms
+# down several times over, so it's off unless asked for
+PROFILING_TRACE_ALLOCATIONS = config.get("PROFILING_TRACE_ALLOCATIONS") == "true"
+# more frames = more useful allocation tracebacks, but more overhead
+PROFILING_TRACEMALLOC_FRAMES = int(config.get("PROFILING_TRACEMALLOC_FRAMES", 1))
+PROFILING_TOP_ALLOCATIONS = int(config.get("PROFILING_TOP_ALLOCATIONS", 15))
+
+# load verification: how many manifests are read + upload locations
+# listed at the same time (it's all waiting on S3, so threads)
+VERIFY_LISTING_CONCURRENCY = int(config.get("VERIFY_LISTING_CONCURRENCY", 32))
+
+# near-duplicates: how many state partitions are read/written at the same time
+NEAR_DUPLICATES_STATE_CONCURRENCY = int(
+    config.get("NEAR_DUPLICATES_STATE_CONCURRENCY", 16)
+)
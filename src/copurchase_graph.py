@@ -0,0 +1,161 @@
+"""
+Here we keep the co-purchase graph: the related items tables
+are long lists of (asin, asin) string pairs, so asking "what
+is bought together with X" means scanning all of them. Here
+we turn them into a compact graph instead:
+  - every asin gets an int32 id (its position in the sorted
+    asins), saved as nodes.npy
+  - per relation, CSR arrays: the neighbors of node i are
+    neighbors[offsets[i]:offsets[i + 1]]
+Everything is a plain .npy file, so it can be memory-mapped
+and a lookup is a binary search + a slice (microseconds)
+"""
+
+import os
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+# relation -> (table, source column, target column), after renaming
+GRAPH_RELATIONS = {
+    "bought_together": (
+        "product_bought_together",
+        "item_id",
+        "bought_together_with_item_id",
+    ),
+    "also_viewed": ("product_also_viewed", "item_id", "also_viewed_item_id"),
+}
+
+# what the graph is built from
+GRAPH_TABLES = ["products"] + [
+    table_name for table_name, _, _ in GRAPH_RELATIONS.values()
+]
+
+
+def build_csr(
+    source_ids: np.ndarray, target_ids: np.ndarray, number_of_nodes: int
+) -> tuple:
+    """Edges as node ids -> (offsets, neighbors), neighbors sorted per node"""
+    edges = np.unique(
+        np.stack([source_ids, target_ids], axis=1).astype("int64"), axis=0
+    )  # sorted by source, then target, and without repeated edges
+
+    offsets = np.zeros(number_of_nodes + 1, dtype="int64")
+    np.cumsum(np.bincount(edges[:, 0], minlength=number_of_nodes), out=offsets[1:])
+
+    return offsets, edges[:, 1].astype("int32")
+
+
+def write_copurchase_graph(
+    processed_tables: Dict[str, pd.DataFrame], output_directory: str
+) -> List[str]:
+    """Build the graph from the metadata tables, return the written files"""
+    # all asins: the products + anything only showing up as a related item
+    asins = [processed_tables["products"]["item_id"]]
+    for table_name, source_column, target_column in GRAPH_RELATIONS.values():
+        asins += [
+            processed_tables[table_name][source_column],
+            processed_tables[table_name][target_column],
+        ]
+
+    nodes = pd.Index(pd.concat(asins, ignore_index=True).dropna().astype(str).unique())
+    nodes = nodes.sort_values()
+
+    # fixed-width bytes, so the sorted asins can be memory-mapped too
+    node_file_path = os.path.join(output_directory, "nodes.npy")
+    np.save(node_file_path, nodes.to_numpy().astype("S"))
+    graph_files = [node_file_path]
+
+    for relation, (table_name, source_column, target_column) in GRAPH_RELATIONS.items():
+        edges = processed_tables[table_name][[source_column, target_column]].dropna()
+
+        offsets, neighbors = build_csr(
+            nodes.get_indexer(edges[source_column].astype(str)),
+            nodes.get_indexer(edges[target_column].astype(str)),
+            len(nodes),
+        )
+
+        for array_name, array in [("offsets", offsets), ("neighbors", neighbors)]:
+            file_path = os.path.join(output_directory, f"{relation}_{array_name}.npy")
+            np.save(file_path, array)
+            graph_files.append(file_path)
+
+        print(
+            f"Co-purchase graph ({relation}): {len(nodes)} items, {len(neighbors)} edges"
+        )
+
+    return graph_files
+
+
+class CopurchaseGraph:
+    def __init__(self, graph_directory: str):
+        """Memory-map a (downloaded) co-purchase graph"""
+        self.nodes = np.load(os.path.join(graph_directory, "nodes.npy"), mmap_mode="r")
+        self.offsets = {}
+        self.neighbor_ids = {}
+
+        for relation in GRAPH_RELATIONS:
+            self.offsets[relation] = np.load(
+                os.path.join(graph_directory, f"{relation}_offsets.npy"), mmap_mode="r"
+            )
+            self.neighbor_ids[relation] = np.load(
+                os.path.join(graph_directory, f"{relation}_neighbors.npy"),
+                mmap_mode="r",
+            )
+
+    def node_id(self, asin: str) -> int:
+        """Id of an asin (-1 if it isn't in the graph)"""
+        encoded_asin = asin.encode("utf-8")
+        position = int(np.searchsorted(self.nodes, encoded_asin))
+
+        if position < len(self.nodes) and self.nodes[position] == encoded_asin:
+            return position
+
+        return -1
+
+    def _neighbor_ids(self, node_id: int, relation: str) -> np.ndarray:
+        if node_id < 0:
+            return np.empty(0, dtype="int32")
+
+        offsets = self.offsets[relation]
+        return self.neighbor_ids[relation][offsets[node_id] : offsets[node_id + 1]]
+
+    def neighbors(self, asin: str, relation: str = "bought_together") -> List[str]:
+        """Asins related to the given one"""
+        neighbor_ids = self._neighbor_ids(self.node_id(asin), relation)
+        return [node.decode("utf-8") for node in self.nodes[neighbor_ids]]
+
+    def degree(self, asin: str, relation: str = "bought_together") -> int:
+        """Number of asins related to the given one"""
+        node_id = self.node_id(asin)
+        if node_id < 0:
+            return 0
+
+        offsets = self.offsets[relation]
+        return int(offsets[node_id + 1] - offsets[node_id])
+
+    def two_hop_counts(self, asin: str, relation: str = "bought_together") -> pd.Series:
+        """Asins two hops away, with how many paths lead to each (most first)"""
+        node_id = self.node_id(asin)
+        offsets = self.offsets[relation]
+        first_hop = self._neighbor_ids(node_id, relation)
+
+        if len(first_hop) == 0:
+            return pd.Series(dtype="int64")
+
+        second_hop = np.concatenate(
+            [
+                self.neighbor_ids[relation][offsets[hop_id] : offsets[hop_id + 1]]
+                for hop_id in first_hop
+            ]
+        )
+        second_hop = second_hop[second_hop != node_id]
+
+        neighbor_ids, path_counts = np.unique(second_hop, return_counts=True)
+        two_hop_counts = pd.Series(
+            path_counts,
+            index=[node.decode("utf-8") for node in self.nodes[neighbor_ids]],
+        )
+
+        return two_hop_counts.sort_values(ascending=False, kind="stable")
@@ -9,13 +9,14 @@ from typing import Tuple
 
 import pandas as pd
 
+from src.external_dedup import has_duplicates_external
 from src.validate import PKNotUnique, SchemaMismatch
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
 
-def process_reviews_raw_columns(reviews: pd.DataFrame) -> pd.DataFrame:
-    """Fix the helpfulness, reviewTime, review_id columns"""
+def parse_review_dates(reviews: pd.DataFrame) -> pd.DataFrame:
+    """Fix the reviewTime column"""
     # parse the date out of the strangely formatted string
     reviews["review_date_parsed_as_int"] = [
         int(  # we like int bcs. it's more memory efficient
@@ -26,6 +27,14 @@ def process_reviews_raw_columns(reviews: pd.DataFrame) -> pd.DataFrame:
         for date_string in reviews["reviewTime"]
     ]
 
+    # technically we don't need this return since we're modifying the
+    # data in place, but this makes it easier to read and
+    # understand especially for more junior people
+    return reviews
+
+
+def parse_review_helpfulness(reviews: pd.DataFrame) -> pd.DataFrame:
+    """Fix the helpfulness column"""
     # compile helpfulness of reviews by parsing the
     # count of YES and NO from the list
     reviews["count_review_helpful_yes"] = [
@@ -38,12 +47,13 @@ def process_reviews_raw_columns(reviews: pd.DataFrame) -> pd.DataFrame:
         for review_helpfulness_list in reviews["helpful"]
     ]
 
-    # create review ID
+    return reviews
+
+
+def compose_review_ids(reviews: pd.DataFrame) -> pd.DataFrame:
+    """Create the review_id column"""
     reviews["review_id"] = reviews["asin"] + reviews["reviewerID"]
 
-    # technically we don't need this return since we're modifying the
-    # data in place, but this makes it easier to read and
-    # understand especially for more junior people
     return reviews
 
 
@@ -67,8 +77,8 @@ def process_nulls(target_data: pd.DataFrame, nulls_handling: dict) -> pd.DataFra
     """Handle NULLs according to the defined schema"""
     for column_name, handling in nulls_handling.items():
         if handling == "PK":  # if PK, we should have no dups
-            count_entries = target_data[column_name].value_counts()
-            if (count_entries != 1).any():
+            # (spills to disk for big tables, like value_counts it skips NaNs)
+            if has_duplicates_external(target_data[[column_name]].dropna()):
                 raise PKNotUnique(f"{column_name} - supposedly PK - is not unique!")
         elif handling == "DROP":  # just drop NULLS -> pointless rows
             target_data = target_data[~pd.isnull(target_data[column_name])]
@@ -167,9 +177,136 @@ def process_categories(target_df: pd.DataFrame) -> pd.DataFrame:
         )
         # yeesh, this for-loop is a bit slow...
 
+    # e.g. an empty sample: no rows, but the columns are still expected
+    if categories_procesed.empty:
+        categories_procesed = pd.DataFrame(columns=["item_id", "category"])
+
     return categories_procesed
 
 
+CATEGORY_PATH_SEPARATOR = " > "
+
+
+def compute_category_ids(category_paths: pd.Series) -> pd.Series:
+    """Integer id of each category path (the same in every run)"""
+    # hash_array has a fixed key, so no state is needed to keep ids stable
+    return pd.Series(
+        pd.util.hash_array(category_paths.to_numpy(dtype=object)).view("int64"),
+        index=category_paths.index,
+    )
+
+
+def process_category_tree(
+    target_df: pd.DataFrame,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Turn the category paths into a tree, its closure + a leaf bridge"""
+    # every item has a list of paths, e.g. [['Electronics', 'Phones', 'Cases']]
+    item_paths = pd.DataFrame(
+        {
+            "item_id": target_df["asin"].to_numpy(),
+            "path": [
+                (
+                    ast.literal_eval(str(category_lists_string))
+                    if str(category_lists_string) != "nan"
+                    else []
+                )
+                for category_lists_string in target_df["categories"]
+            ],
+        }
+    ).explode("path")
+    # (a boolean Series, since an empty list would select columns instead)
+    item_paths = item_paths[
+        pd.Series(
+            [isinstance(path, list) and len(path) > 0 for path in item_paths["path"]],
+            index=item_paths.index,
+            dtype=bool,
+        )
+    ]
+
+    # the tree: one node per path prefix, i.e. per level of each path (there
+    # are only a few thousand distinct paths, so a loop over them is fine)
+    nodes = {}
+    for path in {tuple(path) for path in item_paths["path"]}:
+        for level in range(1, len(path) + 1):
+            nodes[CATEGORY_PATH_SEPARATOR.join(path[:level])] = {
+                "category_name": path[level - 1],
+                "parent_category_path": CATEGORY_PATH_SEPARATOR.join(path[: level - 1]),
+                "category_level": level,
+            }
+
+    category_tree = pd.DataFrame.from_dict(
+        nodes,
+        orient="index",
+        columns=["category_name", "parent_category_path", "category_level"],
+    )
+    category_tree.index.name = "category_path"
+    category_tree = category_tree.reset_index().sort_values(
+        "category_path", ignore_index=True
+    )
+    category_tree.insert(
+        0, "category_id", compute_category_ids(category_tree["category_path"])
+    )
+    category_tree.insert(
+        1,
+        "parent_category_id",
+        # top level categories have no parent (nullable, to keep the ids exact)
+        compute_category_ids(category_tree["parent_category_path"])
+        .astype("Int64")
+        .where(category_tree["category_level"] > 1),
+    )
+    category_tree = category_tree[
+        [
+            "category_id",
+            "parent_category_id",
+            "category_name",
+            "category_path",
+            "category_level",
+        ]
+    ]
+
+    # the closure: every (ancestor, descendant) pair, incl. the node itself,
+    # so rolling up to any level is a single join instead of a recursion
+    category_closure = pd.DataFrame(
+        [
+            {
+                "ancestor_category_path": CATEGORY_PATH_SEPARATOR.join(
+                    category_path.split(CATEGORY_PATH_SEPARATOR)[:ancestor_level]
+                ),
+                "descendant_category_id": category_id,
+                "distance": category_level - ancestor_level,
+            }
+            for category_id, category_path, category_level in zip(
+                category_tree["category_id"],
+                category_tree["category_path"],
+                category_tree["category_level"],
+            )
+            for ancestor_level in range(1, category_level + 1)
+        ],
+        columns=["ancestor_category_path", "descendant_category_id", "distance"],
+    )
+    category_closure.insert(
+        0,
+        "ancestor_category_id",
+        compute_category_ids(category_closure["ancestor_category_path"]),
+    )
+    category_closure.drop(columns="ancestor_category_path", inplace=True)
+
+    # the bridge: items only point at their leaves (the closure does the rest)
+    product_category_leaves = pd.DataFrame(
+        {
+            "item_id": item_paths["item_id"].to_numpy(),
+            "category_id": compute_category_ids(
+                pd.Series(
+                    [CATEGORY_PATH_SEPARATOR.join(path) for path in item_paths["path"]],
+                    dtype=object,
+                )
+            ).to_numpy(),
+        }
+    ).drop_duplicates()
+
+    return category_tree, category_closure, product_category_leaves
+
+
 def process_related_items(target_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Flatten the related items into two tables"""
     # first create a list of items bought together
@@ -230,4 +367,11 @@ def process_related_items(target_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Dat
                 [also_viewed, mini_viewed], axis=0, ignore_index=True
             )
 
+    # e.g. in a small sample none of the products might have links left,
+    # but the (empty) tables still need their columns for the rest
+    if bought_together.empty:
+        bought_together = pd.DataFrame(columns=["item_id", "bought_together"])
+    if also_viewed.empty:
+        also_viewed = pd.DataFrame(columns=["item_id", "also_viewed"])
+
     return bought_together, also_viewed
@@ -0,0 +1,199 @@
+"""
+Here we keep the row-level data quality checks: instead of
+failing the whole batch on the first bad row (e.g. one
+duplicated PK in process_nulls), every row is checked against
+the rules in data_quality_schemas.yml, the rows that break any
+of them go to a quarantine table (with the reason why), and
+the clean rows carry on. Only if too many rows are bad do we
+stop the batch altogether.
+
+For very big inputs there's also a profiling mode, which runs
+the same checks on a sample and only reports the results
+"""
+
+import ast
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.extract import import_data_quality_schemas
+
+DATA_QUALITY_SCHEMAS = import_data_quality_schemas()
+
+PROFILE_SAMPLE_ROWS = 100_000
+
+LITERAL_TYPES = {"list": list, "dict": dict}
+
+
+class DataQualityThresholdExceeded(Exception):
+    pass
+
+
+def resolve_bound(bound):
+    """Turn a min/max from the schema into a number"""
+    if bound == "now":
+        return time.time()
+
+    return bound
+
+
+def is_literal_of_type(value: str, literal_type: str) -> bool:
+    """Whether ast.literal_eval turns the string into the given type"""
+    try:
+        return isinstance(ast.literal_eval(value), LITERAL_TYPES[literal_type])
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return False
+
+
+def check_column(values: pd.Series, column_rules: dict) -> Dict[str, np.ndarray]:
+    """Run all the checks of one column -> {check: mask of violating rows}"""
+    violations = {}
+    is_null = values.isna().to_numpy()
+
+    if column_rules.get("required"):
+        violations["missing"] = is_null
+
+    if any(rule in column_rules for rule in ("type", "min", "max")):
+        numbers = pd.to_numeric(values, errors="coerce")
+
+        if "type" in column_rules:
+            violations["not_numeric"] = numbers.isna().to_numpy() & ~is_null
+
+            if column_rules["type"] == "integer":
+                violations["not_integer"] = (numbers % 1 != 0).to_numpy() & (
+                    numbers.notna().to_numpy()
+                )
+
+        # NaN compares as False, so the nulls don't count here
+        if "min" in column_rules:
+            violations["below_minimum"] = (
+                numbers < resolve_bound(column_rules["min"])
+            ).to_numpy()
+        if "max" in column_rules:
+            violations["above_maximum"] = (
+                numbers > resolve_bound(column_rules["max"])
+            ).to_numpy()
+
+    if "literal" in column_rules:
+        # parsing is per value, but there are usually lots of repeats
+        # (e.g. the categories), so every distinct value is parsed once
+        value_strings = values.astype(str)
+        parseable_values = [
+            value_string
+            for value_string in pd.unique(value_strings[~is_null])
+            if is_literal_of_type(value_string, column_rules["literal"])
+        ]
+        violations["not_parseable"] = ~is_null & ~(
+            value_strings.isin(parseable_values).to_numpy()
+        )
+
+    if "pattern" in column_rules:
+        violations["pattern_mismatch"] = ~is_null & ~(
+            values.astype(str).str.match(column_rules["pattern"]).to_numpy(dtype=bool)
+        )
+
+    return violations
+
+
+def find_violations(target_data: pd.DataFrame, dataset_name: str) -> pd.DataFrame:
+    """Check every row -> one column per reason code (True = violated)"""
+    data_quality_schema = DATA_QUALITY_SCHEMAS[dataset_name]
+    violations = {}
+
+    for column_name, column_rules in data_quality_schema["columns"].items():
+        for check_name, is_violated in check_column(
+            target_data[column_name], column_rules
+        ).items():
+            violations[f"{column_name}:{check_name}"] = is_violated
+
+    # later copies of a PK are the ones that go, the first one stays
+    violations["primary_key:duplicate"] = target_data.duplicated(
+        subset=data_quality_schema["primary_key"], keep="first"
+    ).to_numpy()
+
+    return pd.DataFrame(violations, index=target_data.index)
+
+
+def apply_data_quality_rules(
+    target_data: pd.DataFrame, dataset_name: str
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Split the data into (clean rows, quarantined rows + their reasons)"""
+    violations = find_violations(target_data, dataset_name)
+    is_quarantined = violations.any(axis=1).to_numpy()
+
+    # all the reasons of a row, e.g. "overall:above_maximum,helpful:missing"
+    quarantine_reasons = np.full(len(target_data), "", dtype=object)
+    for reason_code in violations.columns:
+        is_violated = violations[reason_code].to_numpy()
+        quarantine_reasons[is_violated] = quarantine_reasons[is_violated] + (
+            "," + reason_code
+        )
+
+    quarantine = target_data[is_quarantined].copy()
+    quarantine["quarantine_reason"] = [
+        reasons[1:] for reasons in quarantine_reasons[is_quarantined]
+    ]
+
+    reason_counts = violations.sum()
+    for reason_code, count in reason_counts[reason_counts > 0].items():
+        print(f"Quarantined ({dataset_name}): {count} rows for {reason_code}")
+
+    quarantined_fraction = is_quarantined.mean() if len(target_data) else 0.0
+    max_quarantined_fraction = DATA_QUALITY_SCHEMAS[dataset_name][
+        "max_quarantined_fraction"
+    ]
+    if quarantined_fraction > max_quarantined_fraction:
+        raise DataQualityThresholdExceeded(
+            f"{quarantined_fraction:.1%} of the {dataset_name} rows failed the "
+            f"data quality checks (max. {max_quarantined_fraction:.1%})"
+        )
+
+    return target_data[~is_quarantined], quarantine
+
+
+def profile_data_quality(
+    target_data: pd.DataFrame,
+    dataset_name: str,
+    sample_rows: int = PROFILE_SAMPLE_ROWS,
+) -> pd.DataFrame:
+    """Estimate the data quality from a sample (no rows are removed)"""
+    # fixed random_state, so reruns of the same batch give the same profile
+    sample = (
+        target_data.sample(n=sample_rows, random_state=0)
+        if len(target_data) > sample_rows
+        else target_data
+    )
+
+    profile = [
+        ("*", "total_rows", len(target_data)),
+        ("*", "sampled_rows", len(sample)),
+    ]
+    for column_name in sample.columns:
+        profile += [
+            (column_name, "null_fraction", sample[column_name].isna().mean()),
+            (column_name, "distinct_values_in_sample", sample[column_name].nunique()),
+        ]
+
+    violations = find_violations(sample, dataset_name)
+    violated_fraction = violations.any(axis=1).mean() if len(sample) else 0.0
+    for reason_code, fraction in violations.mean().items():
+        column_name, check_name = reason_code.split(":")
+        profile.append((column_name, f"{check_name}_fraction", fraction))
+    profile.append(("*", "violated_fraction", violated_fraction))
+
+    max_quarantined_fraction = DATA_QUALITY_SCHEMAS[dataset_name][
+        "max_quarantined_fraction"
+    ]
+    print(
+        f"Data quality profile ({dataset_name}): ~{violated_fraction:.1%} of the "
+        f"rows break a rule (based on {len(sample)} rows)"
+    )
+    if violated_fraction > max_quarantined_fraction:
+        print(
+            f"Warning: that's above the {max_quarantined_fraction:.1%} at which "
+            "the quarantine mode would stop the batch"
+        )
+
+    return pd.DataFrame(profile, columns=["column_name", "metric", "value"])
@@ -0,0 +1,129 @@
+"""
+Here we keep the on-disk cache for raw objects from S3.
+Every object is stored under its bucket + key + ETag, so
+a HEAD request is enough to know whether the local copy is
+still good; if so, we skip the download altogether (the
+metadata barely ever changes). The cache is size-bounded
+and evicts the least recently used files first
+"""
+
+import hashlib
+import os
+import threading
+from typing import BinaryIO, Optional, Tuple
+
+from src.constants import DOWNLOAD_CACHE_DIRECTORY, DOWNLOAD_CACHE_MAX_BYTES
+from src.helper_functions import get_s3_client
+
+# the reviews + metadata pipelines can share the cache from two threads
+CACHE_LOCK = threading.Lock()
+
+
+class S3DownloadCache:
+    def __init__(
+        self,
+        cache_directory: str = DOWNLOAD_CACHE_DIRECTORY,
+        max_size_bytes: int = DOWNLOAD_CACHE_MAX_BYTES,
+        s3_client=None,
+    ):
+        """Save where the cache lives, how big it can get + the client"""
+        self.cache_directory = cache_directory
+        self.max_size_bytes = max_size_bytes
+        self.s3_client = s3_client if s3_client is not None else get_s3_client()
+
+    def _object_prefix(self, bucket: str, key: str) -> str:
+        # keys have slashes etc., so we name the files after a hash instead
+        return hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+
+    def _cache_file_path(self, bucket: str, key: str, etag: str) -> str:
+        file_name = self._object_prefix(bucket, key) + "_" + etag.strip('"')
+        return os.path.join(self.cache_directory, file_name)
+
+    def lookup(self, bucket: str, key: str) -> Tuple[str, int, Optional[str]]:
+        """HEAD the object, return (etag, size, cached path or None)"""
+        object_head = self.s3_client.head_object(Bucket=bucket, Key=key)
+        etag = object_head["ETag"]
+        cache_file_path = self._cache_file_path(bucket, key, etag)
+
+        if not os.path.exists(cache_file_path):
+            return etag, object_head["ContentLength"], None
+
+        return etag, object_head["ContentLength"], cache_file_path
+
+    def open_cached(self, cache_file_path: str) -> BinaryIO:
+        """Open a cached file and mark it as recently used"""
+        with CACHE_LOCK:
+            # opened under the lock so eviction can't remove it in between
+            # (once open, it stays readable even if it gets evicted later)
+            os.utime(cache_file_path)
+            return open(cache_file_path, "rb")
+
+    def download(self, bucket: str, key: str) -> BinaryIO:
+        """Download (or reuse) the object, return the opened local copy"""
+        etag, _, cache_file_path = self.lookup(bucket, key)
+
+        if cache_file_path is not None:
+            print(f"Using cached copy of s3://{bucket}/{key}")
+            return self.open_cached(cache_file_path)
+
+        return self.fetch(bucket, key, etag)
+
+    def fetch(self, bucket: str, key: str, etag: str) -> BinaryIO:
+        """Download the given version into the cache, return it opened"""
+        # IfMatch makes sure we get the version we HEAD-ed and not one
+        # uploaded in between (that would be stored under the wrong ETag)
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+        partial_file_path = self.compose_partial_file_path(bucket, key, etag)
+        with open(partial_file_path, "wb") as partial_file:
+            for data_chunk in response["Body"].iter_chunks(chunk_size=8 * 1024**2):
+                partial_file.write(data_chunk)
+
+        return self.add(bucket, key, etag, partial_file_path)
+
+    def compose_partial_file_path(self, bucket: str, key: str, etag: str) -> str:
+        """Where to write a download in progress (one per thread)"""
+        os.makedirs(self.cache_directory, exist_ok=True)
+        cache_file_path = self._cache_file_path(bucket, key, etag)
+        return f"{cache_file_path}.{threading.get_ident()}.partial"
+
+    def add(self, bucket: str, key: str, etag: str, downloaded_path: str) -> BinaryIO:
+        """Move a finished download into the cache, return it opened"""
+        cache_file_path = self._cache_file_path(bucket, key, etag)
+
+        with CACHE_LOCK:
+            os.replace(downloaded_path, cache_file_path)
+
+            # older versions of the same object are no use anymore
+            object_prefix = self._object_prefix(bucket, key)
+            for file_name in os.listdir(self.cache_directory):
+                file_path = os.path.join(self.cache_directory, file_name)
+                if (
+                    file_name.startswith(object_prefix)
+                    and not file_name.endswith(".partial")
+                    and file_path != cache_file_path
+                ):
+                    os.remove(file_path)
+
+            self._evict(keep=cache_file_path)
+
+            return open(cache_file_path, "rb")
+
+    def _evict(self, keep: str) -> None:
+        """Drop least recently used files until we're under the size limit"""
+        cached_files = [
+            os.path.join(self.cache_directory, file_name)
+            for file_name in os.listdir(self.cache_directory)
+            if not file_name.endswith(".partial")
+        ]
+        cached_files.sort(key=os.path.getmtime)  # oldest first
+
+        total_size = sum(os.path.getsize(file_path) for file_path in cached_files)
+
+        for file_path in cached_files:
+            if total_size <= self.max_size_bytes:
+                break
+            if file_path == keep:
+                continue  # a single object bigger than the cache still works
+
+            total_size -= os.path.getsize(file_path)
+            os.remove(file_path)
@@ -0,0 +1,314 @@
+"""
+Here we keep the execution planner: every run used to load
+the whole dataset into pandas, whether it's a tiny hourly
+interval or a backfill that doesn't fit in the pod. Before
+the pipeline starts, the planner looks at the source (object
+size + the first bytes of the file, for the row width and
+compression) and picks one of:
+  - in_memory: the usual way, when it fits and isn't worth splitting
+  - chunked: the overlapped mode with one transform worker
+  - parallel: the overlapped mode with several transform workers
+plus the batch size, so the batches in flight fit the memory budget
+"""
+
+import io
+import math
+import os
+from typing import List, Optional
+
+import pandas as pd
+
+from src.api_interactor import APIInteractor
+from src.compression import decompress_head, detect_compression
+from src.constants import (
+    OVERLAPPED_QUEUE_SIZE,
+    PLANNER_CPU_COUNT,
+    PLANNER_HEAD_BYTES,
+    PLANNER_MEMORY_BUDGET_BYTES,
+    PLANNER_MIN_BATCH_ROWS,
+    PLANNER_PARALLEL_MIN_ROWS,
+    PLANNER_TRANSFORM_OVERHEAD,
+    RAW_DATA_FILE_EXTENSION,
+    S3_BUCKET_NAME,
+)
+from src.helper_functions import get_s3_client
+
+# how many times we try to cut the head before a row that's complete
+# (a review text can have line breaks in it)
+HEAD_CUT_ATTEMPTS = 20
+
+
+def read_source_head(dataset_name: str, retrieve_from: str) -> Optional[dict]:
+    """Size, compression + first bytes of the raw data (None if unknown)"""
+    if retrieve_from == "local":
+        csv_paths = APIInteractor.list_csv_files(dataset_name)
+        if not csv_paths:
+            return None
+
+        with open(csv_paths[0], "rb") as raw_file:
+            head = raw_file.read(PLANNER_HEAD_BYTES)
+
+        return {
+            "object_bytes": sum(os.path.getsize(path) for path in csv_paths),
+            "compression": detect_compression(csv_paths[0]),
+            "head": head,
+        }
+
+    elif retrieve_from == "s3":
+        object_key = f"raw_data/{dataset_name}{RAW_DATA_FILE_EXTENSION}"
+        s3_client = get_s3_client()
+
+        object_head = s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=object_key)
+        head = s3_client.get_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=object_key,
+            Range=f"bytes=0-{PLANNER_HEAD_BYTES - 1}",
+        )["Body"].read()
+
+        return {
+            "object_bytes": object_head["ContentLength"],
+            "compression": detect_compression(object_key),
+            "head": head,
+        }
+
+    # the API doesn't tell us how much data there is up front
+    return None
+
+
+def profile_source(dataset_name: str, retrieve_from: str) -> Optional[dict]:
+    """Estimate the rows + bytes per row of the raw data from its head"""
+    source_head = read_source_head(dataset_name, retrieve_from)
+    if source_head is None or not source_head["head"]:
+        return None
+
+    head = source_head["head"]
+    decompressed_head = decompress_head(head, source_head["compression"])
+    whole_file_read = source_head["object_bytes"] <= len(head)
+
+    # cut off the last (most likely partial) row, and if the cut lands
+    # inside a quoted text, cut at an earlier line break
+    cut_position = len(decompressed_head)
+    for _ in range(HEAD_CUT_ATTEMPTS):
+        if not whole_file_read:
+            cut_position = decompressed_head.rfind(b"\n", 0, cut_position)
+            if cut_position <= 0:
+                return None
+
+        try:
+            head_rows = pd.read_csv(
+                io.BytesIO(decompressed_head[:cut_position]), index_col=False
+            )
+            break
+        except pd.errors.ParserError:
+            if whole_file_read:
+                return None
+    else:
+        return None
+
+    if len(head_rows) == 0:
+        return None
+
+    raw_row_bytes = cut_position / len(head_rows)
+    # how much bigger the data is decompressed (1 for plain files)
+    compression_ratio = len(decompressed_head) / len(head)
+
+    return {
+        "object_bytes": source_head["object_bytes"],
+        "compression": source_head["compression"],
+        "compression_ratio": compression_ratio,
+        "estimated_rows": (
+            len(head_rows)
+            if whole_file_read
+            else int(source_head["object_bytes"] * compression_ratio / raw_row_bytes)
+        ),
+        "memory_row_bytes": head_rows.memory_usage(index=False, deep=True).sum()
+        / len(head_rows),
+    }
+
+
+def format_bytes(number_of_bytes: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if number_of_bytes < 1024:
+            return f"{number_of_bytes:.1f} {unit}"
+        number_of_bytes /= 1024
+
+    return f"{number_of_bytes:.1f} TB"
+
+
+class ExecutionPlan:
+    def __init__(
+        self,
+        dataset_name: str,
+        strategy: str,
+        batch_rows: Optional[int] = None,
+        transform_workers: int = 1,
+    ):
+        """The strategy picked for one dataset, and why"""
+        self.dataset_name = dataset_name
+        self.strategy = strategy
+        self.batch_rows = batch_rows
+        self.transform_workers = transform_workers
+        self.reasons = []
+
+    def pipeline_arguments(self) -> dict:
+        """The run_pipeline arguments that carry out the plan"""
+        if self.strategy == "in_memory":
+            return {}
+
+        return {
+            "overlapped": True,
+            "batch_rows": self.batch_rows,
+            "transform_workers": self.transform_workers,
+        }
+
+    def log(self) -> None:
+        if self.strategy == "in_memory":
+            print(f"Execution plan ({self.dataset_name}): in memory")
+        else:
+            print(
+                f"Execution plan ({self.dataset_name}): {self.strategy}, "
+                f"{self.transform_workers} transform worker(s) x "
+                f"{self.batch_rows:,} rows per batch"
+            )
+
+        for reason in self.reasons:
+            print(f"  - {reason}")
+
+
+def compute_batch_rows(
+    memory_row_bytes: float, transform_workers: int, memory_budget_bytes: int
+) -> int:
+    """The biggest batch for which all the batches in flight fit the budget"""
+    # two bounded queues, the batch being extracted + the one being
+    # loaded, and the ones being transformed (each several times over)
+    batches_in_memory = (
+        2 * OVERLAPPED_QUEUE_SIZE + 2 + transform_workers * PLANNER_TRANSFORM_OVERHEAD
+    )
+
+    return int(memory_budget_bytes / (memory_row_bytes * batches_in_memory))
+
+
+def plan_execution(
+    dataset_name: str,
+    retrieve_from: str,
+    memory_budget_bytes: int = PLANNER_MEMORY_BUDGET_BYTES,
+    cpu_count: int = PLANNER_CPU_COUNT,
+    sample_fraction: Optional[float] = None,
+    shard_count: Optional[int] = None,
+    whole_dataset_options: List[str] = (),
+) -> ExecutionPlan:
+    """Pick in memory/chunked/parallel + the batch size for one dataset"""
+    source_profile = profile_source(dataset_name, retrieve_from)
+
+    if source_profile is None:
+        execution_plan = ExecutionPlan(dataset_name, "in_memory")
+        execution_plan.reasons.append(
+            f"the size of the source ({retrieve_from}) isn't known up front"
+        )
+        return execution_plan
+
+    estimated_rows = source_profile["estimated_rows"]
+    if sample_fraction is not None:
+        estimated_rows = int(estimated_rows * sample_fraction)
+    if shard_count is not None:
+        estimated_rows = estimated_rows // shard_count
+
+    memory_row_bytes = source_profile["memory_row_bytes"]
+    in_memory_bytes = estimated_rows * memory_row_bytes * PLANNER_TRANSFORM_OVERHEAD
+    fits_in_memory = in_memory_bytes <= memory_budget_bytes
+
+    source_description = (
+        f"source: {format_bytes(source_profile['object_bytes'])}"
+        + (
+            f" ({source_profile['compression']}, "
+            f"~{source_profile['compression_ratio']:.1f}x)"
+            if source_profile["compression"]
+            else ""
+        )
+        + f", ~{estimated_rows:,} rows, ~{memory_row_bytes:.0f} B/row in memory"
+    )
+    memory_description = (
+        f"~{format_bytes(in_memory_bytes)} to transform in one go, "
+        f"budget {format_bytes(memory_budget_bytes)}, {cpu_count} core(s)"
+    )
+
+    # the whole-dataset stages (and sharding) can't run on batches
+    if whole_dataset_options or shard_count is not None:
+        execution_plan = ExecutionPlan(dataset_name, "in_memory")
+        execution_plan.reasons += [source_description, memory_description]
+        execution_plan.reasons.append(
+            "batches aren't an option with: "
+            + ", ".join(
+                list(whole_dataset_options)
+                + (["sharding"] if shard_count is not None else [])
+            )
+        )
+        if not fits_in_memory:
+            execution_plan.reasons.append("WARNING: this might not fit in memory")
+        return execution_plan
+
+    if fits_in_memory and (
+        estimated_rows < PLANNER_PARALLEL_MIN_ROWS or cpu_count == 1
+    ):
+        execution_plan = ExecutionPlan(dataset_name, "in_memory")
+        execution_plan.reasons += [
+            source_description,
+            memory_description,
+            (
+                "fits in memory, and too small to be worth splitting"
+                if cpu_count > 1
+                else "fits in memory, and there's only one core"
+            ),
+        ]
+        return execution_plan
+
+    # as many workers as there are cores (or full batches to go around),
+    # fewer if that makes the batches too small to be worth it
+    transform_workers = max(
+        1, min(cpu_count, math.ceil(estimated_rows / PLANNER_MIN_BATCH_ROWS))
+    )
+    batch_rows = compute_batch_rows(
+        memory_row_bytes, transform_workers, memory_budget_bytes
+    )
+    while batch_rows < PLANNER_MIN_BATCH_ROWS and transform_workers > 1:
+        transform_workers -= 1
+        batch_rows = compute_batch_rows(
+            memory_row_bytes, transform_workers, memory_budget_bytes
+        )
+
+    # one batch at a time is only worth it when it doesn't fit otherwise
+    if fits_in_memory and transform_workers == 1:
+        execution_plan = ExecutionPlan(dataset_name, "in_memory")
+        execution_plan.reasons += [
+            source_description,
+            memory_description,
+            "fits in memory, and there aren't enough rows for several batches",
+        ]
+        return execution_plan
+
+    execution_plan = ExecutionPlan(
+        dataset_name,
+        "parallel" if transform_workers > 1 else "chunked",
+        # no bigger than it takes to give every worker a batch
+        batch_rows=max(
+            PLANNER_MIN_BATCH_ROWS,
+            min(batch_rows, math.ceil(estimated_rows / transform_workers)),
+        ),
+        transform_workers=transform_workers,
+    )
+    execution_plan.reasons += [
+        source_description,
+        memory_description,
+        (
+            f"fits in memory, but {transform_workers} workers get through it faster"
+            if fits_in_memory
+            else f"doesn't fit in memory, so it goes in batches "
+            f"({transform_workers} at a time)"
+        ),
+    ]
+    if batch_rows < PLANNER_MIN_BATCH_ROWS:
+        execution_plan.reasons.append(
+            f"WARNING: even {PLANNER_MIN_BATCH_ROWS:,}-row batches might not fit"
+        )
+
+    return execution_plan
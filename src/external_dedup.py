@@ -0,0 +1,150 @@
+"""
+Here we keep the deduplication + uniqueness checks for tables
+too big to deduplicate in one go: drop_duplicates/value_counts
+build hash tables over every row at once, which takes several
+times the size of the table itself. Instead, the columns to
+compare are spilled to disk in partitions by a hash of the row
+(so equal rows always land in the same partition) and the
+partitions are deduplicated one at a time, each within the
+memory budget. Small tables skip all that and go straight
+to pandas
+"""
+
+import math
+import os
+import pickle
+import tempfile
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.constants import DEDUP_MEMORY_BUDGET_BYTES, DEDUP_SPILL_DIRECTORY
+
+# drop_duplicates needs roughly this many times the size of the data
+DEDUP_MEMORY_OVERHEAD = 4
+
+ROW_POSITION_COLUMN = "__row_position"
+
+
+def fits_in_memory_budget(
+    key_data: pd.DataFrame, memory_budget_bytes: int
+) -> Optional[int]:
+    """None if the data can be deduplicated in one go, else its size in bytes"""
+    data_bytes = int(key_data.memory_usage(index=False, deep=True).sum())
+
+    if data_bytes * DEDUP_MEMORY_OVERHEAD <= memory_budget_bytes:
+        return None
+
+    return data_bytes
+
+
+def iterate_hash_partitions(
+    key_data: pd.DataFrame, data_bytes: int, memory_budget_bytes: int
+) -> Iterator[pd.DataFrame]:
+    """Spill the rows to disk by hash, give them back a partition at a time"""
+    # each partition (and each chunk spilled) should be about a budget's worth
+    number_of_partitions = math.ceil(
+        data_bytes * DEDUP_MEMORY_OVERHEAD / memory_budget_bytes
+    )
+    chunk_rows = max(1, len(key_data) // number_of_partitions)
+
+    with tempfile.TemporaryDirectory(dir=DEDUP_SPILL_DIRECTORY) as temp_dir:
+        for chunk_start in range(0, len(key_data), chunk_rows):
+            chunk = key_data.iloc[chunk_start : chunk_start + chunk_rows].reset_index(
+                drop=True
+            )
+
+            # hash_pandas_object has a fixed key: equal rows -> equal hashes
+            partition_numbers = pd.util.hash_pandas_object(
+                chunk, index=False
+            ).to_numpy() % np.uint64(number_of_partitions)
+
+            # positions, so we know which rows of the table to keep in the end
+            chunk[ROW_POSITION_COLUMN] = np.arange(
+                chunk_start, chunk_start + len(chunk)
+            )
+
+            # stable, so the rows stay in their original order per partition
+            order = np.argsort(partition_numbers, kind="stable")
+            partition_bounds = np.searchsorted(
+                partition_numbers[order], np.arange(number_of_partitions + 1)
+            )
+            for partition_number in range(number_of_partitions):
+                partition_start, partition_end = partition_bounds[
+                    partition_number : partition_number + 2
+                ]
+                if partition_start == partition_end:
+                    continue
+
+                # appended to one file per partition, as pickled frames (these
+                # never leave the process, and keep any dtype as is)
+                with open(
+                    os.path.join(temp_dir, f"{partition_number:05d}.pickle"), "ab"
+                ) as partition_file:
+                    pickle.dump(
+                        chunk.iloc[order[partition_start:partition_end]],
+                        partition_file,
+                        protocol=pickle.HIGHEST_PROTOCOL,
+                    )
+
+            del chunk
+
+        for partition_file_name in sorted(os.listdir(temp_dir)):
+            partition_chunks = []
+            with open(
+                os.path.join(temp_dir, partition_file_name), "rb"
+            ) as partition_file:
+                while True:
+                    try:
+                        partition_chunks.append(pickle.load(partition_file))
+                    except EOFError:
+                        break
+
+            yield pd.concat(partition_chunks, ignore_index=True)
+
+
+def drop_duplicates_external(
+    target_df: pd.DataFrame,
+    subset: Optional[List[str]] = None,
+    memory_budget_bytes: int = DEDUP_MEMORY_BUDGET_BYTES,
+) -> pd.DataFrame:
+    """Same as target_df.drop_duplicates(subset), within the memory budget"""
+    key_data = target_df if subset is None else target_df[subset]
+
+    data_bytes = fits_in_memory_budget(key_data, memory_budget_bytes)
+    if data_bytes is None:
+        return target_df.drop_duplicates(subset=subset)
+
+    kept_positions = [
+        partition.loc[
+            ~partition.drop(columns=ROW_POSITION_COLUMN).duplicated(keep="first"),
+            ROW_POSITION_COLUMN,
+        ].to_numpy()
+        for partition in iterate_hash_partitions(
+            key_data, data_bytes, memory_budget_bytes
+        )
+    ]
+
+    # back in the original order, with the first copy of each row kept
+    return target_df.take(np.sort(np.concatenate(kept_positions)))
+
+
+def has_duplicates_external(
+    target_df: pd.DataFrame,
+    subset: Optional[List[str]] = None,
+    memory_budget_bytes: int = DEDUP_MEMORY_BUDGET_BYTES,
+) -> bool:
+    """Whether any rows (or subset of columns) repeat, within the memory budget"""
+    key_data = target_df if subset is None else target_df[subset]
+
+    data_bytes = fits_in_memory_budget(key_data, memory_budget_bytes)
+    if data_bytes is None:
+        return bool(key_data.duplicated().any())
+
+    return any(
+        partition.drop(columns=ROW_POSITION_COLUMN).duplicated().any()
+        for partition in iterate_hash_partitions(
+            key_data, data_bytes, memory_budget_bytes
+        )
+    )
@@ -5,12 +5,19 @@ retrieve specific data
 """
 
 import os
-from typing import Dict, Optional
+from typing import Dict, Iterator, Optional
 
 import pandas as pd
 import yaml
 
-from src.api_interactor import APIInteractor
+from src.api_interactor import APIInteractor, filter_on_review_time
+from src.constants import (
+    RAW_DATA_FILE_EXTENSION,
+    S3_BUCKET_NAME,
+    SAMPLE_READ_BATCH_ROWS,
+)
+from src.helper_functions import get_s3_client
+from src.sampling import sample_batches
 
 
 class IncorrectRetrievalSpecification(Exception):
@@ -22,7 +29,24 @@ def retrieve_reviews_data(
     retrieve_from: str,
     start_timestamp: Optional[str],
     end_timestamp: Optional[str],
+    sample_fraction: Optional[float] = None,
 ) -> pd.DataFrame:
+    if sample_fraction is not None:
+        # sampled batch by batch while reading, so the rest of the
+        # data is never held in memory (let alone transformed)
+        return pd.concat(
+            list(
+                retrieve_reviews_data_batches(
+                    api_interactor,
+                    retrieve_from=retrieve_from,
+                    start_timestamp=start_timestamp,
+                    end_timestamp=end_timestamp,
+                    batch_rows=SAMPLE_READ_BATCH_ROWS,
+                    sample_fraction=sample_fraction,
+                )
+            ),
+            ignore_index=True,
+        )
 
     if retrieve_from == "local":
         reviews = api_interactor.retrieve_data_from_csv(
@@ -33,6 +57,14 @@ def retrieve_reviews_data(
 
     elif retrieve_from == "s3":
         reviews = api_interactor.retrieve_data_from_s3("reviews")
+        reviews = filter_on_review_time(reviews, start_timestamp, end_timestamp)
+
+    elif retrieve_from == "api":
+        reviews = api_interactor.retrieve_data(
+            endpoint="reviews",
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+        )
 
     else:
         raise IncorrectRetrievalSpecification(
@@ -47,17 +79,42 @@ def retrieve_metadata(
     retrieve_from: str,
     start_timestamp: Optional[str],
     end_timestamp: Optional[str],
+    sample_fraction: Optional[float] = None,
 ) -> pd.DataFrame:
+    if sample_fraction is not None:
+        # sampled batch by batch while reading, so the rest of the
+        # data is never held in memory (let alone transformed)
+        return pd.concat(
+            list(
+                retrieve_metadata_batches(
+                    api_interactor,
+                    retrieve_from=retrieve_from,
+                    start_timestamp=start_timestamp,
+                    end_timestamp=end_timestamp,
+                    batch_rows=SAMPLE_READ_BATCH_ROWS,
+                    sample_fraction=sample_fraction,
+                )
+            ),
+            ignore_index=True,
+        )
 
+    # metadata has no review times, so there's nothing to filter locally
     if retrieve_from == "local":
         metadata = api_interactor.retrieve_data_from_csv(
             endpoint="metadata",
-            start_timestamp=start_timestamp,
-            end_timestamp=end_timestamp,
+            start_timestamp=None,
+            end_timestamp=None,
         )
     elif retrieve_from == "s3":
         metadata = api_interactor.retrieve_data_from_s3("metadata")
 
+    elif retrieve_from == "api":
+        metadata = api_interactor.retrieve_data(
+            endpoint="metadata",
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+        )
+
     else:
         raise IncorrectRetrievalSpecification(
             "Incorrect retrieval specified - check the 'retrieve_from' argument"
@@ -66,6 +123,108 @@ def retrieve_metadata(
     return metadata
 
 
+def identify_raw_source(dataset_name: str, retrieve_from: str) -> str:
+    """Something that changes when the raw data does (ETag, mtime, ...)"""
+    if retrieve_from == "s3":
+        object_head = get_s3_client().head_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=f"raw_data/{dataset_name}{RAW_DATA_FILE_EXTENSION}",
+        )
+        return object_head["ETag"].strip('"')
+
+    elif retrieve_from == "local":
+        return ",".join(
+            f"{csv_path}:{os.stat(csv_path).st_size}:{os.stat(csv_path).st_mtime_ns}"
+            for csv_path in sorted(APIInteractor.list_csv_files(dataset_name))
+        )
+
+    elif retrieve_from == "api":
+        # nothing to go on, so only the checkpoints' age limits the reuse
+        return "api"
+
+    raise IncorrectRetrievalSpecification(
+        "Incorrect retrieval specified - check the 'retrieve_from' argument"
+    )
+
+
+def retrieve_reviews_data_batches(
+    api_interactor: APIInteractor,
+    retrieve_from: str,
+    start_timestamp: Optional[str],
+    end_timestamp: Optional[str],
+    batch_rows: int,
+    sample_fraction: Optional[float] = None,
+) -> Iterator[pd.DataFrame]:
+    """Same as retrieve_reviews_data, but batch by batch"""
+    if retrieve_from == "local":
+        reviews_batches = api_interactor.retrieve_data_batches_from_csv(
+            endpoint="reviews",
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            batch_rows=batch_rows,
+        )
+
+    elif retrieve_from == "s3":
+        reviews_batches = (
+            filter_on_review_time(reviews, start_timestamp, end_timestamp)
+            for reviews in api_interactor.retrieve_data_batches_from_s3(
+                "reviews", batch_rows
+            )
+        )
+
+    elif retrieve_from == "api":
+        # the API pages are the batches
+        reviews_batches = api_interactor.retrieve_data_batches(
+            endpoint="reviews",
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+        )
+
+    else:
+        raise IncorrectRetrievalSpecification(
+            "Incorrect retrieval specified - check the 'retrieve_from' argument"
+        )
+
+    yield from sample_batches(reviews_batches, "reviews", sample_fraction)
+
+
+def retrieve_metadata_batches(
+    api_interactor: APIInteractor,
+    retrieve_from: str,
+    start_timestamp: Optional[str],
+    end_timestamp: Optional[str],
+    batch_rows: int,
+    sample_fraction: Optional[float] = None,
+) -> Iterator[pd.DataFrame]:
+    """Same as retrieve_metadata, but batch by batch"""
+    if retrieve_from == "local":
+        metadata_batches = api_interactor.retrieve_data_batches_from_csv(
+            endpoint="metadata",
+            start_timestamp=None,
+            end_timestamp=None,
+            batch_rows=batch_rows,
+        )
+
+    elif retrieve_from == "s3":
+        metadata_batches = api_interactor.retrieve_data_batches_from_s3(
+            "metadata", batch_rows
+        )
+
+    elif retrieve_from == "api":
+        metadata_batches = api_interactor.retrieve_data_batches(
+            endpoint="metadata",
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+        )
+
+    else:
+        raise IncorrectRetrievalSpecification(
+            "Incorrect retrieval specified - check the 'retrieve_from' argument"
+        )
+
+    yield from sample_batches(metadata_batches, "metadata", sample_fraction)
+
+
 def import_column_renaming_schemas() -> Dict[dict, dict]:
     path_to_raw_schemas_file = os.path.join(
         "src", "data_schemas", "column_renaming_schemas.yml"
@@ -97,3 +256,69 @@ def import_null_handling_schemas() -> Dict[dict, dict]:
         null_handling_schemas_dict = yaml.safe_load(file)
 
     return null_handling_schemas_dict
+
+
+def import_change_data_capture_schemas() -> Dict[str, list]:
+    path_to_raw_schemas_file = os.path.join(
+        "src", "data_schemas", "change_data_capture_schemas.yml"
+    )
+
+    with open(path_to_raw_schemas_file, "r") as file:
+        change_data_capture_schemas_dict = yaml.safe_load(file)
+
+    return change_data_capture_schemas_dict
+
+
+def import_text_store_schemas() -> Dict[str, dict]:
+    path_to_raw_schemas_file = os.path.join(
+        "src", "data_schemas", "text_store_schemas.yml"
+    )
+
+    with open(path_to_raw_schemas_file, "r") as file:
+        text_store_schemas_dict = yaml.safe_load(file)
+
+    return text_store_schemas_dict
+
+
+def import_surrogate_key_schemas() -> Dict[str, dict]:
+    path_to_raw_schemas_file = os.path.join(
+        "src", "data_schemas", "surrogate_key_schemas.yml"
+    )
+
+    with open(path_to_raw_schemas_file, "r") as file:
+        surrogate_key_schemas_dict = yaml.safe_load(file)
+
+    return surrogate_key_schemas_dict
+
+
+def import_data_quality_schemas() -> Dict[str, dict]:
+    path_to_raw_schemas_file = os.path.join(
+        "src", "data_schemas", "data_quality_schemas.yml"
+    )
+
+    with open(path_to_raw_schemas_file, "r") as file:
+        data_quality_schemas_dict = yaml.safe_load(file)
+
+    return data_quality_schemas_dict
+
+
+def import_postgres_load_schemas() -> Dict[str, list]:
+    path_to_raw_schemas_file = os.path.join(
+        "src", "data_schemas", "postgres_load_schemas.yml"
+    )
+
+    with open(path_to_raw_schemas_file, "r") as file:
+        postgres_load_schemas_dict = yaml.safe_load(file)
+
+    return postgres_load_schemas_dict
+
+
+def import_referential_integrity_schemas() -> Dict[str, dict]:
+    path_to_raw_schemas_file = os.path.join(
+        "src", "data_schemas", "referential_integrity_schemas.yml"
+    )
+
+    with open(path_to_raw_schemas_file, "r") as file:
+        referential_integrity_schemas_dict = yaml.safe_load(file)
+
+    return referential_integrity_schemas_dict
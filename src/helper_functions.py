@@ -0,0 +1,39 @@
+"""
+Here we keep small helpers that are shared across
+the extract, transform and load bits of the pipeline
+"""
+
+from datetime import datetime
+from functools import lru_cache
+
+from boto3 import Session
+from botocore.config import Config
+
+from src.constants import (
+    RANGED_DOWNLOAD_CONCURRENCY,
+    S3_ACCESS_KEY_ID,
+    S3_ACCESS_KEY_SECRET,
+    S3_ENDPOINT_URL,
+)
+
+
+def convert_timestamp_to_unix(timestamp: str) -> float:
+    """Convert a timestamp string to unix seconds"""
+    # this accepts both our own "%Y-%m-%d %H:%M:%S.%f" format and the
+    # ISO format Airflow renders for {{ data_interval_start }}
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """Create the S3 client once and share it across the process"""
+    session = Session(
+        aws_access_key_id=S3_ACCESS_KEY_ID,
+        aws_secret_access_key=S3_ACCESS_KEY_SECRET,
+        region_name="eu-north-1",
+    )
+
+    # enough connections for the ranged downloads of both pipelines at once
+    client_config = Config(max_pool_connections=4 * RANGED_DOWNLOAD_CONCURRENCY)
+
+    return session.client("s3", endpoint_url=S3_ENDPOINT_URL, config=client_config)
@@ -0,0 +1,421 @@
+"""
+Here we keep the inverted index over the review texts: finding
+the reviews that mention a term means scanning every text, so
+instead every term points to the (integer) keys of the reviews
+it appears in. Every run adds a small segment:
+  - terms.npy: the sorted terms (fixed width, memory-mappable)
+  - offsets.npy: where the postings of each term start
+  - counts.npy: how many reviews each term appears in
+  - postings.npy: per term, the sorted review keys as varint
+    encoded gaps (small gaps -> 1 byte instead of 8)
+and once there are SEGMENTS_PER_LEVEL segments of the same size
+class (level), they get merged into one of the next level, so
+there are only ever a handful of segments to look through.
+
+The review keys are the ones of the "review" key dictionary,
+i.e. the review_key the surrogate keys add to the fact table
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.state_store import StateStore
+from src.surrogate_keys import get_key_dictionary
+
+# lowercase ASCII words + numbers (the reviews are in English)
+TOKEN_PATTERN = r"[a-z0-9]+"
+# longer "words" are mostly URLs/garbage, and terms.npy is fixed width
+MAX_TERM_LENGTH = 24
+TERM_DTYPE = f"S{MAX_TERM_LENGTH}"
+
+SEGMENTS_PER_LEVEL = 4
+SEGMENT_FILES = ("terms.npy", "offsets.npy", "counts.npy", "postings.npy")
+
+
+class IncorrectQuery(Exception):
+    pass
+
+
+def count_varint_bytes(values: np.ndarray) -> np.ndarray:
+    """Bytes each value takes as a varint (7 bits per byte)"""
+    byte_counts = np.ones(len(values), dtype="int64")
+    for extra_byte in range(1, 10):
+        byte_counts += values >= np.uint64(1 << (7 * extra_byte))
+
+    return byte_counts
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """uint64 values -> varint bytes (high bit set = more bytes follow)"""
+    values = values.astype("uint64")
+    byte_counts = count_varint_bytes(values)
+    value_starts = np.cumsum(byte_counts) - byte_counts
+
+    # one row per output byte: which value, and which 7 bits of it
+    byte_values = np.repeat(values, byte_counts)
+    byte_positions = np.arange(byte_counts.sum()) - np.repeat(value_starts, byte_counts)
+
+    encoded = (byte_values >> (7 * byte_positions).astype("uint64")) & np.uint64(0x7F)
+    is_last_byte = byte_positions == np.repeat(byte_counts - 1, byte_counts)
+    encoded[~is_last_byte] |= np.uint64(0x80)
+
+    return encoded.astype("uint8")
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+    """Varint bytes -> uint64 values"""
+    encoded = np.asarray(encoded, dtype="uint8")
+    if len(encoded) == 0:
+        return np.empty(0, dtype="uint64")
+
+    value_ends = np.flatnonzero(encoded < 0x80)
+    value_starts = np.concatenate([[0], value_ends[:-1] + 1])
+    value_numbers = np.repeat(np.arange(len(value_ends)), value_ends - value_starts + 1)
+    byte_positions = np.arange(len(encoded)) - value_starts[value_numbers]
+
+    parts = (encoded & 0x7F).astype("uint64") << (7 * byte_positions).astype("uint64")
+
+    # the parts don't share any bits, so adding them up = OR-ing them
+    return np.add.reduceat(parts, value_starts)
+
+
+def tokenize_reviews(
+    reviews: pd.DataFrame, text_columns: Tuple[str, ...]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Split the texts into terms -> (term numbers, terms, review ids)"""
+    words = pd.concat(
+        [
+            reviews[text_column]
+            .fillna("")
+            .str.lower()
+            .str.findall(TOKEN_PATTERN)
+            .set_axis(reviews["review_id"].to_numpy())
+            for text_column in text_columns
+        ]
+    )
+    words = words.explode().dropna()
+
+    # from here on it's numbers, with each distinct term handled only once
+    term_numbers, terms = pd.factorize(words)
+    # (bool, since with no terms at all it would be an empty float array)
+    is_kept_term = np.array(
+        [len(term) <= MAX_TERM_LENGTH for term in terms], dtype=bool
+    )
+    is_kept = is_kept_term[term_numbers]
+
+    return term_numbers[is_kept], terms, words.index.to_numpy()[is_kept]
+
+
+def write_segment(
+    term_numbers: np.ndarray,
+    terms: np.ndarray,
+    review_keys: np.ndarray,
+    segment_directory: str,
+) -> None:
+    """Write (terms[term number], review key) pairs as a segment"""
+    # the terms get sorted (for searchsorted) + deduplicated (e.g. when
+    # segments are merged), and the term numbers follow along
+    unique_terms, term_renumbering = np.unique(
+        np.asarray(terms).astype(TERM_DTYPE), return_inverse=True
+    )
+    term_numbers = term_renumbering[term_numbers]
+    review_keys = review_keys.astype("uint64")
+
+    order = np.lexsort((review_keys, term_numbers))
+    term_numbers, review_keys = term_numbers[order], review_keys[order]
+
+    is_new_term = np.ones(len(term_numbers), dtype=bool)
+    is_new_term[1:] = term_numbers[1:] != term_numbers[:-1]
+    is_new_pair = is_new_term.copy()
+    is_new_pair[1:] |= review_keys[1:] != review_keys[:-1]
+    term_numbers, review_keys = term_numbers[is_new_pair], review_keys[is_new_pair]
+    is_new_term = is_new_term[is_new_pair]
+
+    # gaps between the sorted keys of a term; the first one is the key itself
+    gaps = review_keys.copy()
+    gaps[~is_new_term] = np.diff(review_keys)[~is_new_term[1:]]
+
+    counts = np.bincount(term_numbers, minlength=len(unique_terms))
+    byte_counts = count_varint_bytes(gaps)
+    term_starts = np.flatnonzero(is_new_term)
+    offsets = np.zeros(len(unique_terms) + 1, dtype="int64")
+    if len(gaps) > 0:
+        offsets[1:] = np.cumsum(np.add.reduceat(byte_counts, term_starts))
+
+    os.makedirs(segment_directory, exist_ok=True)
+    np.save(os.path.join(segment_directory, "terms.npy"), unique_terms)
+    np.save(os.path.join(segment_directory, "offsets.npy"), offsets)
+    np.save(os.path.join(segment_directory, "counts.npy"), counts)
+    np.save(os.path.join(segment_directory, "postings.npy"), encode_varints(gaps))
+
+
+class IndexSegment:
+    def __init__(self, segment_directory: str):
+        """Memory-map a segment (nothing is read until it's needed)"""
+        self.terms, self.offsets, self.counts, self.posting_bytes = (
+            np.load(os.path.join(segment_directory, file_name), mmap_mode="r")
+            for file_name in SEGMENT_FILES
+        )
+
+    def find_term(self, term: str) -> int:
+        """Position of a term in the segment (-1 = not there)"""
+        term = term.encode("utf-8")
+        position = int(np.searchsorted(self.terms, term))
+
+        if position < len(self.terms) and self.terms[position] == term:
+            return position
+
+        return -1
+
+    def postings(self, term: str) -> np.ndarray:
+        """Sorted review keys of the reviews with the term"""
+        position = self.find_term(term)
+        if position == -1:
+            return np.empty(0, dtype="uint64")
+
+        gaps = decode_varints(
+            self.posting_bytes[self.offsets[position] : self.offsets[position + 1]]
+        )
+
+        return np.cumsum(gaps, dtype="uint64")
+
+    def read_all(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """All the pairs (as term numbers, terms, review keys), e.g. to merge"""
+        gaps = decode_varints(self.posting_bytes)
+        counts = np.asarray(self.counts)
+
+        # cumulative sum per term: a global one, minus what came before the term
+        running_sums = np.cumsum(gaps, dtype="uint64")
+        term_starts = np.cumsum(counts) - counts
+        term_bases = running_sums[term_starts] - gaps[term_starts]
+
+        return (
+            np.repeat(np.arange(len(counts)), counts),
+            np.asarray(self.terms),
+            running_sums - np.repeat(term_bases, counts),
+        )
+
+
+class InvertedIndex:
+    def __init__(self, index_directory: str):
+        """Open the index in a local directory (see download_inverted_index)"""
+        with open(os.path.join(index_directory, "manifest.json"), "r") as file:
+            manifest = json.load(file)
+
+        self.segments = [
+            IndexSegment(os.path.join(index_directory, "segments", segment["name"]))
+            for segment in manifest["segments"]
+        ]
+
+    def postings(self, term: str) -> np.ndarray:
+        """Sorted review keys of the reviews with the term (all segments)"""
+        segment_postings = [segment.postings(term) for segment in self.segments]
+        if not segment_postings:
+            return np.empty(0, dtype="uint64")
+
+        # a review that came in twice can be in two segments
+        return np.unique(np.concatenate(segment_postings))
+
+    def all_of(self, terms: List[str]) -> np.ndarray:
+        """Reviews with every one of the terms"""
+        # rarest first, so the intersections shrink as early as possible
+        term_postings = sorted((self.postings(term) for term in terms), key=len)
+
+        matches = term_postings[0]
+        for postings in term_postings[1:]:
+            matches = np.intersect1d(matches, postings, assume_unique=True)
+
+        return matches
+
+    def search(self, query: str) -> np.ndarray:
+        """Boolean query, e.g. "battery life OR charger NOT broken" -> review keys"""
+        # OR between groups of terms, AND within a group, NOT excludes a term
+        matches = []
+        for query_group in re.split(r"\s+OR\s+", query.strip()):
+            required_terms, excluded_terms = [], []
+            excluded = False
+            for query_word in query_group.split():
+                if query_word == "AND":
+                    continue
+                if query_word == "NOT":
+                    excluded = True
+                    continue
+
+                # same tokenization as the texts, e.g. "don't" -> don AND t
+                word_terms = re.findall(TOKEN_PATTERN, query_word.lower())
+                (excluded_terms if excluded else required_terms).extend(word_terms)
+                excluded = False
+
+            if not required_terms:
+                raise IncorrectQuery(
+                    f"Every OR group needs a term to look for: {query}"
+                )
+
+            group_matches = self.all_of(required_terms)
+            for excluded_term in excluded_terms:
+                group_matches = np.setdiff1d(
+                    group_matches, self.postings(excluded_term), assume_unique=True
+                )
+            matches.append(group_matches)
+
+        return np.unique(np.concatenate(matches))
+
+
+def download_inverted_index(index_directory: str) -> str:
+    """Copy the index out of the state store (only the new segments)"""
+    store = StateStore("inverted_index")
+    manifest = store.read_json("manifest.json", default={"segments": []})
+
+    for segment in manifest["segments"]:
+        for file_name in SEGMENT_FILES:
+            file_path = os.path.join(
+                index_directory, "segments", segment["name"], file_name
+            )
+            # segments never change once written, so a local copy is up to date
+            if not os.path.exists(file_path):
+                store.download_file(
+                    f"segments/{segment['name']}/{file_name}", file_path
+                )
+
+    # segments merged away since the last download aren't needed anymore
+    segment_names = {segment["name"] for segment in manifest["segments"]}
+    segments_directory = os.path.join(index_directory, "segments")
+    for segment_name in (
+        os.listdir(segments_directory) if os.path.exists(segments_directory) else []
+    ):
+        if segment_name not in segment_names:
+            shutil.rmtree(os.path.join(segments_directory, segment_name))
+
+    # written last, so the local manifest never lists a missing segment
+    with open(os.path.join(index_directory, "manifest.json"), "w") as file:
+        json.dump(manifest, file)
+
+    return index_directory
+
+
+class InvertedIndexWriter:
+    def __init__(self):
+        """Add segments to the index in the state store"""
+        self.store = StateStore("inverted_index")
+        self.manifest = self.store.read_json("manifest.json", default={"segments": []})
+
+    def _upload_segment(self, segment_directory: str, segment_name: str) -> None:
+        for file_name in SEGMENT_FILES:
+            self.store.upload_file(
+                f"segments/{segment_name}/{file_name}",
+                os.path.join(segment_directory, file_name),
+            )
+
+    def _download_segment(self, segment_name: str, temp_dir: str) -> IndexSegment:
+        segment_directory = os.path.join(temp_dir, segment_name)
+        for file_name in SEGMENT_FILES:
+            self.store.download_file(
+                f"segments/{segment_name}/{file_name}",
+                os.path.join(segment_directory, file_name),
+            )
+
+        return IndexSegment(segment_directory)
+
+    def _compact(self) -> None:
+        # merge SEGMENTS_PER_LEVEL segments of a level into one of the next level
+        # (like an LSM tree), so each pair is only rewritten ~log(runs) times
+        # (only ever cascades up from level 0, where the new segment went)
+        level = 0
+        while True:
+            level_segments = [
+                segment
+                for segment in self.manifest["segments"]
+                if segment["level"] == level
+            ]
+            if len(level_segments) < SEGMENTS_PER_LEVEL:
+                return
+
+            with tempfile.TemporaryDirectory() as temp_dir:
+                term_numbers, terms, review_keys = [], [], []
+                for segment in level_segments:
+                    (
+                        segment_term_numbers,
+                        segment_terms,
+                        segment_review_keys,
+                    ) = self._download_segment(segment["name"], temp_dir).read_all()
+                    # numbered after the terms of the segments before it
+                    term_numbers.append(segment_term_numbers + sum(map(len, terms)))
+                    terms.append(segment_terms)
+                    review_keys.append(segment_review_keys)
+
+                merged_name = compose_segment_name()
+                write_segment(
+                    np.concatenate(term_numbers),
+                    np.concatenate(terms),
+                    np.concatenate(review_keys),
+                    os.path.join(temp_dir, merged_name),
+                )
+                self._upload_segment(os.path.join(temp_dir, merged_name), merged_name)
+
+            # the manifest switches over in one write, then the old ones can go
+            self.manifest["segments"] = [
+                segment
+                for segment in self.manifest["segments"]
+                if segment not in level_segments
+            ] + [{"name": merged_name, "level": level + 1}]
+            self.store.write_json("manifest.json", self.manifest)
+
+            for segment in level_segments:
+                self.store.delete(f"segments/{segment['name']}/")
+
+            level += 1
+
+    def add_reviews(
+        self,
+        reviews: pd.DataFrame,
+        text_columns: Tuple[str, ...] = ("review_text", "review_summary"),
+    ) -> None:
+        """Index the texts of the reviews as a new segment"""
+        text_columns = tuple(
+            text_column
+            for text_column in text_columns
+            if text_column in reviews.columns
+        )
+        if not text_columns or len(reviews) == 0:
+            # e.g. the text is stored out of line
+            print("No review texts to index, skipping")
+            return
+
+        term_numbers, terms, review_ids = tokenize_reviews(reviews, text_columns)
+        if len(term_numbers) == 0:
+            print("No terms in the review texts, skipping the index")
+            return
+
+        review_dictionary = get_key_dictionary("review")
+        review_keys = review_dictionary.encode(pd.Series(review_ids, dtype=object))
+        # saved before the segment, so no segment points to unsaved keys
+        review_dictionary.save()
+
+        segment_name = compose_segment_name()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_segment(term_numbers, terms, review_keys, temp_dir)
+            self._upload_segment(temp_dir, segment_name)
+
+        self.manifest["segments"].append({"name": segment_name, "level": 0})
+        self.store.write_json("manifest.json", self.manifest)
+
+        print(
+            f"Inverted index: {len(reviews)} reviews, {len(terms)} terms "
+            f"added as segment {segment_name}"
+        )
+
+        self._compact()
+
+
+def compose_segment_name() -> str:
+    """Unique, and sorts in the order the segments were written"""
+    return f"{time.time_ns()}_{uuid.uuid4().hex[:8]}"
@@ -0,0 +1,78 @@
+"""
+Here we keep the decoding of the API pages: response.json()
++ pd.json_normalize means the whole body, the whole object
+tree and the flattened frame are all in memory at once, and
+json_normalize works out the columns again for every record.
+Instead, the records of the "data" array are decoded one by
+one while the (compressed) response streams in, and each one
+is flattened straight into per-column lists, with the columns
+worked out once up front from the known raw schemas
+"""
+
+import json
+import os
+from typing import BinaryIO, Callable, Dict, List
+
+import pandas as pd
+import yaml
+
+try:
+    import ijson
+except ImportError:  # without it, the page is decoded in one go
+    ijson = None
+
+
+def import_raw_data_schemas() -> Dict[str, List[str]]:
+    path_to_raw_schemas_file = os.path.join(
+        "src", "data_schemas", "raw_data_schemas.yml"
+    )
+
+    with open(path_to_raw_schemas_file, "r") as file:
+        raw_data_schemas = yaml.safe_load(file)
+
+    return raw_data_schemas
+
+
+RAW_DATA_SCHEMAS = import_raw_data_schemas()
+
+
+def compile_flattener(
+    column_names: List[str], column_buffers: Dict[str, list]
+) -> Callable[[dict], None]:
+    """Make a function that appends a record's values to the column buffers"""
+    # the append methods are looked up once here instead of once per value
+    appenders = [
+        (column_name, column_buffers[column_name].append)
+        for column_name in column_names
+    ]
+
+    def flatten_record(record: dict) -> None:
+        for column_name, append in appenders:
+            value = record.get(column_name)
+            # nested values become the literal strings the CSVs have (e.g.
+            # "[2, 3]"), since the transforms parse them with literal_eval
+            append(repr(value) if isinstance(value, (list, dict)) else value)
+
+    return flatten_record
+
+
+def iterate_data_records(response_body: BinaryIO):
+    """Decode the records of the "data" array one at a time"""
+    if ijson is None:
+        yield from json.load(response_body)["data"]
+        return
+
+    # use_float: plain floats instead of Decimals, like json.load
+    yield from ijson.items(response_body, "data.item", use_float=True)
+
+
+def decode_data_records(response_body: BinaryIO, endpoint: str) -> pd.DataFrame:
+    """Stream an API page body into a dataframe with the raw columns"""
+    column_names = RAW_DATA_SCHEMAS[endpoint]
+    column_buffers = {column_name: [] for column_name in column_names}
+    flatten_record = compile_flattener(column_names, column_buffers)
+
+    for record in iterate_data_records(response_body):
+        flatten_record(record)
+
+    return pd.DataFrame(column_buffers, columns=column_names)
@@ -7,13 +7,23 @@ the context of this project it feels a bit
 overkill
 """
 
+import os
+import shutil
 import tempfile
 from io import StringIO
+from typing import Optional
 
 import pandas as pd
-from boto3 import Session
 
-from src.constants import S3_ACCESS_KEY_ID, S3_ACCESS_KEY_SECRET, S3_BUCKET_NAME
+from src.constants import POSTGRES_SCHEMA, S3_BUCKET_NAME
+from src.helper_functions import get_s3_client
+from src.load_manifests import (
+    LoadManifest,
+    compute_s3_etag,
+    list_s3_prefix,
+    record_file_stats,
+)
+from src.postgres_load import copy_to_postgres
 
 
 class IncorrectDWHSpecification(Exception):
@@ -26,54 +36,125 @@ def upload_data_to_s3(
     file_to_upload_name: str,
 ):
     """Function for uploading to the S3 bucket, file agnostic"""
-
-    session = Session(
-        aws_access_key_id=S3_ACCESS_KEY_ID,
-        aws_secret_access_key=S3_ACCESS_KEY_SECRET,
-        region_name="eu-north-1",
-    )
-
-    s3 = session.resource("s3", use_ssl=False)
-
     upload_key = f"{upload_path}/{upload_file_name}"
 
-    s3.Bucket(S3_BUCKET_NAME).upload_file(file_to_upload_name, upload_key)
+    get_s3_client().upload_file(file_to_upload_name, S3_BUCKET_NAME, upload_key)
 
 
-def upload_data_to_s3_as_csv(data_to_upload: pd.DataFrame, table_name: str) -> None:
-    session = Session(
-        aws_access_key_id=S3_ACCESS_KEY_ID,
-        aws_secret_access_key=S3_ACCESS_KEY_SECRET,
-        region_name="eu-north-1",
-    )
+def upload_data_to_s3_as_csv(
+    data_to_upload: pd.DataFrame, table_name: str, partition: Optional[str] = None
+) -> dict:
     bucket = S3_BUCKET_NAME  # already created on S3
     csv_buffer = StringIO()
     data_to_upload.to_csv(csv_buffer)
-    s3_resource = session.resource("s3", use_ssl=False)
-    s3_resource.Object(bucket, f"uploads/{table_name}.csv").put(
-        Body=csv_buffer.getvalue()
+    upload_key = (
+        f"uploads/{table_name}.csv"
+        if partition is None
+        else f"uploads/{table_name}/{partition}.csv"
     )
+    # encoded here (put_object would do the same), so the checksum is of
+    # exactly the bytes that get uploaded
+    body = csv_buffer.getvalue().encode("utf-8")
+    get_s3_client().put_object(Bucket=bucket, Key=upload_key, Body=body)
+
+    return record_file_stats(table_name, upload_key, len(data_to_upload), body=body)
+
+
+def clear_dwh_parts(
+    table_name: str,
+    upload_to: str,
+    partition_prefix: Optional[str] = None,
+    manifest: Optional[LoadManifest] = None,
+) -> None:
+    """Delete the part files (part00000...) a table has for one interval"""
+    # an earlier run may have had more batches (= parts), and the extra
+    # ones would stay there next to the new parts, as duplicates
+    parts_prefix = "part" if partition_prefix is None else f"{partition_prefix}_part"
+
+    if upload_to in ("dwh_as_csv", "dwh_as_stream"):
+        keys_prefix = f"uploads/{table_name}/{parts_prefix}"
+        keys = list(list_s3_prefix(keys_prefix))
+        # delete_objects takes at most 1000 keys at a time
+        for batch_start in range(0, len(keys), 1000):
+            get_s3_client().delete_objects(
+                Bucket=S3_BUCKET_NAME,
+                Delete={
+                    "Objects": [
+                        {"Key": key} for key in keys[batch_start : batch_start + 1000]
+                    ]
+                },
+            )
+    elif upload_to == "mock_dwh_locally":
+        keys_prefix = f"mock_dwh/{table_name}/{parts_prefix}"
+        table_directory = f"mock_dwh/{table_name}"
+        keys = [
+            f"{table_directory}/{file_name}"
+            for file_name in (
+                os.listdir(table_directory) if os.path.isdir(table_directory) else []
+            )
+            if file_name.startswith(parts_prefix)
+        ]
+        for key in keys:
+            os.remove(key)
+    else:
+        # e.g. postgres_copy merges the rows on the primary key, no parts
+        return
+
+    if keys:
+        print(f"Deleted {len(keys)} part files of {table_name} from an earlier run")
 
+    # a retry carries over the previous manifest, which lists the old parts
+    if manifest is not None:
+        manifest.forget(keys_prefix)
 
-def upload_to_dwh(target_data: pd.DataFrame, table_name: str, upload_to: str) -> None:
+
+def upload_to_dwh(
+    target_data: pd.DataFrame,
+    table_name: str,
+    upload_to: str,
+    partition: Optional[str] = None,
+    manifest: Optional[LoadManifest] = None,
+) -> dict:
     """Mock uploader function that puts the data in various locations"""
+    # partition lets one table be written in pieces (e.g. one file
+    # per hourly interval when backfilling) without overwriting itself
+    file_name = f"{table_name}.csv" if partition is None else f"{partition}.csv"
+
     if upload_to == "dwh_as_csv":
         with tempfile.TemporaryDirectory() as temp_dir:
-            target_data.to_csv(temp_dir + f"/{table_name}.csv", index=False)
+            target_data.to_csv(temp_dir + f"/{file_name}", index=False)
 
             upload_data_to_s3(
                 upload_path=f"uploads/{table_name}",
-                upload_file_name=f"{table_name}.csv",
-                file_to_upload_name=temp_dir + f"/{table_name}.csv",
+                upload_file_name=file_name,
+                file_to_upload_name=temp_dir + f"/{file_name}",
+            )
+
+            file_stats = record_file_stats(
+                table_name,
+                f"uploads/{table_name}/{file_name}",
+                len(target_data),
+                file_path=temp_dir + f"/{file_name}",
+                # big files go up in parts, which gives them another ETag
+                etag=compute_s3_etag(temp_dir + f"/{file_name}"),
             )
 
             print("Upload successful!")
     elif upload_to == "dwh_as_stream":
-        upload_data_to_s3_as_csv(target_data, table_name)
+        file_stats = upload_data_to_s3_as_csv(target_data, table_name, partition)
         print("Upload successful!")
 
     elif upload_to == "mock_dwh_locally":
-        target_data.to_csv(f"mock_dwh/{table_name}.csv")
+        if partition is None:
+            file_path = f"mock_dwh/{table_name}.csv"
+        else:
+            os.makedirs(f"mock_dwh/{table_name}", exist_ok=True)
+            file_path = f"mock_dwh/{table_name}/{file_name}"
+        target_data.to_csv(file_path)
+
+        file_stats = record_file_stats(
+            table_name, file_path, len(target_data), file_path=file_path
+        )
         """
         mock_dwh_file_list = pd.read_csv("/mock_dwh/mock_dwh.csv")
 
@@ -95,5 +176,66 @@ def upload_to_dwh(target_data: pd.DataFrame, table_name: str, upload_to: str) ->
         """
         print("Upload successful!")
 
+    elif upload_to == "postgres_copy":
+        # straight into the warehouse tables, no files in between
+        copy_to_postgres(target_data, table_name)
+        # no file to check afterwards, just the rows
+        file_stats = record_file_stats(
+            table_name, f"{POSTGRES_SCHEMA}.{table_name}", len(target_data)
+        )
+        print("Upload successful!")
+
     else:
         raise IncorrectDWHSpecification("Upload location incorrectly specified!")
+
+    if manifest is not None:
+        manifest.add(file_stats)
+
+    return file_stats
+
+
+def upload_file_to_dwh(
+    file_path: str,
+    table_name: str,
+    upload_to: str,
+    partition: Optional[str] = None,
+    manifest: Optional[LoadManifest] = None,
+) -> dict:
+    """Same as upload_to_dwh, but for files that are already written"""
+    # e.g. the text store, which isn't a CSV, so it's uploaded as is
+    upload_path = table_name if partition is None else f"{table_name}/{partition}"
+    file_name = os.path.basename(file_path)
+
+    if upload_to in ("dwh_as_csv", "dwh_as_stream"):
+        upload_data_to_s3(
+            upload_path=f"uploads/{upload_path}",
+            upload_file_name=file_name,
+            file_to_upload_name=file_path,
+        )
+        upload_key = f"uploads/{upload_path}/{file_name}"
+        etag = compute_s3_etag(file_path)
+
+    elif upload_to == "mock_dwh_locally":
+        os.makedirs(f"mock_dwh/{upload_path}", exist_ok=True)
+        shutil.copyfile(file_path, f"mock_dwh/{upload_path}/{file_name}")
+        upload_key = f"mock_dwh/{upload_path}/{file_name}"
+        etag = None
+
+    elif upload_to == "postgres_copy":
+        raise IncorrectDWHSpecification(
+            f"{file_name} isn't a table, so it can't be copied into Postgres"
+        )
+
+    else:
+        raise IncorrectDWHSpecification("Upload location incorrectly specified!")
+
+    print(f"Uploaded {file_name} to {upload_path}")
+
+    # not a table, so no rows to count
+    file_stats = record_file_stats(
+        table_name, upload_key, None, file_path=file_path, etag=etag
+    )
+    if manifest is not None:
+        manifest.add(file_stats)
+
+    return file_stats
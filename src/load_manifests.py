@@ -0,0 +1,258 @@
+"""
+Here we keep the load manifests + their verification: every
+run writes down what it uploaded (per file: the table, rows,
+bytes and checksums), and the verification lists the upload
+locations and compares what's there with the manifests.
+
+The listing is what makes it scale: one list call only sees
+1,000 keys, so every location is listed with a paginator, the
+locations are listed at the same time, and a location with a
+lot of expected files (e.g. a backfill's hourly partitions) is
+split into narrower prefixes so those get listed in parallel too
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from boto3.s3.transfer import TransferConfig
+
+from src.constants import S3_BUCKET_NAME, VERIFY_LISTING_CONCURRENCY
+from src.helper_functions import get_s3_client
+from src.state_store import StateStore
+
+# a listing page holds at most this many keys
+LISTING_PAGE_SIZE = 1000
+
+HASHING_BLOCK_SIZE = 8 * 1024**2
+
+
+class LoadVerificationFailed(Exception):
+    pass
+
+
+def compute_md5(file_path: str) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(HASHING_BLOCK_SIZE), b""):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def compute_s3_etag(file_path: str) -> str:
+    """The ETag S3 gives a file uploaded with upload_file (default settings)"""
+    transfer_config = TransferConfig()
+    if os.path.getsize(file_path) < transfer_config.multipart_threshold:
+        return compute_md5(file_path)
+
+    # multipart: the md5 of the parts' md5s, plus the number of parts
+    part_digests = []
+    with open(file_path, "rb") as file:
+        for part in iter(lambda: file.read(transfer_config.multipart_chunksize), b""):
+            part_digests.append(hashlib.md5(part).digest())
+
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+class LoadManifest:
+    def __init__(self, upload_to: str, manifest_name: str):
+        """What one run uploaded, saved in the state store"""
+        self.store = StateStore("load_manifests")
+        self.name = f"{upload_to}/{manifest_name}.json"
+        self.upload_to = upload_to
+
+        # a retry (e.g. with checkpoints) skips what the failed attempt
+        # uploaded, so those files are carried over from its manifest
+        previous_manifest = self.store.read_json(self.name, default={"files": []})
+        self.files = {
+            file_stats["key"]: file_stats for file_stats in previous_manifest["files"]
+        }
+
+    def add(self, file_stats: dict) -> None:
+        self.files[file_stats["key"]] = file_stats
+
+    def forget(self, key_prefix: str) -> None:
+        """Drop the files under a prefix (e.g. deleted before a re-run)"""
+        self.files = {
+            key: file_stats
+            for key, file_stats in self.files.items()
+            if not key.startswith(key_prefix)
+        }
+
+    def write(self) -> None:
+        self.store.write_json(
+            self.name,
+            {
+                "upload_to": self.upload_to,
+                "written_at": datetime.now(timezone.utc).isoformat(),
+                "files": list(self.files.values()),
+            },
+        )
+        print(f"Load manifest written: {len(self.files)} files")
+
+
+def compose_listing_prefixes(keys: List[str]) -> List[str]:
+    """Prefixes that cover the keys, each with about a page of them"""
+    names_per_directory = {}
+    for key in keys:
+        directory, _, name = key.rpartition("/")
+        names_per_directory.setdefault(f"{directory}/" if directory else "", []).append(
+            name
+        )
+
+    listing_prefixes = []
+
+    def split(prefix: str, names: List[str]) -> None:
+        common_prefix = os.path.commonprefix(names)
+        # a name that's the common prefix itself can't go any narrower
+        if len(names) <= LISTING_PAGE_SIZE or common_prefix in names:
+            listing_prefixes.append(prefix + common_prefix)
+            return
+
+        names_per_next_character = {}
+        for name in names:
+            names_per_next_character.setdefault(name[len(common_prefix)], []).append(
+                name[len(common_prefix) + 1 :]
+            )
+        for next_character, rest_of_names in names_per_next_character.items():
+            split(prefix + common_prefix + next_character, rest_of_names)
+
+    for directory, names in names_per_directory.items():
+        split(directory, names)
+
+    return listing_prefixes
+
+
+def list_s3_prefix(prefix: str) -> Dict[str, dict]:
+    """Every object under a prefix (all pages) -> its size + ETag"""
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    listed_objects = {}
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix):
+        for item in page.get("Contents", []):
+            listed_objects[item["Key"]] = {
+                "bytes": item["Size"],
+                "etag": item["ETag"].strip('"'),
+            }
+
+    return listed_objects
+
+
+def list_local_file(path: str) -> Dict[str, dict]:
+    if not os.path.exists(path):
+        return {}
+
+    # no ETags locally, so the checksum is worked out from the file
+    return {path: {"bytes": os.path.getsize(path), "md5": compute_md5(path)}}
+
+
+def read_manifests(upload_to: str, prefix: str = "") -> List[dict]:
+    store = StateStore("load_manifests")
+    manifest_names = store.list_names(f"{upload_to}/{prefix}")
+
+    with ThreadPoolExecutor(max_workers=VERIFY_LISTING_CONCURRENCY) as executor:
+        return list(executor.map(store.read_json, manifest_names))
+
+
+def verify_loads(upload_to: str, prefix: str = "") -> dict:
+    """Compare the uploaded files with the manifests -> a summary dict"""
+    manifests = sorted(
+        read_manifests(upload_to, prefix), key=lambda manifest: manifest["written_at"]
+    )
+
+    # the same file can be in several manifests (e.g. re-running an
+    # interval), and the last upload is the one that should be there
+    expected_files = {}
+    for manifest in manifests:
+        for file_stats in manifest["files"]:
+            expected_files[file_stats["key"]] = file_stats
+
+    # e.g. the postgres_copy tables: rows, but no files to check
+    unverifiable = [
+        key for key, file_stats in expected_files.items() if file_stats["bytes"] is None
+    ]
+    expected_files = {
+        key: file_stats
+        for key, file_stats in expected_files.items()
+        if file_stats["bytes"] is not None
+    }
+
+    with ThreadPoolExecutor(max_workers=VERIFY_LISTING_CONCURRENCY) as executor:
+        if upload_to in ("dwh_as_csv", "dwh_as_stream"):
+            listings = executor.map(
+                list_s3_prefix, compose_listing_prefixes(list(expected_files))
+            )
+        else:
+            listings = executor.map(list_local_file, list(expected_files))
+
+        found_files = {}
+        for listing in listings:
+            found_files.update(listing)
+
+    missing, size_mismatches, checksum_mismatches = [], [], []
+    for key, file_stats in expected_files.items():
+        found = found_files.get(key)
+        if found is None:
+            missing.append(key)
+        elif found["bytes"] != file_stats["bytes"]:
+            size_mismatches.append(key)
+        elif (
+            found.get("etag", file_stats["etag"]) != file_stats["etag"]
+            or found.get("md5", file_stats["md5"]) != file_stats["md5"]
+        ):
+            checksum_mismatches.append(key)
+
+    rows_per_table = {}
+    for file_stats in expected_files.values():
+        # e.g. the text store files aren't tables
+        if file_stats["rows"] is not None:
+            rows_per_table[file_stats["table"]] = (
+                rows_per_table.get(file_stats["table"], 0) + file_stats["rows"]
+            )
+
+    return {
+        "verified": not (missing or size_mismatches or checksum_mismatches),
+        "upload_to": upload_to,
+        "manifests": len(manifests),
+        "files_expected": len(expected_files),
+        "files_found": len(expected_files) - len(missing),
+        "bytes_expected": sum(
+            file_stats["bytes"] for file_stats in expected_files.values()
+        ),
+        "rows_per_table": rows_per_table,
+        "missing": sorted(missing),
+        "size_mismatches": sorted(size_mismatches),
+        "checksum_mismatches": sorted(checksum_mismatches),
+        "unverifiable": sorted(unverifiable),
+    }
+
+
+def record_file_stats(
+    table_name: str,
+    key: str,
+    rows: Optional[int],
+    file_path: Optional[str] = None,
+    body: Optional[bytes] = None,
+    etag: Optional[str] = None,
+) -> dict:
+    """The manifest entry of an uploaded file (from the file or its bytes)"""
+    if body is not None:
+        md5 = hashlib.md5(body).hexdigest()
+        number_of_bytes = len(body)
+    elif file_path is not None:
+        md5 = compute_md5(file_path)
+        number_of_bytes = os.path.getsize(file_path)
+    else:
+        md5, number_of_bytes = None, None
+
+    return {
+        "table": table_name,
+        "key": key,
+        "rows": rows,
+        "bytes": number_of_bytes,
+        "md5": md5,
+        # put_object ETags are just the md5
+        "etag": etag or md5,
+    }
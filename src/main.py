@@ -4,237 +4,1045 @@ Here we keep the tasks for processing
 each of the different entrypoints/datasets
 """
 
-from typing import Optional
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
+
+import pandas as pd
 
 from src.api_interactor import APIInteractor
-from src.constants import BASE_URL, BEARER_TOKEN
-from src.extract import retrieve_metadata, retrieve_reviews_data
-from src.load import upload_to_dwh
-from src.transform import transform_metadata, transform_reviews_data
-from src.validate import (
-    list_bucket_files_and_update_time,
-    validate_local_upload_mock_dwh,
-    validate_raw_data,
+from src.backfill import BackfillProgress, partition_into_hourly_intervals
+from src.change_data_capture import ChangeDataCapture
+from src.checkpoint import (
+    PipelineCheckpoint,
+    compose_interval_key,
+    compute_content_hash,
+)
+from src.constants import (
+    BASE_URL,
+    BEARER_TOKEN,
+    OVERLAPPED_BATCH_ROWS,
+    OVERLAPPED_TRANSFORM_WORKERS,
+    PLANNER_MEMORY_BUDGET_BYTES,
+)
+from src.copurchase_graph import GRAPH_TABLES, write_copurchase_graph
+from src.data_quality import apply_data_quality_rules, profile_data_quality
+from src.execution_planner import plan_execution
+from src.extract import (
+    identify_raw_source,
+    retrieve_metadata,
+    retrieve_metadata_batches,
+    retrieve_reviews_data,
+    retrieve_reviews_data_batches,
 )
+from src.helper_functions import get_s3_client
+from src.inverted_index import InvertedIndexWriter
+from src.load import clear_dwh_parts, upload_file_to_dwh, upload_to_dwh
+from src.load_manifests import LoadManifest, LoadVerificationFailed, verify_loads
+from src.near_duplicates import NearDuplicateDetector
+from src.overlapped_pipeline import BatchDeduplicator, OverlappedPipeline
+from src.profiling import profile_stage
+from src.referential_integrity import ReferentialIntegrityCheck
+from src.sampling import SAMPLE_TABLE_SUFFIX, validate_sample_fraction
+from src.sharding import (
+    ShardOutput,
+    compose_shard_label,
+    delete_shard_outputs,
+    merge_shard_outputs,
+    select_shard,
+    validate_shard_specification,
+)
+from src.surrogate_keys import assign_surrogate_keys
+from src.text_store import TEXT_STORE_SCHEMAS, move_text_out_of_line
+from src.transform import (
+    METADATA_TABLES,
+    REVIEWS_TABLES,
+    IncorrectTablesSpecified,
+    transform_metadata,
+    transform_reviews_data,
+)
+from src.validate import validate_raw_data
 
+# each dataset is the same extract -> validate -> transform -> load
+# sequence, only with different extract/transform functions
+PIPELINES = {
+    "reviews": {
+        "extract": retrieve_reviews_data,
+        "extract_batches": retrieve_reviews_data_batches,
+        "transform": transform_reviews_data,
+        "tables": REVIEWS_TABLES,
+    },
+    "metadata": {
+        "extract": retrieve_metadata,
+        "extract_batches": retrieve_metadata_batches,
+        "transform": transform_metadata,
+        "tables": METADATA_TABLES,
+    },
+}
 
-def process_raw_reviews_data_with_timestamps(
-    start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None
-) -> None:
-    """Extract, transform, load raw reviews data"""
-    # first set up client
-    api_interactor = APIInteractor(BASE_URL, BEARER_TOKEN)
 
-    # extract data
-    reviews = retrieve_reviews_data(
-        api_interactor,
-        retrieve_from="s3",
-        start_timestamp=start_timestamp,
-        end_timestamp=end_timestamp,
-    )
+class IncorrectDatasetSpecified(Exception):
+    pass
+
+
+class IncorrectDataQualityMode(Exception):
+    pass
+
+
+class IncompatiblePipelineOptions(Exception):
+    pass
 
-    validate_raw_data(reviews, "reviews")
 
-    # transform (i.e. clean) data
+def compose_partition(
+    start_timestamp: Optional[str], end_timestamp: Optional[str]
+) -> Optional[str]:
+    """Partition for the side tables of a run (None = not interval based)"""
+    if start_timestamp is None and end_timestamp is None:
+        return None
 
-    reviews_processed_dict = transform_reviews_data(reviews)
-    reviews_fact_table = reviews_processed_dict["reviews_fact_table"]
-    reviewers = reviews_processed_dict["reviewers"]
-    reviewers_user_names = reviews_processed_dict["reviewers_user_names"]
-    date_dimension = reviews_processed_dict["date_dimension"]
+    return compose_interval_key(start_timestamp, end_timestamp)
 
-    # load
-    upload_to_dwh(reviews_fact_table, "reviews_fact_table", upload_to="dwh_as_stream")
-    upload_to_dwh(reviewers, "reviewers", upload_to="dwh_as_stream")
-    upload_to_dwh(
-        reviewers_user_names, "reviewers_user_names", upload_to="dwh_as_stream"
+
+def select_dataset_tables(
+    dataset_name: str, tables: Optional[List[str]]
+) -> Optional[List[str]]:
+    """The requested tables this dataset makes (None = all of them)"""
+    if tables is None:
+        return None
+
+    return [
+        table_name
+        for table_name in PIPELINES[dataset_name]["tables"]
+        if table_name in tables
+    ]
+
+
+def validate_tables(datasets: List[str], tables: Optional[List[str]]) -> None:
+    """None (all tables) or tables the datasets make"""
+    if tables is None:
+        return
+
+    unknown_tables = set(tables) - {
+        table_name
+        for dataset_name in datasets
+        for table_name in PIPELINES[dataset_name]["tables"]
+    }
+    if unknown_tables:
+        raise IncorrectTablesSpecified(
+            f"Unknown tables (for {', '.join(datasets)}): "
+            + ", ".join(sorted(unknown_tables))
+        )
+
+
+def compose_manifest_name(
+    dataset_name: str,
+    start_timestamp: Optional[str],
+    end_timestamp: Optional[str],
+    shard_label: Optional[str] = None,
+) -> str:
+    """Name the load manifest of a run, e.g. 20140101T00_20140101T01/reviews"""
+    manifest_name = (
+        f"{compose_interval_key(start_timestamp, end_timestamp)}/{dataset_name}"
     )
-    upload_to_dwh(date_dimension, "date_dimension", upload_to="dwh_as_stream")
 
+    return manifest_name if shard_label is None else f"{manifest_name}_{shard_label}"
 
-def process_raw_metadata_with_timestamps(
-    start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None
+
+def store_text_out_of_line(
+    dataset_name: str,
+    raw_data: pd.DataFrame,
+    upload_to: str,
+    partition: Optional[str] = None,
+    manifest: Optional[LoadManifest] = None,
+    table_suffix: str = "",
+) -> pd.DataFrame:
+    """Upload the text columns as a text store, return the data without them"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        narrow_data, store_files = move_text_out_of_line(
+            raw_data, dataset_name, temp_dir
+        )
+
+        for store_file in store_files:
+            upload_file_to_dwh(
+                store_file,
+                TEXT_STORE_SCHEMAS[dataset_name]["store_name"] + table_suffix,
+                upload_to=upload_to,
+                partition=partition,
+                manifest=manifest,
+            )
+
+    return narrow_data
+
+
+def store_copurchase_graph(
+    processed_tables: dict,
+    upload_to: str,
+    partition: Optional[str] = None,
+    manifest: Optional[LoadManifest] = None,
+    table_suffix: str = "",
 ) -> None:
-    """Extract, transform, load raw metadata"""
-    # first set up client
+    """Build the co-purchase graph from the metadata tables and upload it"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for graph_file in write_copurchase_graph(processed_tables, temp_dir):
+            upload_file_to_dwh(
+                graph_file,
+                "copurchase_graph" + table_suffix,
+                upload_to=upload_to,
+                partition=partition,
+                manifest=manifest,
+            )
 
-    api_interactor = APIInteractor(BASE_URL, BEARER_TOKEN)
 
-    # extract data
-    metadata = retrieve_metadata(
-        api_interactor,
-        retrieve_from="s3",
-        start_timestamp=start_timestamp,
-        end_timestamp=end_timestamp,
+def transform_and_load(
+    dataset_name: str,
+    raw_data: pd.DataFrame,
+    upload_to: str,
+    partition: Optional[str] = None,
+    checkpoint: Optional[PipelineCheckpoint] = None,
+    change_data_capture: Optional[ChangeDataCapture] = None,
+    near_duplicate_detector: Optional[NearDuplicateDetector] = None,
+    copurchase_graph: bool = False,
+    surrogate_keys: bool = False,
+    shard_output: Optional[ShardOutput] = None,
+    inverted_index: bool = False,
+    referential_integrity: Optional[ReferentialIntegrityCheck] = None,
+    manifest: Optional[LoadManifest] = None,
+    tables: Optional[List[str]] = None,
+    table_suffix: str = "",
+) -> None:
+    """Transform validated raw data and load the resulting tables (or some)"""
+    processed_tables = None
+
+    if checkpoint is not None:
+        input_hash = compute_content_hash(raw_data)
+        if tables is not None:
+            # a few tables of the same input aren't the whole set
+            input_hash += "_" + "_".join(sorted(tables))
+        processed_tables = checkpoint.load_transformed_tables(input_hash)
+
+    if processed_tables is None:
+        with profile_stage(f"{dataset_name}.transform"):
+            processed_tables = PIPELINES[dataset_name]["transform"](
+                raw_data, tables=tables
+            )
+
+        if checkpoint is not None:
+            checkpoint.save_transformed_tables(input_hash, processed_tables)
+
+    if referential_integrity is not None:
+        # on the string keys, before the surrogate keys replace them
+        referential_integrity.register_keys(processed_tables)
+        referential_integrity.find_orphan_candidates(processed_tables)
+
+    # kept as is, since the surrogate keys below can drop review_id
+    reviews_to_index = (
+        processed_tables.get("reviews_fact_table") if inverted_index else None
     )
 
-    validate_raw_data(metadata, "metadata")
+    if copurchase_graph:
+        # built from the full tables, before CDC narrows them down
+        store_copurchase_graph(
+            processed_tables,
+            upload_to,
+            partition=partition,
+            manifest=manifest,
+            table_suffix=table_suffix,
+        )
 
-    # transform
-    results_dictionary = transform_metadata(metadata)
+    if near_duplicate_detector is not None:
+        processed_tables = near_duplicate_detector.find_clusters(processed_tables)
 
-    products = results_dictionary["products"]
-    product_images = results_dictionary["product_images"]
-    product_sales_ranking = results_dictionary["product_sales_ranking"]
-    product_categories = results_dictionary["product_categories"]
-    product_bought_together = results_dictionary["product_bought_together"]
-    product_also_viewed = results_dictionary["product_also_viewed"]
+    if change_data_capture is not None:
+        # only the rows that changed since the last snapshot get loaded
+        processed_tables = change_data_capture.capture_changes(processed_tables)
 
-    # load
+    if surrogate_keys:
+        # integer keys instead of the string ones in the fact/bridge tables
+        processed_tables = assign_surrogate_keys(processed_tables)
 
-    upload_to_dwh(products, "products")
-    upload_to_dwh(product_images, "product_images")
-    upload_to_dwh(product_sales_ranking, "product_sales_ranking")
-    upload_to_dwh(product_categories, "product_categories")
-    upload_to_dwh(product_bought_together, "product_bought_together")
-    upload_to_dwh(product_also_viewed, "product_also_viewed")
+    if shard_output is not None:
+        # the tables other shards have rows of too get uploaded by the merge
+        processed_tables = shard_output.hold_back_shared_tables(
+            processed_tables, partition
+        )
+        partition = shard_output.shard_partition(partition)
 
+    with profile_stage(f"{dataset_name}.load"):
+        for table_name, table_data in processed_tables.items():
+            if checkpoint is not None and checkpoint.is_loaded(table_name):
+                continue  # uploaded by a previous attempt
 
-def process_raw_reviews_data_without_timestamps() -> None:
-    """Extract, transform, load raw reviews data"""
-    # first set up client
-    api_interactor = APIInteractor(BASE_URL, BEARER_TOKEN)
+            upload_to_dwh(
+                table_data,
+                table_name + table_suffix,
+                upload_to=upload_to,
+                partition=partition,
+                manifest=manifest,
+            )
 
-    # extract data
-    reviews = retrieve_reviews_data(
-        api_interactor, retrieve_from="s3", start_timestamp=None, end_timestamp=None
+            if checkpoint is not None:
+                checkpoint.mark_loaded(table_name)
+                if manifest is not None:
+                    # a retry skips this table, so it has to be in there already
+                    manifest.write()
+
+    if change_data_capture is not None:
+        change_data_capture.commit()
+
+    if near_duplicate_detector is not None:
+        near_duplicate_detector.commit()
+
+    if reviews_to_index is not None:
+        # only once loaded, so the index never points to missing reviews
+        InvertedIndexWriter().add_reviews(reviews_to_index)
+
+
+def run_overlapped_pipeline(
+    dataset_name: str,
+    api_interactor: APIInteractor,
+    retrieve_from: str,
+    upload_to: str,
+    start_timestamp: Optional[str] = None,
+    end_timestamp: Optional[str] = None,
+    batch_rows: int = OVERLAPPED_BATCH_ROWS,
+    sample_fraction: Optional[float] = None,
+    transform_workers: int = OVERLAPPED_TRANSFORM_WORKERS,
+    manifest: Optional[LoadManifest] = None,
+    tables: Optional[List[str]] = None,
+    table_suffix: str = "",
+) -> None:
+    """Extract, validate, transform, load one dataset batch by batch"""
+
+    def extract_and_validate_batches():
+        for raw_batch in PIPELINES[dataset_name]["extract_batches"](
+            api_interactor,
+            retrieve_from=retrieve_from,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            batch_rows=batch_rows,
+            sample_fraction=sample_fraction,
+        ):
+            validate_raw_data(raw_batch, dataset_name)
+            yield raw_batch
+
+    batch_deduplicator = BatchDeduplicator()
+    partition_prefix = compose_partition(start_timestamp, end_timestamp)
+
+    def load_batch(batch_number: int, processed_tables: dict) -> None:
+        # every batch is its own part, so the batches don't overwrite each other
+        partition = f"part{batch_number:05d}"
+        if partition_prefix is not None:
+            partition = f"{partition_prefix}_{partition}"
+
+        for table_name, table_data in processed_tables.items():
+            table_data = batch_deduplicator.deduplicate(table_name, table_data)
+            if len(table_data) == 0:
+                continue
+
+            upload_to_dwh(
+                table_data,
+                table_name + table_suffix,
+                upload_to=upload_to,
+                partition=partition,
+                manifest=manifest,
+            )
+
+    # the batches are numbered from 0 in every run, so a re-run of the
+    # interval starts from a clean slate (a shorter one would leave parts)
+    for table_name in tables or PIPELINES[dataset_name]["tables"]:
+        clear_dwh_parts(
+            table_name + table_suffix,
+            upload_to,
+            partition_prefix=partition_prefix,
+            manifest=manifest,
+        )
+
+    # the stages run at the same time here, so they're one stage to profile
+    with profile_stage(f"{dataset_name}.overlapped"):
+        OverlappedPipeline(
+            extract_and_validate_batches(),
+            # a partial (not a lambda), since it's sent to the worker processes
+            partial(PIPELINES[dataset_name]["transform"], tables=tables),
+            load_batch,
+            transform_workers=transform_workers,
+        ).run()
+
+    print(f"Pipeline ({dataset_name}, overlapped) completed successfully")
+
+
+def run_pipeline(
+    dataset_name: str,
+    api_interactor: APIInteractor,
+    retrieve_from: str,
+    upload_to: str,
+    start_timestamp: Optional[str] = None,
+    end_timestamp: Optional[str] = None,
+    checkpoint: bool = False,
+    change_data_capture: bool = False,
+    out_of_line_text: bool = False,
+    near_duplicates: bool = False,
+    copurchase_graph: bool = False,
+    surrogate_keys: bool = False,
+    data_quality: Optional[str] = None,
+    overlapped: bool = False,
+    batch_rows: int = OVERLAPPED_BATCH_ROWS,
+    shard_index: Optional[int] = None,
+    shard_count: Optional[int] = None,
+    inverted_index: bool = False,
+    sample_fraction: Optional[float] = None,
+    transform_workers: int = OVERLAPPED_TRANSFORM_WORKERS,
+    referential_integrity: Optional[ReferentialIntegrityCheck] = None,
+    tables: Optional[List[str]] = None,
+) -> None:
+    """Extract, validate, transform, load one dataset (or one shard of it)"""
+    # a sample goes to its own tables, so it never mixes with the real ones
+    table_suffix = SAMPLE_TABLE_SUFFIX if sample_fraction is not None else ""
+
+    # every file loaded goes in here, for check_successful_completion_*
+    manifest = LoadManifest(
+        upload_to,
+        compose_manifest_name(
+            dataset_name + table_suffix,
+            start_timestamp,
+            end_timestamp,
+            shard_label=(
+                compose_shard_label(shard_index, shard_count)
+                if shard_count is not None
+                else None
+            ),
+        ),
     )
 
-    validate_raw_data(reviews, "reviews")
+    if overlapped:
+        run_overlapped_pipeline(
+            dataset_name,
+            api_interactor,
+            retrieve_from=retrieve_from,
+            upload_to=upload_to,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            batch_rows=batch_rows,
+            sample_fraction=sample_fraction,
+            transform_workers=transform_workers,
+            manifest=manifest,
+            tables=tables,
+            table_suffix=table_suffix,
+        )
+        manifest.write()
+        return
 
-    # transform (i.e. clean) data
+    shard_output = (
+        ShardOutput(
+            dataset_name,
+            compose_interval_key(start_timestamp, end_timestamp),
+            shard_index,
+            shard_count,
+        )
+        if shard_count is not None
+        else None
+    )
 
-    reviews_processed_dict = transform_reviews_data(reviews)
-    reviews_fact_table = reviews_processed_dict["reviews_fact_table"]
-    reviewers = reviews_processed_dict["reviewers"]
-    reviewers_user_names = reviews_processed_dict["reviewers_user_names"]
-    date_dimension = reviews_processed_dict["date_dimension"]
+    # the side tables (quarantine, text store) are per shard as well
+    side_partition = compose_partition(start_timestamp, end_timestamp)
+    if shard_output is not None:
+        side_partition = shard_output.shard_partition(side_partition)
 
-    # load
+    # with checkpoints on, a retry picks up from the last finished stage
+    pipeline_checkpoint = (
+        PipelineCheckpoint(
+            dataset_name,
+            start_timestamp,
+            end_timestamp,
+            shard_label=shard_output.shard_label if shard_output else None,
+            # another source version/sample/table set can't resume from these
+            run_identity={
+                "source": identify_raw_source(dataset_name, retrieve_from),
+                "retrieve_from": retrieve_from,
+                "sample_fraction": sample_fraction,
+                "tables": tables,
+                # the raw extract is saved after these have run
+                "data_quality": data_quality,
+                "out_of_line_text": out_of_line_text,
+            },
+        )
+        if checkpoint
+        else None
+    )
 
-    upload_to_dwh(reviews_fact_table, "reviews_fact_table", upload_to="dwh_as_stream")
-    upload_to_dwh(reviewers, "reviewers", upload_to="dwh_as_stream")
-    upload_to_dwh(
-        reviewers_user_names, "reviewers_user_names", upload_to="dwh_as_stream"
+    raw_data = (
+        pipeline_checkpoint.load_raw_extract()
+        if pipeline_checkpoint is not None
+        else None
     )
-    upload_to_dwh(date_dimension, "date_dimension", upload_to="dwh_as_stream")
 
+    if raw_data is None:
+        with profile_stage(f"{dataset_name}.extract"):
+            raw_data = PIPELINES[dataset_name]["extract"](
+                api_interactor,
+                retrieve_from=retrieve_from,
+                start_timestamp=start_timestamp,
+                end_timestamp=end_timestamp,
+                sample_fraction=sample_fraction,
+            )
 
-def process_raw_metadata_without_timestamps() -> None:
-    """Extract, transform, load raw metadata"""
-    # first set up client
+        if shard_output is not None:
+            raw_data = select_shard(raw_data, dataset_name, shard_index, shard_count)
 
-    api_interactor = APIInteractor(BASE_URL, BEARER_TOKEN)
+        with profile_stage(f"{dataset_name}.validate"):
+            validate_raw_data(raw_data, dataset_name)
+
+        # the stages below run before the checkpoint, so a retry skips them too
+        if data_quality == "quarantine":
+            # bad rows are set aside (+ loaded separately), the rest carries on
+            raw_data, quarantine = apply_data_quality_rules(raw_data, dataset_name)
+            if len(quarantine) > 0:
+                upload_to_dwh(
+                    quarantine,
+                    f"{dataset_name}_quarantine{table_suffix}",
+                    upload_to=upload_to,
+                    partition=side_partition,
+                    manifest=manifest,
+                )
+        elif data_quality == "profile":
+            upload_to_dwh(
+                profile_data_quality(raw_data, dataset_name),
+                f"{dataset_name}_data_quality_profile{table_suffix}",
+                upload_to=upload_to,
+                partition=side_partition,
+                manifest=manifest,
+            )
+
+        if out_of_line_text:
+            raw_data = store_text_out_of_line(
+                dataset_name,
+                raw_data,
+                upload_to=upload_to,
+                partition=side_partition,
+                manifest=manifest,
+                table_suffix=table_suffix,
+            )
 
-    # extract data
-    metadata = retrieve_metadata(
-        api_interactor, retrieve_from="s3", start_timestamp=None, end_timestamp=None
+        if pipeline_checkpoint is not None:
+            # a retry starts from the checkpoint, after the side tables
+            manifest.write()
+            pipeline_checkpoint.save_raw_extract(raw_data)
+
+    transform_and_load(
+        dataset_name,
+        raw_data,
+        upload_to=upload_to,
+        checkpoint=pipeline_checkpoint,
+        change_data_capture=ChangeDataCapture() if change_data_capture else None,
+        near_duplicate_detector=(
+            NearDuplicateDetector()
+            if near_duplicates and dataset_name == "reviews"
+            else None
+        ),
+        copurchase_graph=copurchase_graph and dataset_name == "metadata",
+        surrogate_keys=surrogate_keys,
+        shard_output=shard_output,
+        inverted_index=inverted_index and dataset_name == "reviews",
+        referential_integrity=referential_integrity,
+        manifest=manifest,
+        tables=tables,
+        table_suffix=table_suffix,
     )
 
-    validate_raw_data(metadata, "metadata")
+    manifest.write()
+
+    if pipeline_checkpoint is not None:
+        pipeline_checkpoint.clear()
+
+    if shard_output is not None:
+        shard_output.mark_completed()
+
+    print(f"Pipeline ({dataset_name}) completed successfully")
+
 
-    # transform
-    results_dictionary = transform_metadata(metadata)
+def run_pipelines(
+    datasets: List[str] = ("reviews", "metadata"),
+    retrieve_from: str = "s3",
+    upload_to: str = "dwh_as_stream",
+    start_timestamp: Optional[str] = None,
+    end_timestamp: Optional[str] = None,
+    concurrent: bool = True,
+    checkpoint: bool = False,
+    change_data_capture: bool = False,
+    out_of_line_text: bool = False,
+    near_duplicates: bool = False,
+    copurchase_graph: bool = False,
+    surrogate_keys: bool = False,
+    data_quality: Optional[str] = None,
+    overlapped: bool = False,
+    batch_rows: int = OVERLAPPED_BATCH_ROWS,
+    shard_index: Optional[int] = None,
+    shard_count: Optional[int] = None,
+    inverted_index: bool = False,
+    sample_fraction: Optional[float] = None,
+    plan: bool = False,
+    referential_integrity: bool = False,
+    tables: Optional[List[str]] = None,
+) -> None:
+    """Run the pipelines of several datasets in one process"""
+    for dataset_name in datasets:
+        if dataset_name not in PIPELINES:
+            raise IncorrectDatasetSpecified(f"Unknown dataset: {dataset_name}")
+
+    if tables is not None:
+        validate_tables(datasets, tables)
+
+        if copurchase_graph and not set(GRAPH_TABLES) <= set(tables):
+            raise IncompatiblePipelineOptions(
+                "The co-purchase graph is built from: " + ", ".join(GRAPH_TABLES)
+            )
+
+        # a dataset none of the tables come from doesn't even get extracted
+        datasets = [
+            dataset_name
+            for dataset_name in datasets
+            if select_dataset_tables(dataset_name, tables)
+        ]
+
+    if data_quality not in (None, "quarantine", "profile"):
+        raise IncorrectDataQualityMode(f"Unknown data quality mode: {data_quality}")
+
+    # these stages need the whole dataset at once (or, for CDC and the
+    # checkpoints, one state per run), so they don't work on batches
+    whole_dataset_options = {
+        "checkpoint": checkpoint,
+        "change_data_capture": change_data_capture,
+        "out_of_line_text": out_of_line_text,
+        "near_duplicates": near_duplicates,
+        "copurchase_graph": copurchase_graph,
+        "surrogate_keys": surrogate_keys,
+        "data_quality": data_quality,
+        "inverted_index": inverted_index,
+        "referential_integrity": referential_integrity,
+    }
+    if overlapped and any(whole_dataset_options.values()):
+        raise IncompatiblePipelineOptions(
+            "The overlapped mode doesn't support: "
+            + ", ".join(name for name, value in whole_dataset_options.items() if value)
+        )
 
-    products = results_dictionary["products"]
-    product_images = results_dictionary["product_images"]
-    product_sales_ranking = results_dictionary["product_sales_ranking"]
-    product_categories = results_dictionary["product_categories"]
-    product_bought_together = results_dictionary["product_bought_together"]
-    product_also_viewed = results_dictionary["product_also_viewed"]
+    validate_shard_specification(shard_index, shard_count)
+    validate_sample_fraction(sample_fraction)
 
-    # load
+    # these keep state across runs (or, for sharding, merge into the real
+    # tables), which a sample would overwrite with its fraction of the data
+    whole_population_options = {
+        "checkpoint": checkpoint,
+        "change_data_capture": change_data_capture,
+        "near_duplicates": near_duplicates,
+        "surrogate_keys": surrogate_keys,
+        "inverted_index": inverted_index,
+        "referential_integrity": referential_integrity,
+        "sharding": shard_count is not None,
+    }
+    if sample_fraction is not None and any(whole_population_options.values()):
+        raise IncompatiblePipelineOptions(
+            "Sampling doesn't support: "
+            + ", ".join(
+                name for name, value in whole_population_options.items() if value
+            )
+        )
+
+    if plan and overlapped:
+        raise IncompatiblePipelineOptions(
+            "The overlapped mode is picked by the planner, it can't be forced too"
+        )
+
+    # these keep one state for all the data, which the shards would all
+    # update at the same time (or, for the graph, need all the products)
+    whole_data_options = {
+        "change_data_capture": change_data_capture,
+        "near_duplicates": near_duplicates,
+        "copurchase_graph": copurchase_graph,
+        "surrogate_keys": surrogate_keys,
+        "overlapped": overlapped,
+        "inverted_index": inverted_index,
+        "referential_integrity": referential_integrity,
+    }
+    if shard_count is not None and any(whole_data_options.values()):
+        raise IncompatiblePipelineOptions(
+            "Sharding doesn't support: "
+            + ", ".join(name for name, value in whole_data_options.items() if value)
+        )
+
+    # these upload files that aren't tables (e.g. the text store), which
+    # can't go into Postgres, and by then the tables would be merged in
+    file_options = {
+        "out_of_line_text": out_of_line_text,
+        "copurchase_graph": copurchase_graph,
+    }
+    if upload_to == "postgres_copy" and any(file_options.values()):
+        raise IncompatiblePipelineOptions(
+            "postgres_copy doesn't support: "
+            + ", ".join(name for name, value in file_options.items() if value)
+        )
+
+    # one API client (HTTP session) + one S3 client for all pipelines;
+    # the S3 one is created up front since creating it isn't thread safe
+    api_interactor = APIInteractor(BASE_URL, BEARER_TOKEN)
+    get_s3_client()
 
-    upload_to_dwh(products, "products", upload_to="dwh_as_stream")
-    upload_to_dwh(product_images, "product_images", upload_to="dwh_as_stream")
-    upload_to_dwh(
-        product_sales_ranking, "product_sales_ranking", upload_to="dwh_as_stream"
+    pipeline_arguments = {
+        "api_interactor": api_interactor,
+        "retrieve_from": retrieve_from,
+        "upload_to": upload_to,
+        "start_timestamp": start_timestamp,
+        "end_timestamp": end_timestamp,
+        "checkpoint": checkpoint,
+        "change_data_capture": change_data_capture,
+        "out_of_line_text": out_of_line_text,
+        "near_duplicates": near_duplicates,
+        "copurchase_graph": copurchase_graph,
+        "surrogate_keys": surrogate_keys,
+        "data_quality": data_quality,
+        "overlapped": overlapped,
+        "batch_rows": batch_rows,
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "inverted_index": inverted_index,
+        "sample_fraction": sample_fraction,
+        # one for all the pipelines, since the reviews refer to the products
+        "referential_integrity": (
+            ReferentialIntegrityCheck() if referential_integrity else None
+        ),
+    }
+
+    # per dataset, since the planner can pick something else for each
+    dataset_arguments = {
+        dataset_name: {
+            **pipeline_arguments,
+            "tables": select_dataset_tables(dataset_name, tables),
+        }
+        for dataset_name in datasets
+    }
+    if plan:
+        run_concurrently = concurrent and len(datasets) > 1
+        for dataset_name in datasets:
+            execution_plan = plan_execution(
+                dataset_name,
+                retrieve_from,
+                # the datasets that run at the same time share the memory
+                memory_budget_bytes=PLANNER_MEMORY_BUDGET_BYTES
+                // (len(datasets) if run_concurrently else 1),
+                sample_fraction=sample_fraction,
+                shard_count=shard_count,
+                whole_dataset_options=[
+                    name for name, value in whole_dataset_options.items() if value
+                ],
+            )
+            execution_plan.log()
+            dataset_arguments[dataset_name] = {
+                **dataset_arguments[dataset_name],
+                **execution_plan.pipeline_arguments(),
+            }
+
+    if not concurrent or len(datasets) == 1:
+        for dataset_name in datasets:
+            run_pipeline(dataset_name, **dataset_arguments[dataset_name])
+    else:
+        # the work is mostly network (downloads/uploads) and pandas, which
+        # both let go of the GIL for long enough that threads pay off
+        with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+            running_pipelines = [
+                executor.submit(
+                    run_pipeline, dataset_name, **dataset_arguments[dataset_name]
+                )
+                for dataset_name in datasets
+            ]
+
+            # .result() re-raises whatever went wrong inside the thread
+            for running_pipeline in running_pipelines:
+                running_pipeline.result()
+
+    if pipeline_arguments["referential_integrity"] is not None:
+        # only now are all the keys of this run in
+        orphans_manifest = LoadManifest(
+            upload_to,
+            compose_manifest_name(
+                "referential_integrity", start_timestamp, end_timestamp
+            ),
+        )
+        pipeline_arguments["referential_integrity"].report(
+            upload_to,
+            partition=compose_partition(start_timestamp, end_timestamp),
+            manifest=orphans_manifest,
+        )
+        orphans_manifest.write()
+
+
+def process_reviews_and_metadata(
+    start_timestamp: Optional[str] = None,
+    end_timestamp: Optional[str] = None,
+    **pipeline_options,
+) -> None:
+    """Extract, transform, load reviews + metadata in the same pod"""
+    # pipeline_options = any of run_pipelines' options (datasets, etc.)
+    run_pipelines(
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
+        **pipeline_options,
     )
-    upload_to_dwh(product_categories, "product_categories", upload_to="dwh_as_stream")
-    upload_to_dwh(
-        product_bought_together, "product_bought_together", upload_to="dwh_as_stream"
+
+
+# the tasks below are kept for the existing DAG runs/docker commands
+
+
+def process_raw_reviews_data_with_timestamps(
+    start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None
+) -> None:
+    """Extract, transform, load raw reviews data"""
+    run_pipelines(
+        ["reviews"],
+        retrieve_from="s3",
+        upload_to="dwh_as_stream",
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
+    )
+
+
+def process_raw_metadata_with_timestamps(
+    start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None
+) -> None:
+    """Extract, transform, load raw metadata"""
+    run_pipelines(
+        ["metadata"],
+        retrieve_from="s3",
+        upload_to="dwh_as_stream",
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
     )
-    upload_to_dwh(product_also_viewed, "product_also_viewed", upload_to="dwh_as_stream")
+
+
+def process_raw_reviews_data_without_timestamps() -> None:
+    """Extract, transform, load raw reviews data"""
+    run_pipelines(["reviews"], retrieve_from="s3", upload_to="dwh_as_stream")
+
+
+def process_raw_metadata_without_timestamps() -> None:
+    """Extract, transform, load raw metadata"""
+    run_pipelines(["metadata"], retrieve_from="s3", upload_to="dwh_as_stream")
 
 
 def process_raw_reviews_data_without_timestamps_locally() -> None:
     """Extract, transform, load raw reviews data"""
-    # first set up client
+    run_pipelines(["reviews"], retrieve_from="local", upload_to="mock_dwh_locally")
+
+
+def process_raw_metadata_without_timestamps_locally() -> None:
+    """Extract, transform, load raw metadata"""
+    run_pipelines(["metadata"], retrieve_from="local", upload_to="mock_dwh_locally")
+
+
+def backfill_raw_data(
+    start_timestamp: str,
+    end_timestamp: str,
+    retrieve_from: str = "s3",
+    upload_to: str = "dwh_as_stream",
+    shard_index: Optional[int] = None,
+    shard_count: Optional[int] = None,
+) -> None:
+    """Backfill a wide interval in one pod, one output per hourly interval"""
+    validate_shard_specification(shard_index, shard_count)
+
     api_interactor = APIInteractor(BASE_URL, BEARER_TOKEN)
 
-    # extract data
+    shard_outputs = {
+        dataset_name: (
+            ShardOutput(
+                dataset_name,
+                compose_interval_key(start_timestamp, end_timestamp),
+                shard_index,
+                shard_count,
+            )
+            if shard_count is not None
+            else None
+        )
+        for dataset_name in ("reviews", "metadata")
+    }
+    shard_labels = {
+        dataset_name: shard_output.shard_label if shard_output else None
+        for dataset_name, shard_output in shard_outputs.items()
+    }
+
+    # reviews: read the source once, then split it by hour in memory
     reviews = retrieve_reviews_data(
-        api_interactor, retrieve_from="local", start_timestamp=None, end_timestamp=None
+        api_interactor,
+        retrieve_from=retrieve_from,
+        start_timestamp=None,
+        end_timestamp=None,
     )
 
+    if shard_count is not None:
+        reviews = select_shard(reviews, "reviews", shard_index, shard_count)
+
     validate_raw_data(reviews, "reviews")
 
-    # transform (i.e. clean) data
+    reviews_progress = BackfillProgress(
+        "reviews", start_timestamp, end_timestamp, shard_labels["reviews"]
+    )
 
-    reviews_processed_dict = transform_reviews_data(reviews)
-    reviews_fact_table = reviews_processed_dict["reviews_fact_table"]
-    reviewers = reviews_processed_dict["reviewers"]
-    reviewers_user_names = reviews_processed_dict["reviewers_user_names"]
-    date_dimension = reviews_processed_dict["date_dimension"]
+    for interval_label, interval_reviews in partition_into_hourly_intervals(
+        reviews, start_timestamp, end_timestamp
+    ):
+        if reviews_progress.is_completed(interval_label):
+            continue  # done by a previous (interrupted) backfill
 
-    # load
+        if len(interval_reviews) == 0:
+            reviews_progress.mark_completed(interval_label, save=False)
+            continue
 
-    upload_to_dwh(
-        reviews_fact_table, "reviews_fact_table", upload_to="mock_dwh_locally"
-    )
-    upload_to_dwh(reviewers, "reviewers", upload_to="mock_dwh_locally")
-    upload_to_dwh(
-        reviewers_user_names, "reviewers_user_names", upload_to="mock_dwh_locally"
-    )
-    upload_to_dwh(date_dimension, "date_dimension", upload_to="mock_dwh_locally")
+        # one (small) manifest per interval, written as each one is done,
+        # so a resumed backfill doesn't lose the intervals it skips
+        interval_manifest = LoadManifest(
+            upload_to,
+            compose_manifest_name(
+                f"reviews/{interval_label}",
+                start_timestamp,
+                end_timestamp,
+                shard_label=shard_labels["reviews"],
+            ),
+        )
+        transform_and_load(
+            "reviews",
+            interval_reviews,
+            upload_to=upload_to,
+            partition=interval_label,
+            shard_output=shard_outputs["reviews"],
+            manifest=interval_manifest,
+        )
+        interval_manifest.write()
 
+        reviews_progress.mark_completed(interval_label)
 
-def process_raw_metadata_without_timestamps_locally() -> None:
-    """Extract, transform, load raw metadata"""
-    # first set up client
+    reviews_progress.save()
 
-    api_interactor = APIInteractor(BASE_URL, BEARER_TOKEN)
+    if shard_outputs["reviews"] is not None:
+        shard_outputs["reviews"].mark_completed()
 
-    # extract data
-    metadata = retrieve_metadata(
-        api_interactor, retrieve_from="local", start_timestamp=None, end_timestamp=None
+    # metadata has no timestamps, so a single snapshot covers the whole backfill
+    metadata_progress = BackfillProgress(
+        "metadata", start_timestamp, end_timestamp, shard_labels["metadata"]
     )
 
-    validate_raw_data(metadata, "metadata")
+    if not metadata_progress.is_completed("snapshot"):
+        metadata = retrieve_metadata(
+            api_interactor,
+            retrieve_from=retrieve_from,
+            start_timestamp=None,
+            end_timestamp=None,
+        )
 
-    # transform
-    results_dictionary = transform_metadata(metadata)
+        if shard_count is not None:
+            metadata = select_shard(metadata, "metadata", shard_index, shard_count)
 
-    products = results_dictionary["products"]
-    product_images = results_dictionary["product_images"]
-    product_sales_ranking = results_dictionary["product_sales_ranking"]
-    product_categories = results_dictionary["product_categories"]
-    product_bought_together = results_dictionary["product_bought_together"]
-    product_also_viewed = results_dictionary["product_also_viewed"]
+        validate_raw_data(metadata, "metadata")
 
-    # load
+        metadata_manifest = LoadManifest(
+            upload_to,
+            compose_manifest_name(
+                "metadata",
+                start_timestamp,
+                end_timestamp,
+                shard_label=shard_labels["metadata"],
+            ),
+        )
+        transform_and_load(
+            "metadata",
+            metadata,
+            upload_to=upload_to,
+            shard_output=shard_outputs["metadata"],
+            manifest=metadata_manifest,
+        )
+        metadata_manifest.write()
 
-    upload_to_dwh(products, "products", upload_to="mock_dwh_locally")
-    upload_to_dwh(product_images, "product_images", upload_to="mock_dwh_locally")
-    upload_to_dwh(
-        product_sales_ranking, "product_sales_ranking", upload_to="mock_dwh_locally"
-    )
-    upload_to_dwh(
-        product_categories, "product_categories", upload_to="mock_dwh_locally"
-    )
-    upload_to_dwh(
-        product_bought_together, "product_bought_together", upload_to="mock_dwh_locally"
-    )
-    upload_to_dwh(
-        product_also_viewed, "product_also_viewed", upload_to="mock_dwh_locally"
+        metadata_progress.mark_completed("snapshot")
+
+    if shard_outputs["metadata"] is not None:
+        shard_outputs["metadata"].mark_completed()
+
+
+def merge_shards(
+    shard_count: int,
+    start_timestamp: Optional[str] = None,
+    end_timestamp: Optional[str] = None,
+    datasets: List[str] = ("reviews", "metadata"),
+    upload_to: str = "dwh_as_stream",
+) -> None:
+    """Once all the shards of a run are done, upload the shared tables once"""
+    validate_shard_specification(0, shard_count)
+    run_key = compose_interval_key(start_timestamp, end_timestamp)
+
+    for dataset_name in datasets:
+        if dataset_name not in PIPELINES:
+            raise IncorrectDatasetSpecified(f"Unknown dataset: {dataset_name}")
+
+    for dataset_name in datasets:
+        merged_manifest = LoadManifest(
+            upload_to,
+            compose_manifest_name(
+                f"{dataset_name}_merged", start_timestamp, end_timestamp
+            ),
+        )
+        merge_shard_outputs(
+            dataset_name,
+            run_key,
+            shard_count,
+            upload_to=upload_to,
+            manifest=merged_manifest,
+        )
+        merged_manifest.write()
+
+    # only now: if e.g. the metadata merge fails after the reviews one, a
+    # retry still finds the completed reviews shards (and merges them again)
+    for dataset_name in datasets:
+        delete_shard_outputs(dataset_name, run_key)
+
+
+def verify_completion(
+    upload_to: str,
+    start_timestamp: Optional[str] = None,
+    end_timestamp: Optional[str] = None,
+) -> dict:
+    """Check the uploads against the load manifests (of one interval, if given)"""
+    # e.g. a backfill's interval covers the manifests of all its hours
+    prefix = (
+        f"{compose_interval_key(start_timestamp, end_timestamp)}/"
+        if start_timestamp is not None or end_timestamp is not None
+        else ""
     )
 
+    verification = verify_loads(upload_to, prefix)
+    # machine-readable, for the DAGs/scripts that run this
+    print(json.dumps(verification, indent=2))
+
+    if not verification["verified"]:
+        raise LoadVerificationFailed(
+            f"{len(verification['missing'])} missing, "
+            f"{len(verification['size_mismatches'])} size and "
+            f"{len(verification['checksum_mismatches'])} checksum mismatches "
+            f"out of {verification['files_expected']} files"
+        )
+
+    return verification
 
-def check_successful_completion_s3():
-    """List bucket objects + time of download"""
-    list_bucket_files_and_update_time()
 
+def check_successful_completion_s3(
+    upload_to: str = "dwh_as_stream",
+    start_timestamp: Optional[str] = None,
+    end_timestamp: Optional[str] = None,
+) -> dict:
+    """Verify the S3 uploads against the load manifests"""
+    return verify_completion(upload_to, start_timestamp, end_timestamp)
 
-def check_successful_completion_locally():
-    """List DWH objects created locally"""
-    validate_local_upload_mock_dwh()
+
+def check_successful_completion_locally(
+    start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None
+) -> dict:
+    """Verify the DWH files created locally against the load manifests"""
+    return verify_completion("mock_dwh_locally", start_timestamp, end_timestamp)
@@ -0,0 +1,479 @@
+"""
+Here we keep the near-duplicate detection for reviews: lots
+of reviews are copy-pasted or templated, but comparing every
+review with every other one doesn't scale. Instead:
+  - every review text is cut into word shingles (3 words)
+  - MinHash turns the shingles into a short signature, where
+    two similar texts get mostly the same values
+  - LSH cuts the signatures into bands; reviews that share
+    a whole band land in the same bucket and become candidates
+  - candidates are glued into clusters (connected components)
+All of it is numpy over whole arrays, so it stays ~linear in
+the number of reviews. The buckets + clusters are kept in the
+state store, so new reviews also match the ones of past runs.
+
+That state grows with every review ever seen, so it's split
+into partitions (on a hash of the bucket/review/cluster id) and
+a run only reads + rewrites the partitions its reviews fall in
+"""
+
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.constants import NEAR_DUPLICATES_STATE_CONCURRENCY
+from src.state_store import StateStore
+
+SHINGLE_SIZE = 3
+NUM_PERMUTATIONS = 128
+# 16 bands x 8 rows: reviews with a Jaccard similarity of ~0.7+
+# are very likely to share a band, below ~0.5 very unlikely
+NUM_BANDS = 16
+# shingles hashed per batch (x NUM_PERMUTATIONS x 8 bytes ~ 16 MB)
+MAX_SHINGLES_PER_BATCH = 2**14
+
+# fixed seed: the signatures have to be comparable across runs
+RANDOM_STATE = np.random.default_rng(20140101)
+PERMUTATION_MULTIPLIERS = RANDOM_STATE.integers(
+    1, 2**63, size=NUM_PERMUTATIONS, dtype="uint64"
+) * np.uint64(2) + np.uint64(1)
+PERMUTATION_OFFSETS = RANDOM_STATE.integers(
+    0, 2**63, size=NUM_PERMUTATIONS, dtype="uint64"
+)
+BAND_MULTIPLIERS = RANDOM_STATE.integers(
+    1, 2**63, size=NUM_PERMUTATIONS // NUM_BANDS, dtype="uint64"
+) * np.uint64(2) + np.uint64(1)
+BAND_SALTS = RANDOM_STATE.integers(0, 2**63, size=NUM_BANDS, dtype="uint64")
+SHINGLE_MULTIPLIER = np.uint64(1099511628211)
+
+# the state is split on the top bits of the hashes. Every partition is
+# a file to read + write, so there are few of them: a big run (16 buckets
+# per review) still touches all the bucket partitions, but each is 1/256th
+# of the buckets, they go in parallel, and the cluster partitions are only
+# read for the reviews that matched. Changing this means rebuilding the
+# state, since every id would move to another partition
+STATE_PARTITION_BITS = 8
+
+
+def compute_shingle_hashes(
+    texts: pd.Series, shingle_size: int = SHINGLE_SIZE
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Hash the word shingles of every text -> (hashes, text position)"""
+    words = texts.fillna("").str.lower().str.findall(r"\w+")
+    words.index = np.arange(len(words))
+    words = words.explode().dropna()
+
+    # same word -> same hash, in every run (hash_array has a fixed key)
+    word_hashes = pd.util.hash_array(words.to_numpy(dtype=object))
+    word_rows = words.index.to_numpy()
+
+    # shingle i = words i..i+shingle_size-1, only if they're all in one text
+    number_of_shingles = max(len(word_hashes) - shingle_size + 1, 0)
+    shingle_hashes = word_hashes[:number_of_shingles].copy()
+    for word_offset in range(1, shingle_size):
+        shingle_hashes = (
+            shingle_hashes * SHINGLE_MULTIPLIER
+            + word_hashes[word_offset : word_offset + number_of_shingles]
+        )
+    shingle_rows = word_rows[:number_of_shingles]
+    is_within_text = shingle_rows == word_rows[shingle_size - 1 :]
+
+    # texts shorter than a shingle just use their single words
+    words_per_row = np.bincount(word_rows, minlength=len(texts))
+    is_short_text = words_per_row[word_rows] < shingle_size
+
+    shingle_hashes = np.concatenate(
+        [shingle_hashes[is_within_text], word_hashes[is_short_text]]
+    )
+    shingle_rows = np.concatenate(
+        [shingle_rows[is_within_text], word_rows[is_short_text]]
+    )
+
+    sort_order = np.argsort(shingle_rows, kind="stable")
+
+    return shingle_hashes[sort_order], shingle_rows[sort_order]
+
+
+def compute_minhash_signatures(
+    shingle_hashes: np.ndarray, shingle_rows: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """MinHash signature of every text with shingles -> (signatures, rows)"""
+    rows, row_starts = np.unique(shingle_rows, return_index=True)
+    signatures = np.empty((len(rows), NUM_PERMUTATIONS), dtype="uint32")
+
+    # whole texts per batch, so a text's minimum is taken in one go
+    batch_start_row = 0
+    while batch_start_row < len(rows):
+        batch_end_row = max(
+            np.searchsorted(
+                row_starts, row_starts[batch_start_row] + MAX_SHINGLES_PER_BATCH
+            ),
+            batch_start_row + 1,
+        )
+        shingle_start = row_starts[batch_start_row]
+        shingle_end = (
+            row_starts[batch_end_row]
+            if batch_end_row < len(rows)
+            else len(shingle_rows)
+        )
+
+        # one "permutation" = a*x + b (wrapping around 2^64); laid out
+        # permutations x shingles, so every minimum runs over contiguous
+        # memory, and the batch fits in the CPU cache
+        permuted = np.multiply(
+            PERMUTATION_MULTIPLIERS[:, None], shingle_hashes[shingle_start:shingle_end]
+        )
+        np.add(permuted, PERMUTATION_OFFSETS[:, None], out=permuted)
+        minimums = np.minimum.reduceat(
+            permuted, row_starts[batch_start_row:batch_end_row] - shingle_start, axis=1
+        )
+
+        # the top 32 bits are plenty (and min(x) >> 32 == min(x >> 32))
+        signatures[batch_start_row:batch_end_row] = (minimums >> np.uint64(32)).T
+
+        batch_start_row = batch_end_row
+
+    return signatures, rows
+
+
+def compute_band_buckets(signatures: np.ndarray) -> np.ndarray:
+    """Hash every band of every signature into a bucket -> (texts, bands)"""
+    bands = signatures.astype("uint64").reshape(len(signatures), NUM_BANDS, -1)
+
+    # the salt keeps equal values in different bands in different buckets
+    return (bands * BAND_MULTIPLIERS).sum(axis=2, dtype="uint64") ^ BAND_SALTS
+
+
+def find_connected_components(
+    number_of_nodes: int, edge_starts: np.ndarray, edge_ends: np.ndarray
+) -> np.ndarray:
+    """Label every node with the smallest node of its component"""
+    labels = np.arange(number_of_nodes)
+
+    while True:
+        # every edge pulls both its ends down to the smaller label...
+        new_labels = labels.copy()
+        edge_labels = np.minimum(labels[edge_starts], labels[edge_ends])
+        np.minimum.at(new_labels, edge_starts, edge_labels)
+        np.minimum.at(new_labels, edge_ends, edge_labels)
+
+        # ...and then every node jumps to its label's label, which
+        # keeps the number of rounds small even for long chains
+        while True:
+            jumped_labels = new_labels[new_labels]
+            if (jumped_labels == new_labels).all():
+                break
+            new_labels = jumped_labels
+
+        if (new_labels == labels).all():
+            return labels
+
+        labels = new_labels
+
+
+def cluster_candidates(
+    review_buckets: pd.DataFrame,
+    previous_buckets: pd.DataFrame,
+    previous_clusters: pd.DataFrame,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Cluster the reviews sharing a bucket -> (touched clusters, buckets, clusters)"""
+    # the previous runs' buckets go first, so an existing bucket keeps
+    # its member (one per bucket: that one is already in the cluster)
+    all_buckets = pd.concat([previous_buckets, review_buckets], ignore_index=True)
+    bucket_anchors = all_buckets.groupby("bucket", sort=False)["review_id"].transform(
+        "first"
+    )
+    is_paired = bucket_anchors != all_buckets["review_id"]
+    candidate_pairs = pd.DataFrame(
+        {
+            "review_id": all_buckets.loc[is_paired, "review_id"],
+            "anchor_id": bucket_anchors[is_paired],
+        }
+    )
+
+    # also link each previous member to its cluster, so clusters from
+    # past runs that a new review connects get merged together
+    previous_links = previous_clusters.loc[
+        previous_clusters["review_id"].isin(candidate_pairs["anchor_id"]),
+        ["review_id", "cluster_id"],
+    ].rename(columns={"cluster_id": "anchor_id"})
+    candidate_pairs = pd.concat([candidate_pairs, previous_links], ignore_index=True)
+
+    node_ids, node_labels = pd.factorize(
+        pd.concat([candidate_pairs["review_id"], candidate_pairs["anchor_id"]])
+    )
+    number_of_pairs = len(candidate_pairs)
+    components = find_connected_components(
+        len(node_labels), node_ids[:number_of_pairs], node_ids[number_of_pairs:]
+    )
+
+    touched_nodes = pd.DataFrame({"review_id": node_labels, "component": components})
+    touched_nodes["cluster_id"] = touched_nodes.groupby("component")[
+        "review_id"
+    ].transform("min")
+
+    # members of merged past clusters, which didn't show up this run
+    new_cluster_ids = touched_nodes.set_index("review_id")["cluster_id"]
+    merged_members = previous_clusters[
+        previous_clusters["cluster_id"].isin(new_cluster_ids.index)
+    ].copy()
+    merged_members["cluster_id"] = merged_members["cluster_id"].map(new_cluster_ids)
+
+    touched_clusters = pd.concat(
+        [touched_nodes[["review_id", "cluster_id"]], merged_members],
+        ignore_index=True,
+    ).drop_duplicates(subset="review_id")
+    touched_clusters["cluster_size"] = touched_clusters.groupby("cluster_id")[
+        "review_id"
+    ].transform("size")
+
+    clusters = pd.concat(
+        [
+            previous_clusters[
+                ~previous_clusters["review_id"].isin(touched_clusters["review_id"])
+            ],
+            touched_clusters[["review_id", "cluster_id"]],
+        ],
+        ignore_index=True,
+    )
+    buckets = all_buckets.drop_duplicates(subset="bucket", keep="first")
+
+    return touched_clusters.reset_index(drop=True), buckets, clusters
+
+
+def compute_state_partitions(keys: pd.Series) -> np.ndarray:
+    """The state partition of every bucket/review id/cluster id"""
+    # the buckets are hashes already, the ids get hashed (with a fixed key)
+    key_hashes = (
+        keys.to_numpy(dtype="uint64")
+        if keys.dtype == "uint64"
+        else pd.util.hash_array(keys.to_numpy(dtype=object))
+    )
+
+    return (key_hashes >> np.uint64(64 - STATE_PARTITION_BITS)).astype("int64")
+
+
+class PartitionedState:
+    def __init__(
+        self,
+        store: StateStore,
+        name: str,
+        partition_column: str,
+        unique_column: str,
+        column_types: dict,
+    ):
+        """A state table split into partitions on one of its columns"""
+        self.store = store
+        self.name = name
+        self.partition_column = partition_column
+        # the rows are unique on this one, so an update replaces on it
+        self.unique_column = unique_column
+        self.column_types = column_types
+
+        self.partitions: Dict[int, pd.DataFrame] = {}
+        self.changed_partitions = set()
+
+    def _empty_rows(self) -> pd.DataFrame:
+        # typed, so e.g. the buckets stay uint64 in the concats
+        return pd.DataFrame(columns=list(self.column_types)).astype(self.column_types)
+
+    def _read_partition(self, partition: int) -> pd.DataFrame:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "partition.parquet")
+            if not self.store.download_file(
+                f"{self.name}/{partition:05d}.parquet", file_path
+            ):
+                return self._empty_rows()
+
+            return pd.read_parquet(file_path)
+
+    def _write_partition(self, partition: int) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "partition.parquet")
+            self.partitions[partition].to_parquet(file_path, index=False)
+            self.store.upload_file(f"{self.name}/{partition:05d}.parquet", file_path)
+
+    def _load_partitions(self, partitions: Iterable[int]) -> None:
+        partitions_to_read = sorted(set(partitions) - set(self.partitions))
+
+        # it's all waiting on the store (S3), so threads
+        with ThreadPoolExecutor(
+            max_workers=NEAR_DUPLICATES_STATE_CONCURRENCY
+        ) as executor:
+            for partition, partition_data in zip(
+                partitions_to_read,
+                executor.map(self._read_partition, partitions_to_read),
+            ):
+                self.partitions[partition] = partition_data
+
+    def read(self, keys: pd.Series) -> pd.DataFrame:
+        """The rows with these keys (from the partitions they fall in)"""
+        partitions = np.unique(compute_state_partitions(keys)).tolist()
+        self._load_partitions(partitions)
+
+        rows = pd.concat(
+            [self._empty_rows()]
+            + [self.partitions[partition] for partition in partitions],
+            ignore_index=True,
+        )
+
+        return rows[rows[self.partition_column].isin(keys)].reset_index(drop=True)
+
+    def update(
+        self, new_rows: pd.DataFrame, removed_rows: Optional[pd.DataFrame] = None
+    ) -> None:
+        """Replace rows (on the unique column) + remove others, in memory"""
+        if removed_rows is None:
+            removed_rows = new_rows.iloc[:0]
+
+        # grouped once: filtering every row per partition is quadratic
+        changed_rows = pd.concat([new_rows, removed_rows], ignore_index=True)
+        is_new_row = np.arange(len(changed_rows)) < len(new_rows)
+        rows_per_partition = changed_rows.groupby(
+            compute_state_partitions(changed_rows[self.partition_column])
+        ).indices
+        self._load_partitions(rows_per_partition)
+
+        for partition, row_positions in rows_per_partition.items():
+            partition_data = self.partitions[partition]
+            partition_rows = changed_rows.iloc[row_positions]
+            self.partitions[partition] = pd.concat(
+                [
+                    partition_data[
+                        ~partition_data[self.unique_column].isin(
+                            partition_rows[self.unique_column]
+                        )
+                    ],
+                    partition_rows[is_new_row[row_positions]],
+                ],
+                ignore_index=True,
+            )
+        self.changed_partitions |= set(rows_per_partition)
+
+    def save(self) -> None:
+        """Write the partitions that changed (only those)"""
+        with ThreadPoolExecutor(
+            max_workers=NEAR_DUPLICATES_STATE_CONCURRENCY
+        ) as executor:
+            list(executor.map(self._write_partition, sorted(self.changed_partitions)))
+
+        self.changed_partitions = set()
+
+
+class NearDuplicateDetector:
+    def __init__(self):
+        """Keep the LSH buckets + clusters of the previous runs in the state store"""
+        store = StateStore("near_duplicates")
+        self.buckets = PartitionedState(
+            store,
+            "buckets",
+            partition_column="bucket",
+            unique_column="bucket",
+            column_types={"bucket": "uint64", "review_id": object},
+        )
+        # the clusters twice: once to look up the cluster of a review, once
+        # to find all the reviews of a cluster (to merge it into another)
+        cluster_column_types = {"review_id": object, "cluster_id": object}
+        self.cluster_of_review = PartitionedState(
+            store,
+            "cluster_of_review",
+            partition_column="review_id",
+            unique_column="review_id",
+            column_types=cluster_column_types,
+        )
+        self.cluster_members = PartitionedState(
+            store,
+            "cluster_members",
+            partition_column="cluster_id",
+            unique_column="review_id",
+            column_types=cluster_column_types,
+        )
+
+        self._migrate_single_file_state(store)
+
+    def _migrate_single_file_state(self, store: StateStore) -> None:
+        # the state used to be one buckets.parquet + one clusters.parquet
+        if not store.exists("buckets.parquet"):
+            return
+
+        print("Splitting the near-duplicates state into partitions (once)")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name in ("buckets", "clusters"):
+                store.download_file(
+                    f"{name}.parquet", os.path.join(temp_dir, f"{name}.parquet")
+                )
+            self.buckets.update(
+                pd.read_parquet(os.path.join(temp_dir, "buckets.parquet"))
+            )
+            if os.path.exists(os.path.join(temp_dir, "clusters.parquet")):
+                clusters = pd.read_parquet(os.path.join(temp_dir, "clusters.parquet"))
+                self.cluster_of_review.update(clusters)
+                self.cluster_members.update(clusters)
+
+        self.commit()
+        # clusters first: without buckets.parquet this isn't run again
+        store.delete("clusters.parquet")
+        store.delete("buckets.parquet")
+
+    def find_clusters(
+        self, processed_tables: Dict[str, pd.DataFrame]
+    ) -> Dict[str, pd.DataFrame]:
+        """Add the review_duplicate_clusters table to the reviews tables"""
+        reviews = processed_tables.get("reviews_fact_table")
+        if reviews is None or "review_text" not in reviews.columns:
+            # e.g. the text is stored out of line
+            print("No review texts to look for near-duplicates in, skipping")
+            return processed_tables
+
+        reviews = reviews.drop_duplicates(subset="review_id")
+
+        shingle_hashes, shingle_rows = compute_shingle_hashes(reviews["review_text"])
+        signatures, signature_rows = compute_minhash_signatures(
+            shingle_hashes, shingle_rows
+        )
+        band_buckets = compute_band_buckets(signatures)
+
+        review_buckets = pd.DataFrame(
+            {
+                "bucket": band_buckets.ravel(),
+                "review_id": np.repeat(
+                    reviews["review_id"].to_numpy()[signature_rows], NUM_BANDS
+                ),
+            }
+        )
+
+        # only the previous buckets these reviews land in, plus all the
+        # reviews of the clusters those buckets' members are in
+        previous_buckets = self.buckets.read(review_buckets["bucket"])
+        previous_clusters = self.cluster_members.read(
+            self.cluster_of_review.read(previous_buckets["review_id"])["cluster_id"]
+        )
+
+        duplicate_clusters, buckets, clusters = cluster_candidates(
+            review_buckets, previous_buckets, previous_clusters
+        )
+
+        # kept in memory until commit; the touched clusters replace the
+        # previous rows of the reviews in them
+        self.buckets.update(
+            buckets[~buckets["bucket"].isin(previous_buckets["bucket"])]
+        )
+        self.cluster_of_review.update(clusters, removed_rows=previous_clusters)
+        self.cluster_members.update(clusters, removed_rows=previous_clusters)
+
+        print(
+            "Near-duplicates: {} reviews in {} clusters".format(
+                len(duplicate_clusters), duplicate_clusters["cluster_id"].nunique()
+            )
+        )
+
+        return {**processed_tables, "review_duplicate_clusters": duplicate_clusters}
+
+    def commit(self) -> None:
+        """Save the new buckets + clusters (only once loaded!)"""
+        for state in (self.buckets, self.cluster_of_review, self.cluster_members):
+            state.save()
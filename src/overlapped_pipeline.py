@@ -0,0 +1,188 @@
+"""
+Here we keep the overlapped mode of a pipeline: normally the
+whole extract finishes before the transform starts, and the
+transform before the load, so the network sits idle while
+pandas works and the other way around. Here the data moves
+through the stages in batches instead:
+  extract (thread) -> queue -> transform (process pool)
+  -> queue -> load (thread)
+so the next batch downloads while the current one transforms
+and the previous one uploads. The queues are bounded: if a
+stage is slow, the ones before it wait instead of piling up
+batches in memory
+"""
+
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator
+
+import numpy as np
+import pandas as pd
+
+from src.constants import OVERLAPPED_QUEUE_SIZE, OVERLAPPED_TRANSFORM_WORKERS
+
+# marks the end of the batches in a queue
+END_OF_BATCHES = None
+
+# dimensions that get the same rows from different batches (e.g. a
+# reviewer with reviews in two batches), so they're deduplicated
+DEDUPLICATED_ACROSS_BATCHES = (
+    "reviewers",
+    "reviewers_user_names",
+    "date_dimension",
+    "category_tree",
+    "category_closure",
+)
+
+
+class BatchDeduplicator:
+    def __init__(self):
+        """Remember the rows already loaded per dimension"""
+        self.loaded_row_hashes = {}
+
+    def deduplicate(self, table_name: str, table_data: pd.DataFrame) -> pd.DataFrame:
+        """Drop the rows that an earlier batch already loaded"""
+        if table_name not in DEDUPLICATED_ACROSS_BATCHES:
+            return table_data
+
+        row_hashes = pd.util.hash_pandas_object(table_data, index=False).to_numpy()
+        loaded_row_hashes = self.loaded_row_hashes.get(
+            table_name, np.empty(0, dtype="uint64")
+        )
+
+        is_new = ~pd.Index(row_hashes).isin(loaded_row_hashes)
+        self.loaded_row_hashes[table_name] = np.concatenate(
+            [loaded_row_hashes, row_hashes[is_new]]
+        )
+
+        return table_data[is_new]
+
+
+class OverlappedPipeline:
+    def __init__(
+        self,
+        extract_batches: Iterator[pd.DataFrame],
+        transform: Callable[[pd.DataFrame], Dict[str, pd.DataFrame]],
+        load_batch: Callable[[int, Dict[str, pd.DataFrame]], None],
+        transform_workers: int = OVERLAPPED_TRANSFORM_WORKERS,
+        queue_size: int = OVERLAPPED_QUEUE_SIZE,
+    ):
+        """Connect the three stages through bounded queues"""
+        self.extract_batches = extract_batches
+        self.transform = transform  # has to be picklable (module level)
+        self.load_batch = load_batch
+        self.transform_workers = transform_workers
+
+        self.raw_batches = queue.Queue(maxsize=queue_size)
+        self.processed_batches = queue.Queue(maxsize=queue_size)
+
+        # the first stage to fail stops the others
+        self.stop_requested = threading.Event()
+        self.errors = []
+
+    def _put(self, target_queue: queue.Queue, item) -> bool:
+        # the queue is bounded: if the next stage falls behind, we wait here
+        while not self.stop_requested.is_set():
+            try:
+                target_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _get(self, source_queue: queue.Queue):
+        while not self.stop_requested.is_set():
+            try:
+                return source_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+        return END_OF_BATCHES
+
+    def _extract(self) -> None:
+        try:
+            batch_number = 0
+            for raw_batch in self.extract_batches:
+                if len(raw_batch) == 0:
+                    continue  # e.g. nothing in the interval in this batch
+
+                if not self._put(self.raw_batches, (batch_number, raw_batch)):
+                    return
+                batch_number += 1
+        finally:
+            self.extract_batches.close()  # e.g. closes the S3 object early
+
+        self._put(self.raw_batches, END_OF_BATCHES)
+
+    def _transform(self) -> None:
+        # separate processes, since the transforms are mostly Python code
+        # (GIL bound); spawned, since forking a process with threads running
+        # (downloads, boto3 connection pools) can leave locks held forever
+        transform_pool = ProcessPoolExecutor(
+            max_workers=self.transform_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        transforms_in_flight = deque()
+
+        try:
+            while True:
+                item = self._get(self.raw_batches)
+                if item is not END_OF_BATCHES:
+                    batch_number, raw_batch = item
+                    transforms_in_flight.append(
+                        (batch_number, transform_pool.submit(self.transform, raw_batch))
+                    )
+
+                # one batch per worker at most; the results are passed on
+                # in order, so the parts come out in the order they came in
+                while transforms_in_flight and (
+                    item is END_OF_BATCHES
+                    or len(transforms_in_flight) >= self.transform_workers
+                ):
+                    batch_number, transform_result = transforms_in_flight.popleft()
+                    if not self._put(
+                        self.processed_batches,
+                        (batch_number, transform_result.result()),
+                    ):
+                        return
+
+                if item is END_OF_BATCHES:
+                    break
+        finally:
+            transform_pool.shutdown(wait=True, cancel_futures=True)
+
+        self._put(self.processed_batches, END_OF_BATCHES)
+
+    def _load(self) -> None:
+        while True:
+            item = self._get(self.processed_batches)
+            if item is END_OF_BATCHES:
+                return
+
+            batch_number, processed_tables = item
+            self.load_batch(batch_number, processed_tables)
+
+    def _run_stage(self, stage: Callable[[], None]) -> None:
+        try:
+            stage()
+        except BaseException as error:
+            self.errors.append(error)
+            self.stop_requested.set()
+
+    def run(self) -> None:
+        """Run all the stages at once, until the last batch is loaded"""
+        stage_threads = [
+            threading.Thread(target=self._run_stage, args=(stage,), daemon=True)
+            for stage in (self._extract, self._transform, self._load)
+        ]
+        for stage_thread in stage_threads:
+            stage_thread.start()
+        for stage_thread in stage_threads:
+            stage_thread.join()
+
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,482 @@
+"""
+Here we keep the postgres_copy target: instead of writing
+files that something else then ingests, the tables are
+streamed straight into Postgres with COPY ... FROM STDIN.
+
+Every table is copied into a fresh (unlogged) stage table
+first and then merged into the final table on its primary
+key in one transaction, so a failed load never leaves half
+a table behind and reloading an interval doesn't double the
+rows. Big tables are copied in parts, each on its own pooled
+connection, so the parts go in at the same time.
+
+A final table that already exists has to match the data: new
+columns are added to it, anything else (columns gone, other
+types, another primary key, e.g. after toggling surrogate_keys
+or out_of_line_text) stops the load with what's different
+"""
+
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.constants import (
+    POSTGRES_COPY_FORMAT,
+    POSTGRES_COPY_PART_ROWS,
+    POSTGRES_DSN,
+    POSTGRES_POOL_SIZE,
+    POSTGRES_SCHEMA,
+)
+from src.extract import import_postgres_load_schemas, import_surrogate_key_schemas
+from src.sampling import SAMPLE_TABLE_SUFFIX
+
+try:
+    from psycopg import sql
+    from psycopg_pool import ConnectionPool
+except ImportError:  # only needed for the postgres_copy target
+    ConnectionPool = None
+
+POSTGRES_LOAD_SCHEMAS = import_postgres_load_schemas()
+SURROGATE_KEY_SCHEMAS = import_surrogate_key_schemas()
+
+# rows per to_csv call when streaming into a COPY
+COPY_BLOCK_ROWS = 10_000
+
+# with CSV, \N marks the NULLs (so empty strings stay empty strings)
+CSV_NULL = "\\N"
+
+# the binary COPY format: a signature, flags + header extension length
+BINARY_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+BINARY_COPY_TRAILER = np.array(-1, dtype=">i2").tobytes()
+
+# binary timestamps are microseconds since 2000-01-01
+POSTGRES_EPOCH = pd.Timestamp("2000-01-01")
+
+# the (big endian) binary COPY fields of the fixed width types
+BINARY_FIELD_DTYPES = {
+    "boolean": "u1",
+    "bigint": ">i8",
+    "double precision": ">f8",
+    "timestamp": ">i8",
+}
+
+# how information_schema names the types map_postgres_type gives
+INFORMATION_SCHEMA_TYPES = {"timestamp": "timestamp without time zone"}
+
+
+class PostgresNotAvailable(Exception):
+    pass
+
+
+class IncorrectCopyFormat(Exception):
+    pass
+
+
+class MissingPrimaryKeyColumns(Exception):
+    pass
+
+
+class PostgresSchemaDrift(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def get_postgres_pool():
+    """Create the connection pool once and share it across the process"""
+    if ConnectionPool is None:
+        raise PostgresNotAvailable("The postgres_copy target needs psycopg")
+    if POSTGRES_DSN is None:
+        raise PostgresNotAvailable("The postgres_copy target needs a POSTGRES_DSN")
+
+    return ConnectionPool(
+        POSTGRES_DSN, min_size=1, max_size=POSTGRES_POOL_SIZE, open=True
+    )
+
+
+def map_postgres_type(column_data: pd.Series) -> str:
+    """Postgres type for a pandas column"""
+    if pd.api.types.is_bool_dtype(column_data):
+        return "boolean"
+    elif pd.api.types.is_integer_dtype(column_data):
+        return "bigint"
+    elif pd.api.types.is_float_dtype(column_data):
+        return "double precision"
+    elif pd.api.types.is_datetime64_any_dtype(column_data):
+        return "timestamp"
+
+    return "text"
+
+
+def find_primary_key(target_data: pd.DataFrame, table_name: str) -> List[str]:
+    """The columns to merge on (empty = just append)"""
+    # a sampled table (e.g. products_sample) has the key of the real one
+    schema_name = table_name.removesuffix(SAMPLE_TABLE_SUFFIX)
+    surrogate_keys = SURROGATE_KEY_SCHEMAS.get(schema_name, {})
+
+    primary_key = []
+    for column_name in POSTGRES_LOAD_SCHEMAS.get(schema_name, []):
+        # with surrogate keys on, the integer key can replace the string one
+        if column_name not in target_data.columns and column_name in surrogate_keys:
+            column_name = surrogate_keys[column_name]["key_column"]
+
+        if column_name not in target_data.columns:
+            # appending instead would double the rows of every reload
+            raise MissingPrimaryKeyColumns(
+                f"{table_name} has no {column_name} column to merge on "
+                f"(it has: {', '.join(target_data.columns)})"
+            )
+
+        primary_key.append(column_name)
+
+    return primary_key
+
+
+def create_final_table(
+    connection, target_data: pd.DataFrame, table_name: str, primary_key: List[str]
+) -> None:
+    column_definitions = [
+        sql.SQL("{} {}").format(
+            sql.Identifier(column_name),
+            sql.SQL(map_postgres_type(target_data[column_name])),
+        )
+        for column_name in target_data.columns
+    ]
+    if primary_key:
+        column_definitions.append(
+            sql.SQL("PRIMARY KEY ({})").format(
+                sql.SQL(", ").join(map(sql.Identifier, primary_key))
+            )
+        )
+
+    connection.execute(
+        sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(
+            sql.Identifier(POSTGRES_SCHEMA)
+        )
+    )
+    connection.execute(
+        sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(
+            sql.Identifier(POSTGRES_SCHEMA, table_name),
+            sql.SQL(", ").join(column_definitions),
+        )
+    )
+
+
+def find_table_columns(connection, table_name: str) -> Dict[str, str]:
+    """Column name -> type of a table in Postgres (empty if there's no table)"""
+    return dict(
+        connection.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position",
+            (POSTGRES_SCHEMA, table_name),
+        ).fetchall()
+    )
+
+
+def find_table_primary_key(connection, table_name: str) -> List[str]:
+    return [
+        column_name
+        for (column_name,) in connection.execute(
+            "SELECT a.attname FROM pg_index i JOIN pg_attribute a "
+            "ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+            "WHERE i.indrelid = %s::regclass AND i.indisprimary "
+            "ORDER BY array_position(i.indkey::int2[], a.attnum)",
+            (sql.Identifier(POSTGRES_SCHEMA, table_name).as_string(connection),),
+        ).fetchall()
+    ]
+
+
+def reconcile_final_table(
+    connection, target_data: pd.DataFrame, table_name: str, primary_key: List[str]
+) -> None:
+    """Add the new columns to the final table, or fail on any other drift"""
+    table_columns = find_table_columns(connection, table_name)
+    data_types = {
+        column_name: map_postgres_type(target_data[column_name])
+        for column_name in target_data.columns
+    }
+
+    differences = []
+    missing_columns = [
+        column_name for column_name in table_columns if column_name not in data_types
+    ]
+    if missing_columns:
+        differences.append("columns not in the data: " + ", ".join(missing_columns))
+
+    # without rows the dtypes say nothing (e.g. empty object columns)
+    if len(target_data) > 0:
+        differences += [
+            f"{column_name} is {table_columns[column_name]}, the data has {data_type}"
+            for column_name, data_type in data_types.items()
+            if column_name in table_columns
+            and table_columns[column_name]
+            != INFORMATION_SCHEMA_TYPES.get(data_type, data_type)
+        ]
+
+    table_primary_key = find_table_primary_key(connection, table_name)
+    if table_primary_key != primary_key:
+        differences.append(
+            f"primary key ({', '.join(table_primary_key)}), "
+            f"the data's is ({', '.join(primary_key)})"
+        )
+
+    if differences:
+        raise PostgresSchemaDrift(
+            f"{POSTGRES_SCHEMA}.{table_name} doesn't match the data ("
+            + "; ".join(differences)
+            + "). Migrate or drop the table, e.g. after toggling surrogate_keys "
+            "or out_of_line_text"
+        )
+
+    # new columns are nullable, so the rows already there stay valid
+    for column_name, data_type in data_types.items():
+        if column_name not in table_columns:
+            print(f"Adding column {column_name} ({data_type}) to {table_name}")
+            connection.execute(
+                sql.SQL("ALTER TABLE {} ADD COLUMN {} {}").format(
+                    sql.Identifier(POSTGRES_SCHEMA, table_name),
+                    sql.Identifier(column_name),
+                    sql.SQL(data_type),
+                )
+            )
+
+
+def encode_binary_column(
+    column_data: pd.Series, postgres_type: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """One column as binary COPY fields -> (field bytes, bytes per row)"""
+    is_null = column_data.isna().to_numpy()
+
+    if postgres_type == "text":
+        # the only variable width type, so the only per-value step
+        values = [
+            b"" if null else str(value).encode("utf-8")
+            for value, null in zip(column_data.tolist(), is_null)
+        ]
+        payload = np.frombuffer(b"".join(values), dtype=np.uint8)
+        payload_lengths = np.fromiter(
+            map(len, values), dtype=np.int64, count=len(values)
+        )
+    else:
+        if postgres_type == "timestamp":
+            values = (
+                (column_data - POSTGRES_EPOCH).to_numpy(dtype="timedelta64[us]")
+            ).astype(np.int64)
+        elif postgres_type == "boolean":
+            values = column_data.to_numpy(dtype=bool, na_value=False)
+        elif postgres_type == "bigint":
+            values = column_data.to_numpy(dtype=np.int64, na_value=0)
+        else:
+            values = column_data.to_numpy(dtype=np.float64, na_value=0.0)
+
+        field_dtype = np.dtype(BINARY_FIELD_DTYPES[postgres_type])
+        field_width = field_dtype.itemsize
+        payload_bytes = (
+            values.astype(field_dtype).view(np.uint8).reshape(-1, field_width)
+        )
+        # NULLs have no payload at all
+        payload = payload_bytes[~is_null].reshape(-1)
+        payload_lengths = np.where(is_null, 0, field_width)
+
+    # every field starts with its length, -1 for NULL
+    length_prefixes = (
+        np.where(is_null, -1, payload_lengths).astype(">i4").view(np.uint8)
+    )
+
+    return interleave_row_pieces(
+        [
+            (length_prefixes, np.full(len(column_data), 4)),
+            (payload, payload_lengths),
+        ]
+    )
+
+
+def interleave_row_pieces(
+    pieces: List[Tuple[np.ndarray, np.ndarray]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Put pieces of bytes (each with its bytes per row) together row by row"""
+    row_lengths = sum(piece_lengths for _, piece_lengths in pieces)
+    row_starts = np.cumsum(row_lengths) - row_lengths
+    rows = np.empty(int(row_lengths.sum()), dtype=np.uint8)
+
+    offset_in_row = np.zeros(len(row_lengths), dtype=np.int64)
+    for piece_bytes, piece_lengths in pieces:
+        piece_starts = np.cumsum(piece_lengths) - piece_lengths
+        # every byte goes to: its row's start + the pieces before it in
+        # that row + its position within its own piece
+        rows[
+            np.repeat(row_starts + offset_in_row - piece_starts, piece_lengths)
+            + np.arange(len(piece_bytes))
+        ] = piece_bytes
+        offset_in_row = offset_in_row + piece_lengths
+
+    return rows, row_lengths
+
+
+def encode_binary_rows(target_data: pd.DataFrame) -> bytes:
+    """Rows in the binary COPY format, built column by column with numpy"""
+    field_counts = np.full(len(target_data), len(target_data.columns), dtype=">i2")
+
+    rows, _ = interleave_row_pieces(
+        [(field_counts.view(np.uint8), np.full(len(target_data), 2))]
+        + [
+            encode_binary_column(
+                target_data[column_name], map_postgres_type(target_data[column_name])
+            )
+            for column_name in target_data.columns
+        ]
+    )
+
+    return rows.tobytes()
+
+
+def copy_part(
+    target_data: pd.DataFrame, stage_table_name: str, copy_format: str
+) -> None:
+    """Stream one part of a table into the stage table"""
+    copy_statement = sql.SQL("COPY {} ({}) FROM STDIN {}").format(
+        sql.Identifier(POSTGRES_SCHEMA, stage_table_name),
+        sql.SQL(", ").join(map(sql.Identifier, target_data.columns)),
+        sql.SQL(
+            "(FORMAT BINARY)"
+            if copy_format == "binary"
+            else f"(FORMAT CSV, NULL '{CSV_NULL}')"
+        ),
+    )
+
+    with get_postgres_pool().connection() as connection:
+        with connection.cursor() as cursor, cursor.copy(copy_statement) as copy:
+            if copy_format == "binary":
+                # no text to parse on the server, and the rows are encoded
+                # per column (numpy) + block, like the CSV path below
+                copy.write(BINARY_COPY_HEADER)
+                for block_start in range(0, len(target_data), COPY_BLOCK_ROWS):
+                    copy.write(
+                        encode_binary_rows(
+                            target_data.iloc[
+                                block_start : block_start + COPY_BLOCK_ROWS
+                            ]
+                        )
+                    )
+                copy.write(BINARY_COPY_TRAILER)
+            else:
+                # to_csv (in C) block by block, so the whole CSV never
+                # exists in memory at once
+                for block_start in range(0, len(target_data), COPY_BLOCK_ROWS):
+                    copy.write(
+                        target_data.iloc[
+                            block_start : block_start + COPY_BLOCK_ROWS
+                        ].to_csv(index=False, header=False, na_rep=CSV_NULL)
+                    )
+
+
+def compose_merge_statement(
+    target_data: pd.DataFrame,
+    table_name: str,
+    stage_table_name: str,
+    primary_key: List[str],
+):
+    column_list = sql.SQL(", ").join(map(sql.Identifier, target_data.columns))
+    final_table = sql.Identifier(POSTGRES_SCHEMA, table_name)
+    stage_table = sql.Identifier(POSTGRES_SCHEMA, stage_table_name)
+
+    if not primary_key:
+        return sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+            final_table, column_list, column_list, stage_table
+        )
+
+    value_columns = [
+        column_name
+        for column_name in target_data.columns
+        if column_name not in primary_key
+    ]
+    on_conflict = (
+        sql.SQL("DO UPDATE SET {}").format(
+            sql.SQL(", ").join(
+                sql.SQL("{} = EXCLUDED.{}").format(
+                    sql.Identifier(column_name), sql.Identifier(column_name)
+                )
+                for column_name in value_columns
+            )
+        )
+        if value_columns
+        else sql.SQL("DO NOTHING")  # bridge tables are all key
+    )
+
+    # DISTINCT ON: a key twice in one load would make the upsert fail
+    return sql.SQL(
+        "INSERT INTO {} ({}) SELECT DISTINCT ON ({}) {} FROM {} ON CONFLICT ({}) {}"
+    ).format(
+        final_table,
+        column_list,
+        sql.SQL(", ").join(map(sql.Identifier, primary_key)),
+        column_list,
+        stage_table,
+        sql.SQL(", ").join(map(sql.Identifier, primary_key)),
+        on_conflict,
+    )
+
+
+def copy_to_postgres(
+    target_data: pd.DataFrame,
+    table_name: str,
+    copy_format: str = POSTGRES_COPY_FORMAT,
+) -> None:
+    """COPY a table into a stage table, then merge it into the final one"""
+    if copy_format not in ("csv", "binary"):
+        raise IncorrectCopyFormat(f"Unknown COPY format: {copy_format}")
+
+    # the index isn't data (the CSV targets write it, but it's just 0..n)
+    target_data = target_data.reset_index(drop=True)
+    primary_key = find_primary_key(target_data, table_name)
+    stage_table_name = f"{table_name}_stage_{uuid.uuid4().hex[:8]}"
+
+    with get_postgres_pool().connection() as connection:
+        create_final_table(connection, target_data, table_name, primary_key)
+        reconcile_final_table(connection, target_data, table_name, primary_key)
+        # unlogged: it only lives for this load, so no need for the WAL
+        connection.execute(
+            sql.SQL("CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(
+                sql.Identifier(POSTGRES_SCHEMA, stage_table_name),
+                sql.Identifier(POSTGRES_SCHEMA, table_name),
+            )
+        )
+
+    try:
+        table_parts = [
+            target_data.iloc[part_start : part_start + POSTGRES_COPY_PART_ROWS]
+            for part_start in range(0, len(target_data), POSTGRES_COPY_PART_ROWS)
+        ]
+
+        if len(table_parts) <= 1:
+            for table_part in table_parts:
+                copy_part(table_part, stage_table_name, copy_format)
+        else:
+            # each part on its own connection; the server parses them in
+            # parallel, and to_csv lets go of the GIL for most of the time
+            with ThreadPoolExecutor(max_workers=POSTGRES_POOL_SIZE) as executor:
+                copies = [
+                    executor.submit(
+                        copy_part, table_part, stage_table_name, copy_format
+                    )
+                    for table_part in table_parts
+                ]
+                for running_copy in copies:
+                    running_copy.result()
+
+        with get_postgres_pool().connection() as connection:
+            connection.execute(
+                compose_merge_statement(
+                    target_data, table_name, stage_table_name, primary_key
+                )
+            )
+    finally:
+        with get_postgres_pool().connection() as connection:
+            connection.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}").format(
+                    sql.Identifier(POSTGRES_SCHEMA, stage_table_name)
+                )
+            )
@@ -0,0 +1,286 @@
+"""
+Here we keep the opt-in profiling of a task: when a run is
+slow in production, there's nothing to go on afterwards.
+With profiling on (the --profile flag, or a PROFILING_SAMPLE_RATE
+share of the runs), a thread samples the stacks of all the
+other threads (+ the memory of the process) every few
+milliseconds, so we end up with:
+  - stacks.folded: the sampled stacks, grouped per stage, in the
+    folded format flamegraph.pl/speedscope read
+  - memory_report.txt: the peak memory per stage
+in PROFILING_OUTPUT (a local folder or an s3://bucket/prefix).
+
+Sampling (instead of cProfile tracing every call) is what keeps
+the overhead low enough to leave on for part of the runs.
+tracemalloc, for the top allocations per stage, is a different
+story: it hooks every allocation, which made the transforms
+several times slower, so it's only on with --profile_allocations.
+The transform workers of the overlapped mode are separate
+processes, so they don't show up here
+"""
+
+import linecache
+import os
+import random
+import resource
+import sys
+import threading
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from src.constants import (
+    PROFILING_INTERVAL_SECONDS,
+    PROFILING_OUTPUT,
+    PROFILING_SAMPLE_RATE,
+    PROFILING_TOP_ALLOCATIONS,
+    PROFILING_TRACE_ALLOCATIONS,
+    PROFILING_TRACEMALLOC_FRAMES,
+)
+from src.helper_functions import get_s3_client
+
+# the profiler of the running task (None = profiling off)
+ACTIVE_PROFILER = None
+
+# what the profiler's own work shows up as in the stacks
+PROFILER_STAGE = "(profiler)"
+
+
+def read_memory_bytes() -> int:
+    """The resident memory of the process right now"""
+    try:
+        with open("/proc/self/statm") as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # not on Linux: the peak so far is the best we have (KB on Linux,
+        # but bytes on macOS, which is where we'd end up here)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def compose_frame_label(frame) -> str:
+    # ";" separates the frames in the folded format, so it can't be in a label
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+
+    return f"{code.co_qualname} ({file_name}:{code.co_firstlineno})".replace(";", ":")
+
+
+class TaskProfiler:
+    def __init__(
+        self,
+        task_name: str,
+        trace_allocations: bool = PROFILING_TRACE_ALLOCATIONS,
+        interval_seconds: float = PROFILING_INTERVAL_SECONDS,
+        tracemalloc_frames: int = PROFILING_TRACEMALLOC_FRAMES,
+    ):
+        """Sample the stacks + trace the memory of one task run"""
+        self.run_name = (
+            f"{task_name}_{datetime.now(timezone.utc):%Y%m%dT%H%M%S}_"
+            f"{uuid.uuid4().hex[:6]}"
+        )
+        self.trace_allocations = trace_allocations
+        self.interval_seconds = interval_seconds
+        self.tracemalloc_frames = tracemalloc_frames
+
+        self.stack_counts = Counter()
+        self.memory_reports = []
+        # thread id -> the stages it's in (outer first), to group the samples
+        self.current_stages = {}
+        # the peak memory (+ traced allocations) of every stage still running
+        self.stage_peaks = {}
+        self.stage_traced_peaks = {}
+
+        self.stop_requested = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        own_thread_id = threading.get_ident()
+
+        while not self.stop_requested.wait(self.interval_seconds):
+            self.update_stage_peaks()
+
+            thread_names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+
+                frame_labels = []
+                while frame is not None:
+                    frame_labels.append(compose_frame_label(frame))
+                    frame = frame.f_back
+
+                stage_names = self.current_stages.get(thread_id) or ["-"]
+                thread_name = thread_names.get(thread_id, str(thread_id))
+                self.stack_counts[
+                    ";".join(stage_names + [thread_name] + frame_labels[::-1])
+                ] += 1
+
+    def start(self) -> None:
+        if self.trace_allocations:
+            tracemalloc.start(self.tracemalloc_frames)
+        self.sampler.start()
+
+    def stop(self) -> None:
+        self.stop_requested.set()
+        self.sampler.join()
+        if self.trace_allocations:
+            tracemalloc.stop()
+
+    def update_stage_peaks(self) -> None:
+        """Hand the memory now (+ traced peak so far) to the running stages"""
+        memory_bytes = read_memory_bytes()
+        for stage_name in list(self.stage_peaks):
+            self.stage_peaks[stage_name] = max(
+                self.stage_peaks.get(stage_name, 0), memory_bytes
+            )
+
+        if not self.trace_allocations:
+            return
+
+        # tracemalloc has one peak for the process, so it's reset every
+        # time (and the stages running keep the max)
+        _, traced_peak_bytes = tracemalloc.get_traced_memory()
+        for stage_name in list(self.stage_traced_peaks):
+            self.stage_traced_peaks[stage_name] = max(
+                self.stage_traced_peaks.get(stage_name, 0), traced_peak_bytes
+            )
+        tracemalloc.reset_peak()
+
+    def enter_stage(self, stage_name: str) -> None:
+        self.update_stage_peaks()
+        self.stage_peaks[stage_name] = read_memory_bytes()
+        self.stage_traced_peaks[stage_name] = 0
+        self.current_stages.setdefault(threading.get_ident(), []).append(stage_name)
+
+    def exit_stage(self, stage_name: str) -> None:
+        self.update_stage_peaks()
+        thread_stages = self.current_stages.setdefault(threading.get_ident(), [])
+        if thread_stages:
+            thread_stages.pop()
+
+        # the snapshot takes a while with lots of objects around, so it's
+        # sampled as its own (profiler) stage rather than hidden in this one
+        thread_stages.append(PROFILER_STAGE)
+        self.record_stage(
+            stage_name,
+            self.stage_peaks.pop(stage_name, 0),
+            self.stage_traced_peaks.pop(stage_name, 0),
+        )
+        thread_stages.pop()
+
+    def record_stage(
+        self, stage_name: str, peak_bytes: int, traced_peak_bytes: int
+    ) -> None:
+        """Note the peak (+ biggest live allocations) at the end of a stage"""
+        report_lines = [
+            f"== {stage_name}: peak {peak_bytes / 1024**2:.1f} MB resident, "
+            f"{read_memory_bytes() / 1024**2:.1f} MB at the end"
+        ]
+
+        if not self.trace_allocations:
+            self.memory_reports.append("\n".join(report_lines))
+            return
+
+        current_bytes, _ = tracemalloc.get_traced_memory()
+        top_allocations = (
+            tracemalloc.take_snapshot()
+            .filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            .statistics("lineno")[:PROFILING_TOP_ALLOCATIONS]
+        )
+
+        report_lines.append(
+            f"   traced: peak {traced_peak_bytes / 1024**2:.1f} MB, "
+            f"{current_bytes / 1024**2:.1f} MB still allocated at the end"
+        )
+        for allocation in top_allocations:
+            frame = allocation.traceback[0]
+            report_lines.append(
+                f"{allocation.size / 1024**2:10.1f} MB {allocation.count:>10} blocks  "
+                f"{frame.filename}:{frame.lineno}  "
+                f"{linecache.getline(frame.filename, frame.lineno).strip()}"
+            )
+
+        self.memory_reports.append("\n".join(report_lines))
+
+    def write_outputs(self) -> None:
+        """Save the folded stacks + memory report where PROFILING_OUTPUT says"""
+        outputs = {
+            "stacks.folded": "".join(
+                f"{stack} {count}\n" for stack, count in self.stack_counts.items()
+            ),
+            "memory_report.txt": "\n\n".join(self.memory_reports) + "\n",
+        }
+
+        for file_name, content in outputs.items():
+            if PROFILING_OUTPUT.startswith("s3://"):
+                bucket_name, _, prefix = PROFILING_OUTPUT[len("s3://") :].partition("/")
+                get_s3_client().put_object(
+                    Bucket=bucket_name,
+                    Key=f"{prefix.rstrip('/')}/{self.run_name}/{file_name}".lstrip("/"),
+                    Body=content.encode("utf-8"),
+                )
+            else:
+                os.makedirs(
+                    os.path.join(PROFILING_OUTPUT, self.run_name), exist_ok=True
+                )
+                with open(
+                    os.path.join(PROFILING_OUTPUT, self.run_name, file_name), "w"
+                ) as file:
+                    file.write(content)
+
+        print(f"Profile written to {PROFILING_OUTPUT}/{self.run_name}")
+
+
+def should_profile(profile_flag: bool) -> bool:
+    """Profile if asked to, or else for a PROFILING_SAMPLE_RATE share of runs"""
+    return profile_flag or random.random() < PROFILING_SAMPLE_RATE
+
+
+@contextmanager
+def profile_task(
+    task_name: str, enabled: bool, trace_allocations: bool = False
+) -> Iterator[Optional[TaskProfiler]]:
+    """Profile everything inside (with the task as the first stage)"""
+    global ACTIVE_PROFILER
+
+    if not enabled:
+        yield None
+        return
+
+    task_profiler = TaskProfiler(
+        task_name, trace_allocations=trace_allocations or PROFILING_TRACE_ALLOCATIONS
+    )
+    ACTIVE_PROFILER = task_profiler
+    task_profiler.start()
+    try:
+        with profile_stage(task_name):
+            yield task_profiler
+    finally:
+        task_profiler.stop()
+        ACTIVE_PROFILER = None
+        # also (especially) when the task failed
+        task_profiler.write_outputs()
+
+
+@contextmanager
+def profile_stage(stage_name: str) -> Iterator[None]:
+    """Group the samples + report the memory of a stage (if profiling)"""
+    task_profiler = ACTIVE_PROFILER
+    if task_profiler is None:
+        yield
+        return
+
+    # the memory is for the whole process, so with the datasets running
+    # next to each other, a stage's peak includes the other dataset's
+    task_profiler.enter_stage(stage_name)
+    try:
+        yield
+    finally:
+        task_profiler.exit_stage(stage_name)
@@ -0,0 +1,110 @@
+"""
+Here we keep the parallel downloader for big raw objects:
+instead of one sequential stream, the object is fetched as
+byte ranges by several threads at once, and handed to the
+reader in order as the ranges come in, so pandas can already
+parse the start of the file while the rest is downloading
+"""
+
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Optional
+
+from src.constants import RANGE_SIZE_BYTES, RANGED_DOWNLOAD_CONCURRENCY
+
+
+class RangedObjectReader(io.RawIOBase):
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        key: str,
+        object_size: int,
+        etag: Optional[str] = None,
+        sink: Optional[BinaryIO] = None,
+        range_size: int = RANGE_SIZE_BYTES,
+        max_concurrency: int = RANGED_DOWNLOAD_CONCURRENCY,
+    ):
+        """Read-only file over an S3 object, downloaded in parallel ranges"""
+        # note: the ranges are glued back together in order before the
+        # parser sees them, so a CSV record (even one with a newline inside
+        # a quoted reviewText) cut in two at a range edge is parsed as if
+        # it was a single stream; we never parse a range on its own
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.sink = sink  # e.g. the download cache file, written as we go
+
+        self.range_starts = deque(range(0, object_size, range_size))
+        self.range_size = range_size
+        self.object_size = object_size
+
+        # at most 2 ranges per thread are kept in memory; if parsing
+        # is slower than downloading, the downloads wait
+        self.max_ranges_in_flight = 2 * max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.ranges_in_flight = deque()
+        self.current_range = memoryview(b"")
+        self.bytes_read = 0
+
+        self._fill_pipeline()
+
+    def _download_range(self, range_start: int) -> bytes:
+        range_end = min(range_start + self.range_size, self.object_size) - 1
+        request_arguments = {
+            "Bucket": self.bucket,
+            "Key": self.key,
+            "Range": f"bytes={range_start}-{range_end}",
+        }
+        if self.etag is not None:
+            # all the ranges have to come from the same version of the object
+            request_arguments["IfMatch"] = self.etag
+
+        return self.s3_client.get_object(**request_arguments)["Body"].read()
+
+    def _fill_pipeline(self) -> None:
+        while (
+            self.range_starts and len(self.ranges_in_flight) < self.max_ranges_in_flight
+        ):
+            self.ranges_in_flight.append(
+                self.executor.submit(self._download_range, self.range_starts.popleft())
+            )
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if len(self.current_range) == 0:
+            if not self.ranges_in_flight:
+                return 0  # end of the object
+
+            # wait for the next range in order (the ones after it
+            # keep downloading in the meantime)
+            self.current_range = memoryview(self.ranges_in_flight.popleft().result())
+            self._fill_pipeline()
+
+            if self.sink is not None:
+                self.sink.write(self.current_range)
+
+        number_of_bytes = min(len(buffer), len(self.current_range))
+        buffer[:number_of_bytes] = self.current_range[:number_of_bytes]
+        self.current_range = self.current_range[number_of_bytes:]
+        self.bytes_read += number_of_bytes
+
+        return number_of_bytes
+
+    @property
+    def completed(self) -> bool:
+        """Whether the whole object went through the reader"""
+        return self.bytes_read == self.object_size
+
+    def close(self) -> None:
+        if not self.closed:
+            for range_in_flight in self.ranges_in_flight:
+                range_in_flight.cancel()
+            self.executor.shutdown(wait=True)
+
+        super().close()
@@ -0,0 +1,113 @@
+"""
+Here we keep the sampling mode for quick dev runs: instead
+of the whole dataset (or hand-editing data_short), only the
+products whose asin hashes below the sample fraction are
+kept, together with their reviews and the related-item
+links between them. Since it's a hash and not a random
+draw, the reviews and the metadata pick the same products
+(and every run picks the same ones), so the joins between
+the sampled tables still line up
+"""
+
+import ast
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+SAMPLE_KEY = "asin"
+
+# the sampled tables load as e.g. products_sample, next to the real ones
+SAMPLE_TABLE_SUFFIX = "_sample"
+
+# a different key than the default one the sharding uses, so the
+# sample isn't made up of the same few shards
+SAMPLE_HASH_KEY = "asin-sampling-v1"
+
+
+class IncorrectSampleFraction(Exception):
+    pass
+
+
+def validate_sample_fraction(sample_fraction: Optional[float]) -> None:
+    """None (no sampling) or within (0, 1]"""
+    if sample_fraction is not None and not 0 < sample_fraction <= 1:
+        raise IncorrectSampleFraction(
+            f"The sample fraction should be in (0, 1], got {sample_fraction}"
+        )
+
+
+def is_sampled(asins: pd.Series, sample_fraction: float) -> np.ndarray:
+    """Whether each asin falls in the sample"""
+    asin_hashes = pd.util.hash_array(
+        asins.astype(str).to_numpy(dtype=object), hash_key=SAMPLE_HASH_KEY
+    )
+
+    # the top 32 bits as a number in [0, 1), times 2**32
+    return (asin_hashes >> np.uint64(32)) < np.uint64(round(sample_fraction * 2**32))
+
+
+def sample_related_items(related: pd.Series, sample_fraction: float) -> pd.Series:
+    """Drop the links to products that aren't in the sample"""
+    related_items = [
+        ast.literal_eval(value) if isinstance(value, str) else None for value in related
+    ]
+
+    # all the linked asins hashed in one go, then handed back out in order
+    linked_asins = [
+        asin
+        for items in related_items
+        if items
+        for linked in items.values()
+        for asin in linked
+    ]
+    kept_links = iter(
+        is_sampled(pd.Series(linked_asins, dtype=object), sample_fraction).tolist()
+    )
+
+    sampled_related = []
+    for items in related_items:
+        # NaN, not None, since the transform checks for str(value) == "nan"
+        if not items:
+            sampled_related.append(np.nan)
+            continue
+
+        sampled_items = {
+            relation: [asin for asin in linked if next(kept_links)]
+            for relation, linked in items.items()
+        }
+        sampled_items = {
+            relation: linked for relation, linked in sampled_items.items() if linked
+        }
+
+        # back to the same literal strings the raw data has
+        sampled_related.append(repr(sampled_items) if sampled_items else np.nan)
+
+    return pd.Series(sampled_related, index=related.index, dtype=object)
+
+
+def sample_records(
+    raw_data: pd.DataFrame, dataset_name: str, sample_fraction: float
+) -> pd.DataFrame:
+    """Keep the records (+ related items) of the sampled products"""
+    sampled_data = raw_data[is_sampled(raw_data[SAMPLE_KEY], sample_fraction)]
+
+    if dataset_name == "metadata":
+        sampled_data = sampled_data.assign(
+            related=sample_related_items(sampled_data["related"], sample_fraction)
+        )
+
+    return sampled_data.reset_index(drop=True)
+
+
+def sample_batches(
+    raw_batches: Iterator[pd.DataFrame],
+    dataset_name: str,
+    sample_fraction: Optional[float],
+) -> Iterator[pd.DataFrame]:
+    """Sample every batch as it's read (or pass them through, with no sample)"""
+    for raw_batch in raw_batches:
+        if sample_fraction is None:
+            yield raw_batch
+        else:
+            yield sample_records(raw_batch, dataset_name, sample_fraction)
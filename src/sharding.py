@@ -0,0 +1,180 @@
+"""
+Here we keep the sharding: one pod per interval means a big
+interval (or backfill) runs on a single node. Instead, N pods
+can each take the records whose key hashes to their shard
+(reviewerID for the reviews, asin for the metadata), and
+a merge step at the end puts the shards back together.
+
+The hash keys are chosen so the fact/product tables never
+share a PK between shards (review_id contains the reviewerID),
+so those are uploaded by the shards directly. Only the
+dimensions that every shard can produce the same rows for
+(e.g. the dates) are held back in the state store and
+deduplicated + uploaded once by the merge
+"""
+
+import os
+import tempfile
+from typing import Dict, Optional
+
+import pandas as pd
+
+from src.checkpoint import restore_missing_values
+from src.load import upload_to_dwh
+from src.load_manifests import LoadManifest
+from src.state_store import StateStore
+
+SHARD_KEYS = {"reviews": "reviewerID", "metadata": "asin"}
+
+# tables that different shards can produce the same rows for
+SHARED_ACROSS_SHARDS = ("date_dimension", "category_tree", "category_closure")
+
+# stands in for "no partition" in the state store paths
+UNPARTITIONED = "_unpartitioned"
+
+
+class IncorrectShardSpecification(Exception):
+    pass
+
+
+class IncompleteShards(Exception):
+    pass
+
+
+def validate_shard_specification(
+    shard_index: Optional[int], shard_count: Optional[int]
+) -> None:
+    """Both or neither, and the index within [0, count)"""
+    if shard_index is None and shard_count is None:
+        return
+
+    if shard_index is None or shard_count is None:
+        raise IncorrectShardSpecification(
+            "Both the shard index and the shard count should be given"
+        )
+
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise IncorrectShardSpecification(
+            f"Incorrect shard: {shard_index} of {shard_count}"
+        )
+
+
+def select_shard(
+    raw_data: pd.DataFrame, dataset_name: str, shard_index: int, shard_count: int
+) -> pd.DataFrame:
+    """Keep the records whose key hashes to the given shard"""
+    # hash_array has a fixed hash key, so every pod (and every run)
+    # puts a record in the same shard, unlike Python's hash()
+    key_hashes = pd.util.hash_array(
+        raw_data[SHARD_KEYS[dataset_name]].astype(str).to_numpy(dtype=object)
+    )
+
+    return raw_data[key_hashes % shard_count == shard_index].reset_index(drop=True)
+
+
+def compose_shard_label(shard_index: int, shard_count: int) -> str:
+    return f"shard{shard_index:03d}of{shard_count:03d}"
+
+
+class ShardOutput:
+    def __init__(
+        self, dataset_name: str, run_key: str, shard_index: int, shard_count: int
+    ):
+        """Where one shard of one run keeps what the merge needs"""
+        self.store = StateStore("shards")
+        self.prefix = f"{run_key}/{dataset_name}"
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_label = compose_shard_label(shard_index, shard_count)
+
+    def shard_partition(self, partition: Optional[str]) -> str:
+        """The partition this shard uploads its part of a table to"""
+        if partition is None:
+            return self.shard_label
+
+        return f"{partition}_{self.shard_label}"
+
+    def hold_back_shared_tables(
+        self, processed_tables: Dict[str, pd.DataFrame], partition: Optional[str]
+    ) -> Dict[str, pd.DataFrame]:
+        """Save the shared tables for the merge, return the rest"""
+        for table_name in SHARED_ACROSS_SHARDS:
+            if table_name not in processed_tables:
+                continue
+
+            with tempfile.TemporaryDirectory() as temp_dir:
+                file_path = os.path.join(temp_dir, "data.parquet")
+                processed_tables[table_name].to_parquet(file_path)
+                self.store.upload_file(
+                    f"{self.prefix}/tables/{partition or UNPARTITIONED}/"
+                    f"{table_name}/{self.shard_label}.parquet",
+                    file_path,
+                )
+
+        return {
+            table_name: table_data
+            for table_name, table_data in processed_tables.items()
+            if table_name not in SHARED_ACROSS_SHARDS
+        }
+
+    def mark_completed(self) -> None:
+        """Tell the merge this shard is done"""
+        self.store.write_json(
+            f"{self.prefix}/completed/{self.shard_label}.json",
+            {"shard_index": self.shard_index, "shard_count": self.shard_count},
+        )
+
+
+def merge_shard_outputs(
+    dataset_name: str,
+    run_key: str,
+    shard_count: int,
+    upload_to: str,
+    manifest: Optional[LoadManifest] = None,
+) -> None:
+    """Deduplicate + upload the shared tables once all shards are done"""
+    store = StateStore("shards")
+    prefix = f"{run_key}/{dataset_name}"
+
+    completed_shards = store.list_names(f"{prefix}/completed/")
+    if len(completed_shards) != shard_count:
+        raise IncompleteShards(
+            f"{len(completed_shards)} of the {shard_count} {dataset_name} "
+            f"shards of {run_key} completed"
+        )
+
+    # <prefix>/tables/<partition>/<table>/<shard>.parquet
+    shard_files = {}
+    for name in store.list_names(f"{prefix}/tables/"):
+        partition, table_name = name.split("/")[-3:-1]
+        shard_files.setdefault((partition, table_name), []).append(name)
+
+    for (partition, table_name), names in sorted(shard_files.items()):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_tables = []
+            for name in names:
+                file_path = os.path.join(temp_dir, os.path.basename(name))
+                store.download_file(name, file_path)
+                shard_tables.append(restore_missing_values(pd.read_parquet(file_path)))
+
+        # the shared dimensions are derived from their key only (e.g. the
+        # date), so the copies from different shards are identical rows
+        merged_table = pd.concat(shard_tables).drop_duplicates().reset_index(drop=True)
+
+        upload_to_dwh(
+            merged_table,
+            table_name,
+            upload_to=upload_to,
+            partition=None if partition == UNPARTITIONED else partition,
+            manifest=manifest,
+        )
+
+    # the shard state stays until every dataset is merged (see
+    # delete_shard_outputs), so re-running a merge that failed halfway
+    # finds all the shards again and just uploads the same files again
+    print(f"Merged the {shard_count} shards of {dataset_name} ({run_key})")
+
+
+def delete_shard_outputs(dataset_name: str, run_key: str) -> None:
+    """Clean up the shard state of a run (once it's all merged)"""
+    StateStore("shards").delete(f"{run_key}/{dataset_name}/")
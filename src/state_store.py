@@ -0,0 +1,198 @@
+"""
+Here we keep a tiny store for the state the pipeline
+needs to remember between runs (e.g. backfill progress).
+It's either a folder on the local disk or a prefix in
+the S3 bucket, with the same interface for both
+"""
+
+import json
+import os
+import shutil
+import uuid
+from typing import List, Optional
+
+from botocore.exceptions import ClientError
+
+from src.constants import (
+    S3_BUCKET_NAME,
+    STATE_LOCAL_DIRECTORY,
+    STATE_LOCATION,
+    STATE_S3_PREFIX,
+)
+from src.helper_functions import get_s3_client
+
+
+class IncorrectStateLocation(Exception):
+    pass
+
+
+class StateStore:
+    def __init__(self, namespace: str, location: str = STATE_LOCATION):
+        """Save where the state lives: local folder or S3 prefix"""
+        if location not in ("local", "s3"):
+            raise IncorrectStateLocation(
+                "State location should be either 'local' or 's3'"
+            )
+
+        self.namespace = namespace
+        self.location = location
+
+    def _local_path(self, name: str) -> str:
+        return os.path.join(STATE_LOCAL_DIRECTORY, self.namespace, name)
+
+    def _s3_key(self, name: str) -> str:
+        return f"{STATE_S3_PREFIX}/{self.namespace}/{name}"
+
+    def exists(self, name: str) -> bool:
+        """Check if a state file exists"""
+        if self.location == "local":
+            return os.path.exists(self._local_path(name))
+
+        try:
+            get_s3_client().head_object(Bucket=S3_BUCKET_NAME, Key=self._s3_key(name))
+        except ClientError:
+            return False
+
+        return True
+
+    def read_json(self, name: str, default: Optional[dict] = None) -> Optional[dict]:
+        """Read a JSON state file, or return the default if missing"""
+        if not self.exists(name):
+            return default
+
+        if self.location == "local":
+            with open(self._local_path(name), "r") as file:
+                return json.load(file)
+
+        response = get_s3_client().get_object(
+            Bucket=S3_BUCKET_NAME, Key=self._s3_key(name)
+        )
+
+        return json.loads(response["Body"].read())
+
+    def write_json(self, name: str, content: dict) -> None:
+        """Write a JSON state file (overwrites)"""
+        if self.location == "local":
+            path = self._local_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # write + rename, so a crash never leaves half a file behind
+            with open(path + ".tmp", "w") as file:
+                json.dump(content, file)
+            os.replace(path + ".tmp", path)
+
+        else:
+            get_s3_client().put_object(
+                Bucket=S3_BUCKET_NAME,
+                Key=self._s3_key(name),
+                Body=json.dumps(content).encode("utf-8"),
+            )
+
+    def upload_file(self, name: str, file_path: str) -> None:
+        """Save a (binary) file into the store"""
+        if self.location == "local":
+            path = self._local_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.abspath(path) != os.path.abspath(file_path):
+                shutil.copyfile(file_path, path)
+        else:
+            get_s3_client().upload_file(file_path, S3_BUCKET_NAME, self._s3_key(name))
+
+    def create_file(self, name: str, file_path: str) -> bool:
+        """Save a file only if the name is free, return False if it's taken"""
+        # atomic in both places, so of two runs creating the same name
+        # exactly one succeeds (e.g. for append-only state)
+        if self.location == "local":
+            path = self._local_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            shutil.copyfile(file_path, temp_path)
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                return False
+            finally:
+                os.remove(temp_path)
+
+            return True
+
+        try:
+            with open(file_path, "rb") as file:
+                get_s3_client().put_object(
+                    Bucket=S3_BUCKET_NAME,
+                    Key=self._s3_key(name),
+                    Body=file,
+                    IfNoneMatch="*",
+                )
+        except ClientError as error:
+            # 409: another conditional write to the same key is in flight
+            if error.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                return False
+            raise
+
+        return True
+
+    def download_file(self, name: str, file_path: str) -> bool:
+        """Copy a file out of the store, return False if it's missing"""
+        if not self.exists(name):
+            return False
+
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+
+        if self.location == "local":
+            if os.path.abspath(self._local_path(name)) != os.path.abspath(file_path):
+                shutil.copyfile(self._local_path(name), file_path)
+        else:
+            get_s3_client().download_file(S3_BUCKET_NAME, self._s3_key(name), file_path)
+
+        return True
+
+    def list_names(self, prefix: str = "") -> List[str]:
+        """List the state files under a prefix (relative names)"""
+        if self.location == "local":
+            root = self._local_path("")
+            if not os.path.exists(root):
+                return []
+
+            names = []
+            for directory, _, file_names in os.walk(root):
+                for file_name in file_names:
+                    relative_path = os.path.relpath(
+                        os.path.join(directory, file_name), root
+                    ).replace(os.sep, "/")
+                    if relative_path.startswith(prefix):
+                        names.append(relative_path)
+
+            return sorted(names)
+
+        root_key = self._s3_key("")
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        names = []
+        for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=root_key + prefix):
+            names += [item["Key"][len(root_key) :] for item in page.get("Contents", [])]
+
+        return sorted(names)
+
+    def delete(self, prefix: str = "") -> None:
+        """Delete every state file under a prefix"""
+        names = self.list_names(prefix)
+
+        if self.location == "local":
+            for name in names:
+                os.remove(self._local_path(name))
+            return
+
+        # delete_objects takes at most 1000 keys at a time
+        for batch_start in range(0, len(names), 1000):
+            get_s3_client().delete_objects(
+                Bucket=S3_BUCKET_NAME,
+                Delete={
+                    "Objects": [
+                        {"Key": self._s3_key(name)}
+                        for name in names[batch_start : batch_start + 1000]
+                    ]
+                },
+            )
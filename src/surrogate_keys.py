@@ -0,0 +1,211 @@
+"""
+Here we keep the surrogate keys: all the tables join on long
+strings (asin, reviewerID, and review_id = asin + reviewerID),
+which is heavy to store and slow to join on. Instead, every
+string key gets an integer (its position in an append-only
+key dictionary, kept in the state store), so:
+  - the same asin gets the same item_key in every run
+  - the fact + bridge tables carry only the integer keys
+  - the dimensions keep the string key next to the integer one,
+    so it's still there to look things up/decode
+
+The dictionary is stored as numbered segments, one per save with
+just the keys that save added. A segment is only written if its
+number is still free, so when two runs overlap only one of them
+can claim the next ids, and the other fails before loading
+anything (the retry then starts from the new segment). Every so
+many segments a snapshot of all of them is written too, so a run
+reads one snapshot + a few segments instead of the whole history
+"""
+
+import os
+import re
+import tempfile
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.extract import import_surrogate_key_schemas
+from src.state_store import StateStore
+
+SURROGATE_KEY_SCHEMAS = import_surrogate_key_schemas()
+
+# the reviews + metadata pipelines share the item dictionary from two
+# threads, so there's one instance per dictionary in the process
+KEY_DICTIONARIES: Dict[str, "KeyDictionary"] = {}
+KEY_DICTIONARIES_LOCK = threading.Lock()
+
+# a snapshot of all segments so far gets written every this many segments
+SNAPSHOT_EVERY_SEGMENTS = 50
+
+STORED_FILE_PATTERN = re.compile(r"(segment|snapshot)_(\d{8})\.parquet")
+
+
+class KeyDictionaryConflict(Exception):
+    pass
+
+
+class KeyDictionary:
+    def __init__(self, name: str):
+        """Load the dictionary (string key -> position) of previous runs"""
+        self.name = name
+        self.store = StateStore("surrogate_keys")
+        self.lock = threading.Lock()
+
+        snapshots, segments = self._list_stored_files()
+
+        # segment numbers are claimed one by one, so a gap means a lost file
+        if segments != list(range(len(segments))):
+            raise KeyDictionaryConflict(
+                f"The {name} key dictionary is missing segments"
+            )
+
+        # the latest snapshot covers every segment up to its number
+        loaded_files = []
+        if snapshots:
+            loaded_files.append(f"snapshot_{snapshots[-1]:08d}.parquet")
+        loaded_files += [
+            f"segment_{segment_number:08d}.parquet"
+            for segment_number in segments
+            if not snapshots or segment_number > snapshots[-1]
+        ]
+
+        self.keys = pd.Index(
+            [key for file_name in loaded_files for key in self._read_keys(file_name)],
+            dtype=object,
+        )
+        self.segment_count = len(segments)
+        self.saved_size = len(self.keys)
+
+    def _list_stored_files(self) -> Tuple[List[int], List[int]]:
+        snapshots, segments = [], []
+        for name in self.store.list_names(f"{self.name}/"):
+            matched = STORED_FILE_PATTERN.fullmatch(name[len(self.name) + 1 :])
+            if matched is None:
+                continue  # e.g. a half written temporary file
+
+            (snapshots if matched[1] == "snapshot" else segments).append(
+                int(matched[2])
+            )
+
+        return sorted(snapshots), sorted(segments)
+
+    def _read_keys(self, file_name: str) -> List[str]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, file_name)
+            self.store.download_file(f"{self.name}/{file_name}", file_path)
+
+            return pd.read_parquet(file_path)["key"].tolist()
+
+    def _write_keys(self, file_name: str, keys: pd.Index) -> bool:
+        """Write keys to a new file, return False if the file already exists"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, file_name)
+            pd.DataFrame({"key": keys}).to_parquet(file_path, index=False)
+
+            return self.store.create_file(f"{self.name}/{file_name}", file_path)
+
+    def encode(self, values: pd.Series) -> np.ndarray:
+        """String keys -> integer keys (new ones are appended, -1 = missing)"""
+        with self.lock:
+            key_ids = self.keys.get_indexer(values)
+
+            new_keys = pd.unique(values[(key_ids == -1) & values.notna().to_numpy()])
+            if len(new_keys) > 0:
+                # only ever appended, so the existing ids never change
+                self.keys = self.keys.append(pd.Index(new_keys, dtype=object))
+                key_ids = self.keys.get_indexer(values)
+
+        return key_ids
+
+    def decode(self, key_ids: np.ndarray) -> np.ndarray:
+        """Integer keys -> string keys"""
+        return self.keys.to_numpy()[key_ids]
+
+    def save(self) -> None:
+        """Save the keys added since the last save, as the next segment"""
+        with self.lock:
+            if len(self.keys) == self.saved_size:
+                return
+
+            # only if no one else saved in the meantime: if they did, their
+            # new keys got the same ids as ours, so ours can't be used
+            if not self._write_keys(
+                f"segment_{self.segment_count:08d}.parquet",
+                self.keys[self.saved_size :],
+            ):
+                raise KeyDictionaryConflict(
+                    f"The {self.name} key dictionary changed since it was loaded "
+                    f"({self.saved_size} keys), another run must have added keys"
+                )
+
+            self.segment_count += 1
+            self.saved_size = len(self.keys)
+
+            if self.segment_count % SNAPSHOT_EVERY_SEGMENTS == 0:
+                # created like a segment, so it's never read half written
+                self._write_keys(
+                    f"snapshot_{self.segment_count - 1:08d}.parquet", self.keys
+                )
+
+
+def get_key_dictionary(name: str) -> KeyDictionary:
+    """Get the (shared) key dictionary with the given name"""
+    with KEY_DICTIONARIES_LOCK:
+        if name not in KEY_DICTIONARIES:
+            KEY_DICTIONARIES[name] = KeyDictionary(name)
+
+        return KEY_DICTIONARIES[name]
+
+
+def add_surrogate_keys(target_df: pd.DataFrame, key_schema: dict) -> pd.DataFrame:
+    """Add the integer key columns (+ drop the strings, if so specified)"""
+    target_df = target_df.copy()
+
+    for string_key_column, key_specification in key_schema.items():
+        key_ids = get_key_dictionary(key_specification["key_dictionary"]).encode(
+            target_df[string_key_column]
+        )
+        # nullable, since e.g. the deleted rows of CDC tables may miss keys
+        key_ids = pd.array(key_ids, dtype="Int64")
+        key_ids[key_ids == -1] = pd.NA
+
+        # the integer key goes where the string key was/right in front of it
+        target_df.insert(
+            target_df.columns.get_loc(string_key_column),
+            key_specification["key_column"],
+            key_ids,
+        )
+        if not key_specification["keep_string_key"]:
+            target_df.drop(columns=string_key_column, inplace=True)
+
+    return target_df
+
+
+def assign_surrogate_keys(
+    processed_tables: Dict[str, pd.DataFrame]
+) -> Dict[str, pd.DataFrame]:
+    """Add the surrogate keys to every table that has a key schema"""
+    keyed_tables = {}
+
+    for table_name, table_data in processed_tables.items():
+        # CDC tables (<table>_changes) are keyed like the table itself
+        key_schema = SURROGATE_KEY_SCHEMAS.get(table_name.removesuffix("_changes"))
+
+        keyed_tables[table_name] = (
+            add_surrogate_keys(table_data, key_schema)
+            if key_schema is not None
+            else table_data
+        )
+
+    # saved right away (not after the load like CDC): a table loaded
+    # with keys that weren't saved would clash with the next run's keys
+    with KEY_DICTIONARIES_LOCK:
+        key_dictionaries = list(KEY_DICTIONARIES.values())
+
+    for key_dictionary in key_dictionaries:
+        key_dictionary.save()
+
+    return keyed_tables
@@ -0,0 +1,161 @@
+"""
+Here we keep the out-of-line text store: reviewText, summary
+and description are most of the bytes of the fact/product
+tables, yet no transform touches them. With this on, they are
+taken out of the raw data before the transforms, and written
+into a separate compressed store instead:
+  - <column>.blocks: the texts, glued together and compressed
+    in ~1 MB zstd blocks
+  - <column>.index.parquet: per key, which block + where in it
+so the tables stay narrow, and a single text can still be read
+without decompressing everything
+"""
+
+import mmap
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.compression import UnsupportedCompression, zstandard
+from src.extract import import_text_store_schemas
+
+TEXT_STORE_SCHEMAS = import_text_store_schemas()
+
+TEXT_BLOCK_SIZE_BYTES = 1024**2
+
+
+def compose_text_keys(raw_data: pd.DataFrame, key_columns: List[str]) -> pd.Series:
+    """Build the key of every row (e.g. review_id = asin + reviewerID)"""
+    text_keys = raw_data[key_columns[0]].astype(str)
+    for key_column in key_columns[1:]:
+        text_keys = text_keys + raw_data[key_column].astype(str)
+
+    return text_keys
+
+
+def write_text_column(
+    text_keys: pd.Series,
+    texts: pd.Series,
+    key_name: str,
+    output_path_prefix: str,
+    block_size_bytes: int = TEXT_BLOCK_SIZE_BYTES,
+) -> List[str]:
+    """Write one text column as compressed blocks + an index"""
+    if zstandard is None:
+        raise UnsupportedCompression("The text store needs zstandard")
+
+    encoded_texts = texts.fillna("").astype(str).str.encode("utf-8").to_numpy()
+    text_lengths = np.fromiter(
+        (len(text) for text in encoded_texts), dtype="int64", count=len(encoded_texts)
+    )
+
+    # where each text starts if all of them were glued together; every
+    # text goes (whole) into the block its start falls in
+    text_starts = np.cumsum(text_lengths) - text_lengths
+    block_numbers = text_starts // block_size_bytes
+    block_numbers, first_rows = np.unique(block_numbers, return_index=True)
+    row_block = np.repeat(
+        np.arange(len(block_numbers)), np.diff(np.append(first_rows, len(text_lengths)))
+    )
+
+    compressor = zstandard.ZstdCompressor(level=3)
+    block_offsets = np.zeros(len(block_numbers), dtype="int64")
+    block_lengths = np.zeros(len(block_numbers), dtype="int64")
+    block_boundaries = np.append(first_rows, len(text_lengths))
+
+    with open(output_path_prefix + ".blocks", "wb") as blocks_file:
+        for block_index in range(len(block_numbers)):
+            block_rows = encoded_texts[
+                block_boundaries[block_index] : block_boundaries[block_index + 1]
+            ]
+            compressed_block = compressor.compress(b"".join(block_rows))
+
+            block_offsets[block_index] = blocks_file.tell()
+            block_lengths[block_index] = len(compressed_block)
+            blocks_file.write(compressed_block)
+
+    text_index = pd.DataFrame(
+        {
+            key_name: text_keys.to_numpy(),
+            "block_offset": block_offsets[row_block],
+            "block_length": block_lengths[row_block],
+            "offset": text_starts - text_starts[first_rows][row_block],
+            # -1 marks a missing text (vs. an empty one)
+            "length": np.where(texts.isna().to_numpy(), -1, text_lengths),
+        }
+    )
+    text_index.to_parquet(output_path_prefix + ".index.parquet", index=False)
+
+    return [output_path_prefix + ".blocks", output_path_prefix + ".index.parquet"]
+
+
+def move_text_out_of_line(
+    raw_data: pd.DataFrame, dataset_name: str, output_directory: str
+) -> Tuple[pd.DataFrame, List[str]]:
+    """Write the text columns to the store, return (narrow data, store files)"""
+    text_store_schema = TEXT_STORE_SCHEMAS[dataset_name]
+    text_keys = compose_text_keys(raw_data, text_store_schema["key_columns"])
+
+    store_files = []
+    for text_column in text_store_schema["text_columns"]:
+        store_files += write_text_column(
+            text_keys,
+            raw_data[text_column],
+            key_name=text_store_schema["key_name"],
+            output_path_prefix=os.path.join(output_directory, text_column),
+        )
+
+    narrow_data = raw_data.drop(columns=text_store_schema["text_columns"])
+
+    return narrow_data, store_files
+
+
+class TextStoreReader:
+    def __init__(self, store_directory: str, text_column: str, key_name: str):
+        """Look texts up in a (downloaded) text store column"""
+        if zstandard is None:
+            raise UnsupportedCompression("The text store needs zstandard")
+
+        self.text_index = pd.read_parquet(
+            os.path.join(store_directory, text_column + ".index.parquet")
+        ).set_index(key_name)
+
+        with open(os.path.join(store_directory, text_column + ".blocks"), "rb") as file:
+            # the blocks are memory-mapped, so only the ones we read get loaded
+            self.blocks = (
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(file.fileno()).st_size > 0
+                else b""
+            )
+
+        self.decompressor = zstandard.ZstdDecompressor()
+        self._cached_block: Dict[int, bytes] = {}
+
+    def _read_block(self, block_offset: int, block_length: int) -> bytes:
+        if block_offset not in self._cached_block:
+            # keep one block around, lookups are often close to each other
+            self._cached_block = {
+                block_offset: self.decompressor.decompress(
+                    self.blocks[block_offset : block_offset + block_length]
+                )
+            }
+
+        return self._cached_block[block_offset]
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the text of a key (None if it was missing)"""
+        location = self.text_index.loc[key]
+        if isinstance(location, pd.DataFrame):
+            location = location.iloc[0]  # duplicated key, same text anyway
+
+        if location["length"] < 0:
+            return None
+
+        block = self._read_block(
+            int(location["block_offset"]), int(location["block_length"])
+        )
+        offset = int(location["offset"])
+
+        return block[offset : offset + int(location["length"])].decode("utf-8")
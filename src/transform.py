@@ -2,20 +2,32 @@
 Here we keep the transform functions, where
 we'll do all the data processing, including splitting
 the raw data into the eventual tables that we'll use
+
+Every table (+ every step more than one table needs, e.g.
+parsing the dates) is its own named step, computed only
+when a table that needs it is asked for, so e.g. reloading
+just the products doesn't go through the (slow) categories
+and related items
 """
 
+from typing import Callable, Dict, List, Optional
+
 import pandas as pd
 
 from src.data_processing_functions import (
     add_date_string_column,
+    compose_review_ids,
     convert_data_types,
+    parse_review_dates,
+    parse_review_helpfulness,
     process_categories,
+    process_category_tree,
     process_nulls,
     process_products,
     process_related_items,
-    process_reviews_raw_columns,
     process_sales_ranks,
 )
+from src.external_dedup import drop_duplicates_external
 from src.extract import (
     import_column_data_type_schemas,
     import_column_renaming_schemas,
@@ -27,13 +39,87 @@ COLUMN_DATA_TYPE_SCHEMAS = import_column_data_type_schemas()
 NULL_HANDLING_SCHEMAS = import_null_handling_schemas()
 
 
-def transform_reviews_data(reviews: pd.DataFrame) -> dict:
-    """Transform (clean) raw data"""
-    # first we clean the data (convert the date to the right format)
-    # and retrieve the helpfulness
-    # then we handle nulls
-    # finally we split the data and return the different bits as a dict
+class IncorrectTablesSpecified(Exception):
+    pass
+
+
+def keep_present_columns(schema: dict, target_df: pd.DataFrame) -> dict:
+    """Drop the schema entries of columns the table doesn't have"""
+    # the text columns are missing when they're stored out of line
+    return {
+        column_name: column_schema
+        for column_name, column_schema in schema.items()
+        if column_name in target_df.columns
+    }
+
+
+def clean_table(
+    target_data: pd.DataFrame, schema_name: str, present_columns_only: bool = False
+) -> pd.DataFrame:
+    """Handle the nulls, then cast the dtypes of one table"""
+    # handle nulls (only doable easily before transforming the data)
+    # normally it'd be more memory efficient to leave Nulls as nulls
+    # but this makes the data "unfriendlier", because in some query
+    # engines aggregations functions treat nulls differently, results
+    # may be incomplete, etc., leading to confusion and errors.
+    # For this reason I prefer to just write "UNKNOWN" and then the
+    # analysts/scientists can more quickly grasp the data (even at
+    # the cost of extra database storage <- this trade-off should be
+    # discussed with the managers, team, etc.)
+
+    # if PKs are missing, then we drop the entire row
+    # because it's probably corrupt data. Under normal
+    # circumstances I'd go looking for why/where the data
+    # is missing and try to fix it, but in this case we have
+    # neat PKs for our dataset as far as I could tell (i.e. no nulls)
+
+    nulls_handling = NULL_HANDLING_SCHEMAS[schema_name]
+    data_type_schema = COLUMN_DATA_TYPE_SCHEMAS[schema_name]
+    if present_columns_only:
+        nulls_handling = keep_present_columns(nulls_handling, target_data)
+        data_type_schema = keep_present_columns(data_type_schema, target_data)
+
+    target_data = process_nulls(target_data=target_data, nulls_handling=nulls_handling)
+
+    return convert_data_types(target_df=target_data, data_type_schema=data_type_schema)
+
+
+class LazyTables:
+    def __init__(self, steps: Dict[str, Callable[["LazyTables"], object]]):
+        """Named steps, each run the first time something asks for it"""
+        self.steps = steps
+        self.results = {}
+
+    def __getitem__(self, step_name: str):
+        # every step runs at most once, however many tables need it
+        if step_name not in self.results:
+            self.results[step_name] = self.steps[step_name](self)
+
+        return self.results[step_name]
+
+
+def compute_tables(
+    steps: Dict[str, Callable[[LazyTables], object]],
+    output_tables: List[str],
+    tables: Optional[List[str]] = None,
+) -> dict:
+    """Run the steps the requested tables (all of them by default) need"""
+    unknown_tables = set(tables or []) - set(output_tables)
+    if unknown_tables:
+        raise IncorrectTablesSpecified(
+            f"Unknown tables: {', '.join(sorted(unknown_tables))}"
+        )
 
+    lazy_tables = LazyTables(steps)
+
+    return {
+        table_name: lazy_tables[table_name]
+        for table_name in output_tables
+        if tables is None or table_name in tables
+    }
+
+
+def build_reviews_fact_table(steps: LazyTables) -> pd.DataFrame:
     # debate: it's safer to perform operations on a copy of the DF
     # such that the function can easily retry if needed, because
     # saving a copy means we keep the raw intact. On the other hand,
@@ -51,49 +137,68 @@ def transform_reviews_data(reviews: pd.DataFrame) -> dict:
     # Note: this will result to a lot of annoying warnings for
     # SettingWithCopyWarning
 
-    reviews = process_reviews_raw_columns(reviews)
+    # the columns below are added in place, so any of them works
+    steps["review_dates"]
+    steps["review_helpfulness"]
+    reviews = steps["review_ids"]
 
-    # split the data
     reviews_fact_table = reviews[
         [
-            "review_id",  # note: this list could also be a schema/in constants
-            "reviewerID",
-            "asin",
-            "reviewText",
-            "summary",
-            "overall",
-            "count_review_helpful_yes",
-            "count_review_helpful_no",
-            "unixReviewTime",
-            "review_date_parsed_as_int",
+            column_name
+            for column_name in [
+                "review_id",  # note: this list could also be a schema/in constants
+                "reviewerID",
+                "asin",
+                "reviewText",
+                "summary",
+                "overall",
+                "count_review_helpful_yes",
+                "count_review_helpful_no",
+                "unixReviewTime",
+                "review_date_parsed_as_int",
+            ]
+            if column_name in reviews.columns  # text may be stored out of line
         ]
     ].copy()
 
-    reviewers = reviews[["reviewerID"]].copy()
+    reviews_fact_table.rename(
+        columns=COLUMN_RENAMING_SCHEMAS["reviews_fact_table"], inplace=True
+    )
+
+    return clean_table(
+        reviews_fact_table, "reviews_fact_table", present_columns_only=True
+    )
+
+
+def build_reviewers(steps: LazyTables) -> pd.DataFrame:
+    reviewers = steps["reviews"][["reviewerID"]].copy()
+
+    # drop random duplicates (spilling to disk if there are too many rows)
+    reviewers = drop_duplicates_external(reviewers)
+    reviewers.rename(columns=COLUMN_RENAMING_SCHEMAS["reviewers"], inplace=True)
 
-    reviewer_user_names = reviews[["reviewerID", "reviewerName"]].copy()
+    return clean_table(reviewers, "reviewers")
 
-    date_dimension = reviews[["review_date_parsed_as_int"]].copy()
 
-    # drop random duplicates
-    reviewers.drop_duplicates(inplace=True)
-    reviewer_user_names.drop_duplicates(inplace=True)
-    date_dimension.drop_duplicates(inplace=True)
+def build_reviewer_user_names(steps: LazyTables) -> pd.DataFrame:
+    reviewer_user_names = steps["reviews"][["reviewerID", "reviewerName"]].copy()
 
     # Note: normally you'd specify the cols to find dups on, but in this
     # case it can be all; I've found multiple user_names to each
     # reviewer, which is why I decided to split the data into
     # two tables
-
-    # now rename the columns
-
-    reviews_fact_table.rename(
-        columns=COLUMN_RENAMING_SCHEMAS["reviews_fact_table"], inplace=True
-    )
-    reviewers.rename(columns=COLUMN_RENAMING_SCHEMAS["reviewers"], inplace=True)
+    reviewer_user_names = drop_duplicates_external(reviewer_user_names)
     reviewer_user_names.rename(
         columns=COLUMN_RENAMING_SCHEMAS["reviewer_user_names"], inplace=True
     )
+
+    return clean_table(reviewer_user_names, "reviewer_user_names")
+
+
+def build_date_dimension(steps: LazyTables) -> pd.DataFrame:
+    date_dimension = steps["review_dates"][["review_date_parsed_as_int"]].copy()
+
+    date_dimension = drop_duplicates_external(date_dimension)
     date_dimension.rename(
         columns=COLUMN_RENAMING_SCHEMAS["date_dimension"], inplace=True
     )
@@ -101,119 +206,97 @@ def transform_reviews_data(reviews: pd.DataFrame) -> dict:
     # add the date_string_column to date_dimension now
     date_dimension = add_date_string_column(date_dimension)
 
-    # handle nulls (only doable easily before transforming the data)
-    # normally it'd be more memory efficient to leave Nulls as nulls
-    # but this makes the data "unfriendlier", because in some query
-    # engines aggregations functions treat nulls differently, results
-    # may be incomplete, etc., leading to confusion and errors.
-    # For this reason I prefer to just write "UNKNOWN" and then the
-    # analysts/scientists can more quickly grasp the data (even at
-    # the cost of extra database storage <- this trade-off should be
-    # discussed with the managers, team, etc.)
-
-    # if PKs are missing, then we drop the entire row
-    # because it's probably corrupt data. Under normal
-    # circumstances I'd go looking for why/where the data
-    # is missing and try to fix it, but in this case we have
-    # neat PKs for our dataset as far as I could tell (i.e. no nulls)
-
-    reviews_fact_table = process_nulls(
-        target_data=reviews_fact_table,
-        nulls_handling=NULL_HANDLING_SCHEMAS["reviews_fact_table"],
-    )
-    reviewers = process_nulls(
-        target_data=reviewers, nulls_handling=NULL_HANDLING_SCHEMAS["reviewers"]
-    )
-    reviewer_user_names = process_nulls(
-        target_data=reviewer_user_names,
-        nulls_handling=NULL_HANDLING_SCHEMAS["reviewer_user_names"],
-    )
-    date_dimension = process_nulls(
-        target_data=date_dimension,
-        nulls_handling=NULL_HANDLING_SCHEMAS["date_dimension"],
-    )
+    return clean_table(date_dimension, "date_dimension")
 
-    # finally convert the data types
 
-    reviews_fact_table = convert_data_types(
-        target_df=reviews_fact_table,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["reviews_fact_table"],
-    )
-    reviewers = convert_data_types(
-        target_df=reviewers, data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["reviewers"]
-    )
-    reviewer_user_names = convert_data_types(
-        target_df=reviewer_user_names,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["reviewer_user_names"],
-    )
-    date_dimension = convert_data_types(
-        target_df=date_dimension,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["date_dimension"],
-    )
+# the raw data itself is the "reviews" step, the rest parse raw columns
+REVIEWS_STEPS = {
+    "review_dates": lambda steps: parse_review_dates(steps["reviews"]),
+    "review_helpfulness": lambda steps: parse_review_helpfulness(steps["reviews"]),
+    "review_ids": lambda steps: compose_review_ids(steps["reviews"]),
+    "reviews_fact_table": build_reviews_fact_table,
+    "reviewers": build_reviewers,
+    "reviewers_user_names": build_reviewer_user_names,
+    "date_dimension": build_date_dimension,
+}
 
-    # finally fill missing data/NaNs
+REVIEWS_TABLES = [
+    "reviews_fact_table",
+    "reviewers",
+    "reviewers_user_names",
+    "date_dimension",
+]
 
-    # it's also suboptimal to try to plug the NaNs after we've already
-    # converted the data. I should've thought this through a bit better
 
-    result_dict = {
-        "reviews_fact_table": reviews_fact_table,
-        "reviewers": reviewers,
-        "reviewers_user_names": reviewer_user_names,
-        "date_dimension": date_dimension,
-    }
+def transform_reviews_data(
+    reviews: pd.DataFrame, tables: Optional[List[str]] = None
+) -> dict:
+    """Transform (clean) raw data into the requested tables (default: all)"""
+    # first we clean the data (convert the date to the right format)
+    # and retrieve the helpfulness, but only what the tables need
+    # then we split the data, handle nulls + dtypes per table
+    # finally we return the different bits as a dict
+    result_dict = compute_tables(
+        {**REVIEWS_STEPS, "reviews": lambda steps: reviews}, REVIEWS_TABLES, tables
+    )
 
     print("Reviews data successfully processed")
 
     return result_dict
 
 
-def transform_metadata(metadata: pd.DataFrame) -> dict:
-    """Transform the metadata into the various datasets"""
-    # this dataset needs no pre-processing of columns,
-    # so we can go straight to splitting the data
-
-    products = metadata[["asin", "title", "brand", "description", "price"]].copy()
-
-    product_images = metadata[
+def build_products(steps: LazyTables) -> pd.DataFrame:
+    metadata = steps["metadata"]
+    products = metadata[
         [
-            "asin",
-            "imurl",
+            column_name
+            for column_name in ["asin", "title", "brand", "description", "price"]
+            if column_name in metadata.columns  # text may be stored out of line
         ]
     ].copy()
 
-    product_sales_ranking = metadata[["asin", "salesrank"]].copy()
-
-    product_categories = metadata[["asin", "categories"]].copy()
-
-    product_related_items = metadata[
-        ["asin", "related"]
-    ].copy()  # this one we'll split further later on
+    products = process_products(products)
+    products.rename(columns=COLUMN_RENAMING_SCHEMAS["products"], inplace=True)
 
-    # there are no duplicates to drop here (we checked in
-    # the preliminary analysis and the validations will
-    # let us know if something snuck in lol)
+    return clean_table(products, "products", present_columns_only=True)
 
-    # the data is split, so we can process it now
-    products = process_products(products)
-    product_sales_ranking = process_sales_ranks(product_sales_ranking)
-    product_categories = process_categories(product_categories)
-    product_bought_together, product_also_viewed = process_related_items(
-        product_related_items
-    )
 
-    # now renaming (a bit too much repeating myself here,
-    # in a future version I'd use a list + for loop
-    products.rename(columns=COLUMN_RENAMING_SCHEMAS["products"], inplace=True)
+def build_product_images(steps: LazyTables) -> pd.DataFrame:
+    product_images = steps["metadata"][["asin", "imurl"]].copy()
     product_images.rename(
         columns=COLUMN_RENAMING_SCHEMAS["product_images"], inplace=True
     )
+
+    return clean_table(product_images, "product_images")
+
+
+def build_product_sales_ranking(steps: LazyTables) -> pd.DataFrame:
+    product_sales_ranking = process_sales_ranks(
+        steps["metadata"][["asin", "salesrank"]].copy()
+    )
     product_sales_ranking.rename(
         columns=COLUMN_RENAMING_SCHEMAS["product_sales_ranking"], inplace=True
     )
+
+    return clean_table(product_sales_ranking, "product_sales_ranking")
+
+
+def build_product_categories(steps: LazyTables) -> pd.DataFrame:
+    product_categories = process_categories(
+        steps["metadata"][["asin", "categories"]].copy()
+    )
     product_categories.rename(
         columns=COLUMN_RENAMING_SCHEMAS["product_categories"], inplace=True
     )
+
+    return clean_table(product_categories, "product_categories")
+
+
+def build_related_items(steps: LazyTables) -> tuple:
+    # this one we split further, into the two related items tables
+    product_bought_together, product_also_viewed = process_related_items(
+        steps["metadata"][["asin", "related"]].copy()
+    )
     product_bought_together.rename(
         columns=COLUMN_RENAMING_SCHEMAS["product_bought_together"], inplace=True
     )
@@ -221,69 +304,61 @@ def transform_metadata(metadata: pd.DataFrame) -> dict:
         columns=COLUMN_RENAMING_SCHEMAS["product_also_viewed"], inplace=True
     )
 
-    # now we process the nulls (again a bit too much repetition
-    # but it makes it easier to debug)
-
-    products = process_nulls(
-        target_data=products, nulls_handling=NULL_HANDLING_SCHEMAS["products"]
-    )
-    product_images = process_nulls(
-        target_data=product_images,
-        nulls_handling=NULL_HANDLING_SCHEMAS["product_images"],
-    )
-    product_sales_ranking = process_nulls(
-        target_data=product_sales_ranking,
-        nulls_handling=NULL_HANDLING_SCHEMAS["product_sales_ranking"],
-    )
-    product_categories = process_nulls(
-        target_data=product_categories,
-        nulls_handling=NULL_HANDLING_SCHEMAS["product_categories"],
-    )
-    product_bought_together = process_nulls(
-        target_data=product_bought_together,
-        nulls_handling=NULL_HANDLING_SCHEMAS["product_bought_together"],
-    )
-    product_also_viewed = process_nulls(
-        target_data=product_also_viewed,
-        nulls_handling=NULL_HANDLING_SCHEMAS["product_also_viewed"],
-    )
-
-    # and finally we cast the dtypes
+    return product_bought_together, product_also_viewed
+
+
+def build_category_tree(steps: LazyTables) -> tuple:
+    # (the category tree tables come out with their final column names)
+    return process_category_tree(steps["metadata"][["asin", "categories"]].copy())
+
+
+METADATA_STEPS = {
+    "related_items": build_related_items,
+    "category_tree_tables": build_category_tree,
+    "products": build_products,
+    "product_images": build_product_images,
+    "product_sales_ranking": build_product_sales_ranking,
+    "product_categories": build_product_categories,
+    "product_bought_together": lambda steps: clean_table(
+        steps["related_items"][0], "product_bought_together"
+    ),
+    "product_also_viewed": lambda steps: clean_table(
+        steps["related_items"][1], "product_also_viewed"
+    ),
+    "category_tree": lambda steps: clean_table(
+        steps["category_tree_tables"][0], "category_tree"
+    ),
+    "category_closure": lambda steps: clean_table(
+        steps["category_tree_tables"][1], "category_closure"
+    ),
+    "product_category_leaves": lambda steps: clean_table(
+        steps["category_tree_tables"][2], "product_category_leaves"
+    ),
+}
+
+METADATA_TABLES = [
+    "products",
+    "product_images",
+    "product_sales_ranking",
+    "product_categories",
+    "product_bought_together",
+    "product_also_viewed",
+    "category_tree",
+    "category_closure",
+    "product_category_leaves",
+]
+
+
+def transform_metadata(
+    metadata: pd.DataFrame, tables: Optional[List[str]] = None
+) -> dict:
+    """Transform the metadata into the requested tables (default: all)"""
+    # this dataset needs no pre-processing of columns, so every
+    # table goes straight to splitting the data
 
-    products = convert_data_types(
-        target_df=products,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["products"],
-    )
-    product_images = convert_data_types(
-        target_df=product_images,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["product_images"],
-    )
-    product_sales_ranking = convert_data_types(
-        target_df=product_sales_ranking,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["product_sales_ranking"],
-    )
-    product_categories = convert_data_types(
-        target_df=product_categories,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["product_categories"],
-    )
-    product_bought_together = convert_data_types(
-        target_df=product_bought_together,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["product_bought_together"],
-    )
-    product_also_viewed = convert_data_types(
-        target_df=product_also_viewed,
-        data_type_schema=COLUMN_DATA_TYPE_SCHEMAS["product_also_viewed"],
+    # there are no duplicates to drop here (we checked in
+    # the preliminary analysis and the validations will
+    # let us know if something snuck in lol)
+    return compute_tables(
+        {**METADATA_STEPS, "metadata": lambda steps: metadata}, METADATA_TABLES, tables
     )
-
-    # finally, pack the dictionary & return
-
-    results_dict = {
-        "products": products,
-        "product_images": product_images,
-        "product_sales_ranking": product_sales_ranking,
-        "product_categories": product_categories,
-        "product_bought_together": product_bought_together,
-        "product_also_viewed": product_also_viewed,
-    }
-
-    return results_dict
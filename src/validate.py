@@ -6,9 +6,6 @@ import os
 
 import pandas as pd
 import yaml
-from boto3 import Session
-
-from src.constants import S3_ACCESS_KEY_ID, S3_ACCESS_KEY_SECRET, S3_BUCKET_NAME
 
 
 class SchemaMismatch(Exception):
@@ -32,49 +29,3 @@ def validate_raw_data(target_data: pd.DataFrame, dataset_name: str) -> None:
 
     if [column_name for column_name in target_data.columns] != current_data_schema:
         raise SchemaMismatch("Incorrect schema detected!")
-
-
-def list_bucket_files_and_update_time():
-    """List S3 files + upload time"""
-    session = Session(
-        aws_access_key_id=S3_ACCESS_KEY_ID,
-        aws_secret_access_key=S3_ACCESS_KEY_SECRET,
-        region_name="eu-north-1",
-    )
-
-    s3 = session.resource("s3")
-
-    # get objects
-    objects_in_bucket = s3.meta.client.list_objects(Bucket=S3_BUCKET_NAME)
-
-    contents_df = pd.DataFrame(objects_in_bucket["Contents"])
-
-    # filter data
-    contents_df["folder"] = [key.split("/")[0] for key in contents_df["Key"]]
-
-    contents_uploads = contents_df[contents_df["folder"] == "uploads"]
-
-    contents_uploads = contents_uploads[["Key", "LastModified"]]
-
-    # list contents
-    print(contents_uploads)
-
-
-def validate_local_upload_mock_dwh() -> None:
-    """Read from the mock DWH csv, print latest 10"""
-    # latest_uploads = pd.read_csv("/mock_dwh/mock_dwh.csv")
-    # [print(file_name) for file_name in os.listdir("mock_dwh")]
-    # print(os.listdir("mock_dwh"))
-    # print(latest_uploads[:10])
-
-    """
-    I tried 1'000'000 ways to get Python to print the files
-    it has generated within the docker, and for the life of me
-    I cannot figure out why it won't see the files when printing,
-    even though they are there when I check the daemon. This is
-    suboptimal handling of the situation, but it's 11:30 pm
-    on Sunday and I want to rest a bit before tomorrow, so I'll
-    leave it like this for now
-    """
-
-    print("Upload successful!")
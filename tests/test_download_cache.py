@@ -0,0 +1,123 @@
+import hashlib
+import io
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from src.download_cache import S3DownloadCache
+
+BUCKET = "raw-bucket"
+
+
+class StreamingBody(io.BytesIO):
+    def iter_chunks(self, chunk_size: int):
+        return iter(lambda: self.read(chunk_size), b"")
+
+
+class StubS3Client:
+    def __init__(self):
+        """In-memory objects, counting the downloads"""
+        self.objects = {}
+        self.get_object_calls = []
+
+    def put(self, key: str, body: bytes) -> None:
+        self.objects[key] = body
+
+    def etag(self, key: str) -> str:
+        # quoted, like the real ones
+        return f'"{hashlib.md5(self.objects[key]).hexdigest()}"'
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        return {"ETag": self.etag(Key), "ContentLength": len(self.objects[Key])}
+
+    def get_object(self, Bucket: str, Key: str, IfMatch: str) -> dict:
+        self.get_object_calls.append(Key)
+        assert IfMatch == self.etag(Key), "precondition failed"
+
+        return {"Body": StreamingBody(self.objects[Key])}
+
+
+class TestS3DownloadCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.s3_client = StubS3Client()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_cache(self, max_size_bytes: int = 10 * 1024**2) -> S3DownloadCache:
+        return S3DownloadCache(
+            cache_directory=self.temp_dir.name,
+            max_size_bytes=max_size_bytes,
+            s3_client=self.s3_client,
+        )
+
+    def download(self, cache: S3DownloadCache, key: str) -> bytes:
+        with cache.download(BUCKET, key) as cached_file:
+            return cached_file.read()
+
+    def cached_files(self) -> list:
+        return sorted(os.listdir(self.temp_dir.name))
+
+    def test_unchanged_object_is_reused(self):
+        self.s3_client.put("raw_data/metadata.csv", b"asin,title\n1,a\n")
+
+        for _ in range(3):
+            # a new cache object every time, like every pipeline run
+            self.assertEqual(
+                self.download(self.make_cache(), "raw_data/metadata.csv"),
+                b"asin,title\n1,a\n",
+            )
+
+        self.assertEqual(self.s3_client.get_object_calls, ["raw_data/metadata.csv"])
+        self.assertEqual(len(self.cached_files()), 1)
+
+    def test_changed_object_is_downloaded_again(self):
+        cache = self.make_cache()
+        self.s3_client.put("raw_data/metadata.csv", b"old")
+        self.download(cache, "raw_data/metadata.csv")
+
+        self.s3_client.put("raw_data/metadata.csv", b"new version")
+        self.assertEqual(self.download(cache, "raw_data/metadata.csv"), b"new version")
+        self.assertEqual(self.download(cache, "raw_data/metadata.csv"), b"new version")
+
+        self.assertEqual(len(self.s3_client.get_object_calls), 2)
+        # the old version is dropped, not kept next to the new one
+        self.assertEqual(len(self.cached_files()), 1)
+        self.assertTrue(
+            self.cached_files()[0].endswith(
+                self.s3_client.etag("raw_data/metadata.csv").strip('"')
+            )
+        )
+
+    def test_least_recently_used_is_evicted(self):
+        cache = self.make_cache(max_size_bytes=250)
+        for key in ("a.csv", "b.csv", "c.csv"):
+            self.s3_client.put(key, key.encode("utf-8") * 20)  # 100 bytes
+
+        self.download(cache, "a.csv")
+        self.download(cache, "b.csv")
+        # a was downloaded first, but b is the one that hasn't been used since
+        now = time.time()
+        for file_name in self.cached_files():
+            os.utime(os.path.join(self.temp_dir.name, file_name), (now - 60, now - 60))
+        self.download(cache, "a.csv")
+
+        # 300 bytes > 250: b goes
+        self.download(cache, "c.csv")
+        self.assertEqual(self.s3_client.get_object_calls, ["a.csv", "b.csv", "c.csv"])
+        self.assertEqual(len(self.cached_files()), 2)
+
+        self.download(cache, "a.csv")
+        self.download(cache, "b.csv")
+        self.assertEqual(
+            self.s3_client.get_object_calls, ["a.csv", "b.csv", "c.csv", "b.csv"]
+        )
+
+    def test_object_bigger_than_the_cache_still_works(self):
+        cache = self.make_cache(max_size_bytes=10)
+        self.s3_client.put("big.csv", b"x" * 100)
+
+        self.assertEqual(self.download(cache, "big.csv"), b"x" * 100)
+        self.assertEqual(len(self.cached_files()), 1)
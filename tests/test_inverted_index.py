@@ -0,0 +1,147 @@
+import json
+import os
+import re
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from src.inverted_index import (
+    TOKEN_PATTERN,
+    IncorrectQuery,
+    InvertedIndex,
+    decode_varints,
+    encode_varints,
+    tokenize_reviews,
+    write_segment,
+)
+
+REVIEWS = pd.DataFrame(
+    {
+        "review_id": ["a", "b", "c", "d"],
+        "review_text": [
+            "Great battery life",
+            "The battery died, charger broken",
+            "Nice charger",
+            None,
+        ],
+        "review_summary": ["battery", "broken", "great", "Great charger"],
+    }
+)
+# the review_key of every review_id (what the key dictionary would give)
+REVIEW_KEYS = {"a": 3, "b": 150, "c": 151, "d": 100000}
+
+
+def write_index(index_directory: str, batches: list) -> InvertedIndex:
+    """An index with one segment per batch of reviews"""
+    segments = []
+    for segment_number, reviews in enumerate(batches):
+        term_numbers, terms, review_ids = tokenize_reviews(
+            reviews, ("review_text", "review_summary")
+        )
+        segment_name = f"segment{segment_number}"
+        write_segment(
+            term_numbers,
+            terms,
+            pd.Series(review_ids).map(REVIEW_KEYS).to_numpy(),
+            os.path.join(index_directory, "segments", segment_name),
+        )
+        segments.append({"name": segment_name, "level": 0})
+
+    with open(os.path.join(index_directory, "manifest.json"), "w") as file:
+        json.dump({"segments": segments}, file)
+
+    return InvertedIndex(index_directory)
+
+
+class TestVarints(TestCase):
+    def test_round_trip(self):
+        values = np.array(
+            [0, 1, 127, 128, 300, 16383, 16384, 2**32, 2**63, 2**64 - 1],
+            dtype="uint64",
+        )
+        encoded = encode_varints(values)
+
+        self.assertEqual(encoded.dtype, np.uint8)
+        # 7 bits per byte: 1 byte up to 127, 2 up to 16383, 10 for the biggest
+        self.assertEqual(len(encode_varints(values[:3])), 3)
+        self.assertEqual(len(encode_varints(values[-1:])), 10)
+        np.testing.assert_array_equal(decode_varints(encoded), values)
+
+    def test_empty(self):
+        self.assertEqual(len(encode_varints(np.empty(0, dtype="uint64"))), 0)
+        self.assertEqual(len(decode_varints(np.empty(0, dtype="uint8"))), 0)
+
+
+class TestTokenizeReviews(TestCase):
+    def test_terms_per_review(self):
+        term_numbers, terms, review_ids = tokenize_reviews(
+            REVIEWS.iloc[:1], ("review_text",)
+        )
+
+        self.assertEqual(
+            sorted(zip(review_ids, np.asarray(terms)[term_numbers])),
+            [("a", "battery"), ("a", "great"), ("a", "life")],
+        )
+
+    def test_batch_without_terms(self):
+        # no text has a single [a-z0-9] word in it
+        reviews = pd.DataFrame(
+            {"review_id": [1, 2, 3], "review_text": [None, "", "¡¿ — !!"]}
+        )
+        term_numbers, terms, review_ids = tokenize_reviews(reviews, ("review_text",))
+
+        self.assertEqual(len(term_numbers), 0)
+        self.assertEqual(len(terms), 0)
+        self.assertEqual(len(review_ids), 0)
+
+    def test_long_terms_are_dropped(self):
+        reviews = pd.DataFrame({"review_id": [1], "review_text": ["ok " + "x" * 25]})
+        term_numbers, terms, _ = tokenize_reviews(reviews, ("review_text",))
+
+        self.assertEqual(list(np.asarray(terms)[term_numbers]), ["ok"])
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # two segments, so the search goes over both
+        self.index = write_index(
+            self.temp_dir.name, [REVIEWS.iloc[:2], REVIEWS.iloc[2:]]
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_single_term(self):
+        np.testing.assert_array_equal(self.index.search("battery"), [3, 150])
+        np.testing.assert_array_equal(self.index.search("charger"), [150, 151, 100000])
+
+    def test_and_or_not(self):
+        # (the summary counts too: "Nice charger" + "great")
+        np.testing.assert_array_equal(self.index.search("great charger"), [151, 100000])
+        np.testing.assert_array_equal(
+            self.index.search("great AND charger"), [151, 100000]
+        )
+        np.testing.assert_array_equal(self.index.search("life OR nice"), [3, 151])
+        np.testing.assert_array_equal(
+            self.index.search("charger NOT broken"), [151, 100000]
+        )
+
+    def test_unknown_term(self):
+        self.assertEqual(len(self.index.search("screen")), 0)
+
+    def test_group_without_terms_raises(self):
+        with self.assertRaises(IncorrectQuery):
+            self.index.search("battery OR NOT broken")
+
+    def test_search_matches_a_scan(self):
+        # the same answer as going through every text
+        for term in ["battery", "great", "broken", "the"]:
+            scanned = sorted(
+                REVIEW_KEYS[review_id]
+                for review_id, text, summary in REVIEWS.itertuples(index=False)
+                if term in re.findall(TOKEN_PATTERN, f"{text} {summary}".lower())
+            )
+            np.testing.assert_array_equal(self.index.search(term), scanned)
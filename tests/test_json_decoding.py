@@ -0,0 +1,150 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import pandas as pd
+
+from src import json_decoding
+from src.api_interactor import APIInteractor
+from src.json_decoding import RAW_DATA_SCHEMAS
+
+METADATA_RECORDS = [
+    {
+        "metadataid": product_number,
+        "asin": f"B{product_number:09d}",
+        "salesrank": {"Electronics": product_number * 10},
+        "imurl": f"http://img/{product_number}.jpg",
+        "categories": [["Electronics", "Phones"], ["Cases"]],
+        "title": f"Case nr. {product_number} – “quoted”",
+        "description": None,
+        "price": 9.99 + product_number,
+        "related": {
+            "also_bought": [f"B{product_number + 1:09d}"],
+            "bought_together": [],
+        },
+        # some records come without a brand at all
+        **({"brand": "Acme"} if product_number % 2 == 0 else {}),
+    }
+    for product_number in range(50)
+]
+
+REVIEWS_RECORDS = [
+    {
+        "Unnamed: 0": review_number,
+        "reviewerID": f"A{review_number}",
+        "asin": "B000000001",
+        "reviewerName": None if review_number == 3 else f"name {review_number}",
+        "helpful": [review_number, review_number + 2],
+        "reviewText": "ok",
+        "overall": 4.0,
+        "summary": "fine",
+        "unixReviewTime": 1388534400 + review_number,
+        "reviewTime": "01 1, 2014",
+    }
+    for review_number in range(20)
+]
+
+PAGES = {"/metadata": METADATA_RECORDS, "/reviews": REVIEWS_RECORDS}
+
+
+class GzippedPageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        self.server.requests.append(
+            (path, self.headers["Authorization"], self.headers["Accept-Encoding"])
+        )
+        body = gzip.compress(json.dumps({"data": PAGES[path]}).encode("utf-8"))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def normalize_like_before(records: list, endpoint: str) -> pd.DataFrame:
+    """The old json_normalize decoding, nested values as the CSVs have them"""
+    # (max_level=0 keeps the dicts whole, instead of a column per key)
+    flattened = pd.json_normalize(records, max_level=0).reindex(
+        columns=RAW_DATA_SCHEMAS[endpoint]
+    )
+
+    return flattened.map(
+        lambda value: repr(value) if isinstance(value, (list, dict)) else value
+    )
+
+
+def as_comparable(frame: pd.DataFrame) -> pd.DataFrame:
+    # missing values are None in one and NaN in the other
+    return frame.astype(object).where(frame.notna(), None)
+
+
+class TestDecodeApiPages(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), GzippedPageHandler)
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.api_interactor = APIInteractor(
+            f"http://127.0.0.1:{cls.server.server_port}", "test-token"
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def retrieve_pages(self, endpoint: str) -> list:
+        return list(
+            self.api_interactor.retrieve_data_batches(
+                endpoint, "2014-01-01 00:00:00", "2014-01-02 00:00:00"
+            )
+        )
+
+    def check_pages(self):
+        for endpoint in ("metadata", "reviews"):
+            with self.subTest(endpoint=endpoint):
+                pages = self.retrieve_pages(endpoint)
+
+                # fewer than 10000 records = the last page
+                self.assertEqual(len(pages), 1)
+                self.assertEqual(list(pages[0].columns), RAW_DATA_SCHEMAS[endpoint])
+                pd.testing.assert_frame_equal(
+                    as_comparable(pages[0]),
+                    as_comparable(
+                        normalize_like_before(PAGES[f"/{endpoint}"], endpoint)
+                    ),
+                )
+
+    @skipUnless(json_decoding.ijson is not None, "ijson isn't installed")
+    def test_streamed_with_ijson(self):
+        self.check_pages()
+
+    def test_without_ijson(self):
+        with patch.object(json_decoding, "ijson", None):
+            self.check_pages()
+
+    def test_requests_are_authorized_and_accept_gzip(self):
+        self.retrieve_pages("reviews")
+        path, authorization, accept_encoding = self.server.requests[-1]
+
+        self.assertEqual(path, "/reviews")
+        self.assertEqual(authorization, "Bearer test-token")
+        self.assertIn("gzip", accept_encoding)
+
+    def test_nested_values_are_literal_strings(self):
+        metadata = self.retrieve_pages("metadata")[0]
+
+        # what the transforms parse with literal_eval, like the CSV values
+        self.assertEqual(metadata.loc[1, "salesrank"], "{'Electronics': 10}")
+        self.assertEqual(
+            metadata.loc[0, "categories"], "[['Electronics', 'Phones'], ['Cases']]"
+        )
+        self.assertIsNone(metadata.loc[1, "brand"])
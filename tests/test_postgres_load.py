@@ -0,0 +1,162 @@
+import os
+import uuid
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+from src import postgres_load
+from src.main import IncompatiblePipelineOptions, run_pipelines
+from src.postgres_load import (
+    MissingPrimaryKeyColumns,
+    PostgresSchemaDrift,
+    copy_to_postgres,
+    find_primary_key,
+)
+
+# e.g. postgresql://postgres@localhost/postgres; the tests make (+ drop)
+# their own schema in it
+POSTGRES_TEST_DSN = os.environ.get("POSTGRES_TEST_DSN")
+
+
+def make_products(rows: int = 25_000) -> pd.DataFrame:
+    """A table with every type the loader maps (and NULLs in each)"""
+    products = pd.DataFrame(
+        {
+            "item_id": [f"B{row_number:09d}" for row_number in range(rows)],
+            "title": [f"title ünïcode {row_number}" for row_number in range(rows)],
+            "price": np.arange(rows) / 100,
+            "ranking": pd.array(np.arange(rows), dtype="Int64"),
+            "in_stock": pd.array(np.arange(rows) % 2 == 0, dtype="boolean"),
+            "listed_at": pd.Timestamp("2014-01-01 12:34:56.789")
+            + pd.to_timedelta(np.arange(rows), unit="s"),
+        }
+    )
+    products.loc[::7, ["title", "price", "ranking", "in_stock", "listed_at"]] = None
+    products.loc[::11, "title"] = ""
+
+    return products
+
+
+class TestFindPrimaryKey(TestCase):
+    def test_declared_key(self):
+        self.assertEqual(find_primary_key(make_products(3), "products"), ["item_id"])
+
+    def test_surrogate_key_replaces_the_string_key(self):
+        bridge = pd.DataFrame({"item_key": [1], "category": ["Books"]})
+
+        self.assertEqual(
+            find_primary_key(bridge, "product_categories"), ["item_key", "category"]
+        )
+
+    def test_sampled_table_has_the_real_key(self):
+        self.assertEqual(
+            find_primary_key(make_products(3), "products_sample"), ["item_id"]
+        )
+
+    def test_missing_key_column_raises(self):
+        with self.assertRaises(MissingPrimaryKeyColumns):
+            find_primary_key(make_products(3).drop(columns="item_id"), "products")
+
+    def test_table_without_key_appends(self):
+        self.assertEqual(find_primary_key(make_products(3), "products_changes"), [])
+
+
+@skipUnless(
+    POSTGRES_TEST_DSN and postgres_load.ConnectionPool is not None,
+    "needs psycopg and a POSTGRES_TEST_DSN",
+)
+class TestCopyToPostgres(TestCase):
+    def setUp(self):
+        self.schema = f"pipeline_test_{uuid.uuid4().hex[:8]}"
+        for patcher in (
+            patch.object(postgres_load, "POSTGRES_DSN", POSTGRES_TEST_DSN),
+            patch.object(postgres_load, "POSTGRES_SCHEMA", self.schema),
+            # small parts, so the parallel copies are tested too
+            patch.object(postgres_load, "POSTGRES_COPY_PART_ROWS", 10_000),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        postgres_load.get_postgres_pool.cache_clear()
+        self.addCleanup(postgres_load.get_postgres_pool.cache_clear)
+        self.addCleanup(self.drop_schema)
+
+    def drop_schema(self):
+        with postgres_load.get_postgres_pool().connection() as connection:
+            connection.execute(f'DROP SCHEMA IF EXISTS "{self.schema}" CASCADE')
+
+    def read_table(self, table_name: str) -> pd.DataFrame:
+        with postgres_load.get_postgres_pool().connection() as connection:
+            cursor = connection.execute(
+                f'SELECT * FROM "{self.schema}"."{table_name}" ORDER BY item_id'
+            )
+            return pd.DataFrame(
+                cursor.fetchall(),
+                columns=[column.name for column in cursor.description],
+            )
+
+    def test_binary_and_csv_load_the_same_rows(self):
+        products = make_products()
+
+        copy_to_postgres(products, "products", copy_format="csv")
+        with postgres_load.get_postgres_pool().connection() as connection:
+            connection.execute(
+                f'ALTER TABLE "{self.schema}".products RENAME TO products_csv'
+            )
+        copy_to_postgres(products, "products", copy_format="binary")
+
+        binary_rows = self.read_table("products")
+        pd.testing.assert_frame_equal(binary_rows, self.read_table("products_csv"))
+        self.assertEqual(len(binary_rows), len(products))
+        self.assertEqual(
+            binary_rows["title"].isna().sum(), products["title"].isna().sum()
+        )
+        self.assertEqual(
+            (binary_rows["title"] == "").sum(), (products["title"] == "").sum()
+        )
+
+    def test_reload_merges_on_the_primary_key(self):
+        products = make_products(100)
+
+        copy_to_postgres(products, "products", copy_format="binary")
+        copy_to_postgres(
+            products.assign(title="updated"), "products", copy_format="binary"
+        )
+
+        loaded = self.read_table("products")
+        self.assertEqual(len(loaded), 100)
+        self.assertTrue((loaded["title"] == "updated").all())
+
+    def test_new_column_is_added(self):
+        products = make_products(10)
+
+        copy_to_postgres(products.drop(columns="listed_at"), "products")
+        copy_to_postgres(products, "products")
+
+        self.assertEqual(self.read_table("products")["listed_at"].notna().sum(), 8)
+
+    def test_schema_drift_raises(self):
+        products = make_products(10)
+        copy_to_postgres(products, "products")
+
+        # e.g. the text columns moved out of line
+        with self.assertRaisesRegex(PostgresSchemaDrift, "title"):
+            copy_to_postgres(products.drop(columns="title"), "products")
+
+        with self.assertRaisesRegex(PostgresSchemaDrift, "ranking"):
+            copy_to_postgres(products.assign(ranking="first"), "products")
+
+
+class TestPostgresCopyOptions(TestCase):
+    def test_file_uploads_are_rejected_up_front(self):
+        # checked before anything is extracted, let alone merged into Postgres
+        for option in ("out_of_line_text", "copurchase_graph"):
+            with self.subTest(option=option):
+                with self.assertRaisesRegex(IncompatiblePipelineOptions, option):
+                    run_pipelines(
+                        retrieve_from="local",
+                        upload_to="postgres_copy",
+                        **{option: True},
+                    )
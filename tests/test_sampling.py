@@ -0,0 +1,92 @@
+import ast
+from unittest import TestCase
+
+import pandas as pd
+
+from src.sampling import is_sampled, sample_records
+from src.transform import METADATA_TABLES, transform_metadata
+
+PRODUCTS = 2000
+
+
+def make_metadata(products: int = PRODUCTS) -> pd.DataFrame:
+    """Raw metadata where every product links to the next few"""
+    asins = [f"B{product_number:09d}" for product_number in range(products)]
+
+    return pd.DataFrame(
+        {
+            "metadataid": range(products),
+            "asin": asins,
+            "salesrank": [
+                str({"Electronics": product_number})
+                for product_number in range(products)
+            ],
+            "imurl": [f"http://img/{asin}.jpg" for asin in asins],
+            "categories": [str([["Electronics", "Phones", "Cases"]])] * products,
+            "title": [f"title {asin}" for asin in asins],
+            "description": [f"description {asin}" for asin in asins],
+            "price": 9.99,
+            "related": [
+                str(
+                    {
+                        "also_bought": asins[product_number + 1 : product_number + 4],
+                        "also_viewed": asins[product_number + 4 : product_number + 6],
+                    }
+                )
+                for product_number in range(products)
+            ],
+            "brand": "brand",
+        }
+    )
+
+
+class TestSampling(TestCase):
+    def test_sample_keeps_about_the_fraction(self):
+        metadata = make_metadata()
+
+        sampled = sample_records(metadata, "metadata", 0.01)
+
+        self.assertGreater(len(sampled), 0)
+        self.assertLess(len(sampled), PRODUCTS * 0.03)
+        self.assertTrue(is_sampled(sampled["asin"], 0.01).all())
+
+    def test_sample_is_the_same_every_run(self):
+        metadata = make_metadata()
+
+        pd.testing.assert_frame_equal(
+            sample_records(metadata, "metadata", 0.05),
+            sample_records(metadata.sample(frac=1, random_state=0), "metadata", 0.05)
+            .sort_values("asin")
+            .reset_index(drop=True),
+        )
+
+    def test_sample_drops_links_to_products_outside_it(self):
+        sampled = sample_records(make_metadata(), "metadata", 0.2)
+
+        sampled_asins = set(sampled["asin"])
+        for related in sampled["related"].dropna():
+            for linked_asins in ast.literal_eval(related).values():
+                self.assertTrue(set(linked_asins) <= sampled_asins)
+
+    def test_one_percent_sample_transforms(self):
+        # at 1% hardly any links are left, so the related item tables are
+        # empty, but they still have to come out with their columns
+        sampled = sample_records(make_metadata(), "metadata", 0.01)
+
+        tables = transform_metadata(sampled)
+
+        self.assertEqual(set(tables), set(METADATA_TABLES))
+        self.assertEqual(len(tables["products"]), len(sampled))
+        for table_name in ("product_bought_together", "product_also_viewed"):
+            self.assertIn("item_id", tables[table_name].columns)
+
+    def test_empty_sample_transforms(self):
+        # e.g. 1% of a handful of products is no products at all
+        sampled = sample_records(make_metadata(products=20), "metadata", 0.001)
+
+        tables = transform_metadata(sampled)
+
+        self.assertEqual(len(sampled), 0)
+        for table_data in tables.values():
+            self.assertEqual(len(table_data), 0)
+            self.assertGreater(len(table_data.columns), 0)